@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Replay cache access traces recorded by graph-ingest.py (live mode with
+--trace) against each layer 1 eviction policy at several sizes, and report
+the hit rates. Traces of the same cache from several workers can be given
+together; each is replayed against its own cache, like the workers do.
+
+    python3 graph-ingest.py --mode live --trace traces/
+    python3 -m benchmarks.cache_policies traces/domain.*.trace --sizes 10000,100000,1000000
+
+Sizes are in entries. At a given memory budget CLOCK holds far more
+entries than the others, see utils.eviction.object_entry_bytes.
+"""
+
+import argparse
+
+from utils.eviction import policies, read_trace, simulate, sized_cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('traces', nargs='+', help='trace files to replay')
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000', help='comma separated cache sizes in entries')
+    parser.add_argument('--policies', default=','.join(policies), help='comma separated policies to compare')
+    args = parser.parse_args()
+
+    traces = [read_trace(filename).tolist() for filename in args.traces]
+    sizes = [int(size) for size in args.sizes.split(',')]
+    names = args.policies.split(',')
+    print('{} accesses, {} distinct keys'.format(
+        sum(len(trace) for trace in traces), len(set().union(*(set(trace) for trace in traces))),
+    ))
+
+    print('{:>10} '.format('size') + ' '.join('{:>10}'.format(name) for name in names))
+    for size in sizes:
+        rates = []
+        for name in names:
+            hits = sum(simulate(trace, sized_cache(name, size)) * len(trace) for trace in traces)
+            rates.append(hits / max(1, sum(len(trace) for trace in traces)))
+        print('{:>10} '.format(size) + ' '.join('{:>10.2%}'.format(rate) for rate in rates))
+
+
+if __name__ == '__main__':
+    main()
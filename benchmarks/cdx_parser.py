@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Compare the old parse.parse based cdx line handling in stream.py against
+utils.cdx on a synthetic cdx file.
+
+    python3 -m benchmarks.cdx_parser --lines 200000
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import tempfile
+import time
+
+import parse
+
+from utils.cdx import parse_lines
+
+words = ['news', 'shop', 'blog', 'docs', 'static', 'about', 'contact', 'index', 'product', 'search']
+tlds = ['com', 'org', 'net', 'de', 'uk', 'ru', 'jp', 'fr', 'br', 'es']
+mimes = ['text/html', 'application/pdf', 'image/jpeg', 'text/plain']
+
+
+def synthetic_cdx(filename: str, lines: int, seed: int = 0):
+    """
+    Write a gzipped cdx file with realistic looking records. Domains are
+    generated in runs, since real cdx files are surt sorted.
+
+    :param filename:
+    :param lines:
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    with gzip.open(filename, 'wb') as f:
+        written = 0
+        while written < lines:
+            surt = ','.join([rng.choice(tlds), rng.choice(words) + str(rng.randint(0, 10 ** 6))])
+            host = '.'.join(reversed(surt.split(',')))
+            for _ in range(min(rng.randint(1, 50), lines - written)):
+                path = '/' + '/'.join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+                timestamp = '202009{:02d}{:06d}'.format(rng.randint(1, 30), rng.randint(0, 235959))
+                meta = {
+                    'url': 'https://' + host + path,
+                    'mime': rng.choice(mimes),
+                    'mime-detected': rng.choice(mimes),
+                    'status': '200',
+                    'digest': '%032X' % rng.getrandbits(128),
+                    'length': str(rng.randint(500, 100000)),
+                    'offset': str(rng.randint(0, 10 ** 9)),
+                    'filename': 'crawl-data/CC-MAIN-2020-40/segments/warc.gz',
+                }
+                f.write('{}){} {} {}\n'.format(surt, path, timestamp, json.dumps(meta)).encode())
+                written += 1
+
+
+def legacy(filename: str, batch_size: int = 10000) -> int:
+    """
+    The per-line parsing that stream.py used to do. Rows are collected in
+    batches like the records of batched, so both sides build their output.
+
+    :param filename:
+    :param batch_size: rows to collect before starting a new batch
+    :return:
+    """
+    count = 0
+    rows = []
+    with gzip.open(filename, 'rb') as f:
+        for line in f:
+            parsed = parse.parse("{domain}){path} {timestamp} {meta}", line.decode())
+            meta = json.loads(parsed['meta'])
+            row = [
+                '.'.join(parsed.named.get('domain', None).split(',')[::-1]),
+                parsed.named.get('domain', None).split(',')[-1],
+                parsed.named.get('path', None),
+                meta.get('status', None),
+                parsed.named.get('timestamp', None),
+                meta.get('mime', None),
+                meta.get('mime-detected'),
+                meta.get('length', None),
+                meta.get('url', None),
+                meta.get('redirect', None),
+            ]
+            rows.append(row)
+            if len(rows) >= batch_size:
+                count += len(rows)
+                rows = []
+    return count + len(rows)
+
+
+def batched(filename: str, read_size: int = 1 << 20) -> int:
+    """
+    utils.cdx parsing the way stream.py does it now.
+
+    :param filename:
+    :param read_size:
+    :return:
+    """
+    count = 0
+    with gzip.open(filename, 'rb') as f:
+        while True:
+            lines = f.readlines(read_size)
+            if len(lines) == 0:
+                break
+            count += len(parse_lines(lines))
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=200000, help='number of synthetic cdx lines')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'cdx-00000.gz')
+        synthetic_cdx(filename, args.lines)
+
+        for name, func in [('parse.parse', legacy), ('utils.cdx', batched)]:
+            start = time.perf_counter()
+            count = func(filename)
+            elapsed = time.perf_counter() - start
+            print('{:<12} {:>10} lines {:>8.2f}s {:>12.0f} lines/s'.format(name, count, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Compare the row by row reading graph-ingest.py used to do (csv.DictReader
+rows wrapped in an EasyDict, with the document key and tld worked out per
+row) against the chunked column reader it uses now. Both build the same
+mutation batches, without talking to DGraph or the caches.
+
+    python3 -m benchmarks.ingest_reader --rows 500000
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import tempfile
+import time
+
+from easydict import EasyDict as edict
+
+from benchmarks.ingest_strategies import load_graph_ingest
+from utils.mutations import MutationBatch
+from utils.storage import open_writer, read_rows
+
+columns = ['domain', 'ip', 'asn_num', 'country', 'asn_org', 'tld', 'path', 'status', 'timestamp', 'mime', 'mime_detected', 'length', 'url', 'redirect']
+words = ['news', 'shop', 'blog', 'docs', 'static', 'about', 'contact', 'index', 'product', 'search']
+tlds = ['com', 'org', 'net', 'de', 'uk', 'ru', 'jp', 'fr', 'br', 'es']
+
+
+def synthetic_dataset(name: str, rows: int, output_format: str, seed: int = 0) -> str:
+    """
+    Write preprocessed output with runs of rows per domain, like the real
+    (surt sorted) data.
+
+    :param name: output name without extension
+    :param rows:
+    :param output_format: csv or parquet
+    :param seed:
+    :return: the dataset's filename
+    """
+    rng = random.Random(seed)
+    writer = open_writer(name, columns, output_format=output_format)
+    batch = []
+    while len(batch) < rows:
+        domain = rng.choice(words) + str(rng.randint(0, 10 ** 6)) + '.' + rng.choice(tlds)
+        ip = '.'.join(str(rng.randint(1, 254)) for _ in range(4))
+        asn = str(rng.randint(1, 60000))
+        for _ in range(min(rng.randint(1, 50), rows - len(batch))):
+            path = '/' + '/'.join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+            batch.append([
+                domain, ip, asn, 'US', 'ORG', domain.split('.')[-1], path, '200', '20200901000000',
+                'text/html', 'text/html', '1000', 'https://' + domain + path, '',
+            ])
+    writer.write(batch)
+    writer.close()
+    return writer.filename if output_format == 'csv' else name + '.parquet'
+
+
+def build(batch: MutationBatch, domain: str, ip: str, asn_num: str, path: str, doc_key: str, tld: str):
+    """
+    The batch building half of insert, with every node treated as new.
+
+    :return:
+    """
+    domain_uid = batch.get('domain', domain)
+    if domain_uid is None:
+        domain_uid = batch.node('domain', domain, {'dgraph.type': 'Domain', 'domain': domain, 'tld': tld, 'ip': ip})
+        batch.edge('0x1', 'domains', domain_uid)
+    document_uid = batch.get('doc_key', doc_key)
+    if document_uid is None:
+        document_uid = batch.node('doc_key', doc_key, {'dgraph.type': 'Document', 'path': path, 'doc_key': doc_key})
+    batch.edge(domain_uid, 'documents', document_uid)
+
+
+def legacy(filename: str, batch_size: int) -> int:
+    """
+    Row by row, the way insert used to read.
+
+    :param filename:
+    :param batch_size:
+    :return:
+    """
+    count = 0
+    batch = MutationBatch()
+    for row in read_rows(filename, columns=['domain', 'ip', 'asn_num', 'path']):
+        row = edict(row)
+        doc_key = hashlib.md5(row.path.encode()).hexdigest()
+        build(batch, row.domain, row.ip, row.asn_num, row.path, doc_key, row.domain.split('.')[-1])
+        count += 1
+        if count % batch_size == 0:
+            batch = MutationBatch()
+    return count
+
+
+def chunked(filename: str, batch_size: int) -> int:
+    """
+    Column chunks, the way insert reads now.
+
+    :param filename:
+    :param batch_size:
+    :return:
+    """
+    graph_ingest = load_graph_ingest()
+    count = 0
+    for _, _, chunk in graph_ingest.read_chunks([filename], batch_size):
+        if chunk is None:
+            continue
+        batch = MutationBatch()
+        for row in zip(chunk['domain'], chunk['ip'], chunk['asn_num'], chunk['path'], chunk['doc_key'], chunk['tld']):
+            build(batch, *row)
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500000, help='number of synthetic rows')
+    parser.add_argument('--batch-size', type=int, default=100, help='rows per mutation batch')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for output_format in ['csv', 'parquet']:
+            filename = synthetic_dataset(os.path.join(tmp, 'cdx-00000'), args.rows, output_format)
+            for name, func in [('row by row', legacy), ('chunked', chunked)]:
+                start = time.perf_counter()
+                count = func(filename, args.batch_size)
+                elapsed = time.perf_counter() - start
+                print('{:<8} {:<12} {:>10} rows {:>8.2f}s {:>12.0f} rows/s'.format(
+                    output_format, name, count, elapsed, count / elapsed,
+                ))
+
+
+if __name__ == '__main__':
+    main()
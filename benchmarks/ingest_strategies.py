@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Compare the cache and upsert strategies of graph-ingest.py for finding
+existing Domain and Document nodes, on a running cluster.
+
+Every strategy combination starts from an empty graph and empty caches,
+then ingests the first --rows rows of a preprocessed file twice: once
+into the empty graph, and once more over the same data, where every node
+already exists. This DROPS ALL DGRAPH AND REDIS DATA, so it refuses to
+run without --reset.
+
+    python3 -m benchmarks.ingest_strategies --file common-crawl/cdx-00026.csv.gz --rows 100000 --reset
+"""
+
+import argparse
+import importlib.util
+import itertools
+import os
+import shutil
+import tempfile
+import time
+
+from redis import Redis
+
+from utils import checkpoints
+from utils.dgraph import drop_all, get_client, set_schema
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_graph_ingest():
+    """
+    graph-ingest.py isn't importable by name, so load it from its path.
+
+    :return:
+    """
+    spec = importlib.util.spec_from_file_location('graph_ingest', os.path.join(root, 'graph-ingest.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def clear_checkpoints():
+    """
+    Forget every checkpoint and progress marker, so the next pass reads the
+    file from the start.
+
+    :return:
+    """
+    if os.path.exists('checkpoint.pickle'):
+        os.remove('checkpoint.pickle')
+    shutil.rmtree(checkpoints.progress_dir, ignore_errors=True)
+    checkpoints.init_checkpoints()
+
+
+def reset(graph_ingest):
+    """
+    Empty DGraph, redis and the bloom filters, then load the countries and
+    ASNs again.
+
+    :param graph_ingest:
+    :return:
+    """
+    client, stub = get_client()
+    drop_all(client)
+    set_schema(client)
+    stub.close()
+
+    for port in [6379, 6378]:
+        r = Redis(port=port)
+        r.flushall()
+        r.close()
+
+    # Fresh checkpoints, so nothing gets skipped
+    clear_checkpoints()
+    graph_ingest.ingest_country_asn()
+
+
+def timed_insert(graph_ingest, filename: str, rows: int, batch_size: int, strategies: dict) -> float:
+    """
+    Run one insert pass, returning rows/s.
+
+    :param graph_ingest:
+    :param filename:
+    :param rows:
+    :param batch_size:
+    :param strategies:
+    :return:
+    """
+    start = time.perf_counter()
+    count = graph_ingest.insert(0, filename, batch_size=batch_size, iterations=rows, strategies=strategies)
+    elapsed = time.perf_counter() - start
+
+    # Let the next pass read the same file again
+    clear_checkpoints()
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file', required=True, help='preprocessed csv or parquet dataset')
+    parser.add_argument('--rows', type=int, default=100000, help='rows to ingest per pass')
+    parser.add_argument('--batch-size', type=int, default=100, help='rows per transaction')
+    parser.add_argument('--reset', action='store_true', help='allow dropping all DGraph and redis data')
+    args = parser.parse_args()
+
+    if not args.reset:
+        parser.error('this benchmark drops all DGraph and redis data, pass --reset to run it')
+
+    filename = os.path.abspath(args.file)
+    graph_ingest = load_graph_ingest()
+
+    # Checkpoints and the asn table are relative to the working directory,
+    # so run in a scratch directory to keep the real checkpoints untouched.
+    with tempfile.TemporaryDirectory() as tmp:
+        os.symlink(os.path.join(root, 'ip2asn-v4.tsv.gz'), os.path.join(tmp, 'ip2asn-v4.tsv.gz'))
+        os.chdir(tmp)
+
+        print('{:<8} {:<8} {:>14} {:>14}'.format('domain', 'document', 'new rows/s', 'existing rows/s'))
+        for domain, document in itertools.product(['cache', 'upsert'], repeat=2):
+            strategies = {'domain': domain, 'doc_key': document}
+            reset(graph_ingest)
+            new = timed_insert(graph_ingest, filename, args.rows, args.batch_size, strategies)
+            existing = timed_insert(graph_ingest, filename, args.rows, args.batch_size, strategies)
+            print('{:<8} {:<8} {:>14.0f} {:>14.0f}'.format(domain, document, new, existing))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,50 @@
 #!/usr/bin/env python3
 
 
-import csv
-import gzip
+import argparse
+import functools
+import glob
 import hashlib
 import multiprocessing as mp
 import os
 import time
 import traceback
 
-import grpc
 import tqdm
-import pydgraph
-from easydict import EasyDict as edict
 
+from utils import metrics
 from utils.asn import get_asn_table
+from utils.batching import BatchSizeController
 from utils.cache import LayeredCache, FullLayeredCache
-from utils.checkpoints import set_checkpoint_lock, init_checkpoints, set_checkpoint, get_checkpoint
-from utils.dgraph import get_client, initialize_dgraph
+from utils.checkpoints import (
+    set_checkpoint_lock, init_checkpoints, set_checkpoint, get_checkpoint, load_progress, save_progress,
+)
+from utils.codec import read_ahead
+from utils.dgraph import Connection, initialize_dgraph, schema
+from utils.eviction import policies
+from utils.mutations import MutationBatch
+from utils.partition import partition_file, shard_files
+from utils.pipeline import CommitPipeline
+from utils.rdf import RdfWriter, asn_node, country_node, document_node, domain_node, root_node
+from utils.retry import Committer
+from utils.storage import dataset_name, list_datasets, read_frames, read_rows
+from utils.uidindex import UidIndex
+from utils.uidtable import UidTable
+
+# Preprocessed columns the ingest actually uses. Parquet datasets only read
+# these from disk.
+ingest_columns = ['domain', 'ip', 'asn_num', 'path']
+
+# How insert finds existing Domain and Document nodes, per node kind.
+#   cache: look the uid up in the layered cache, create the node if missing
+#   upsert: let DGraph look the node up by its indexed key in an upsert block
+default_strategies = {'domain': 'cache', 'doc_key': 'cache'}
+
+# Minimum number of committed rows between progress markers for a file
+progress_rows = 10000
+
+# Directory holding the published country and asn uid tables
+uid_tables = 'uid-tables'
 
 
 def ingest_country_asn():
@@ -33,219 +60,643 @@ def ingest_country_asn():
     :return:
     """
 
-    # Create DGraph client
-    client, stub = get_client()
+    # Create DGraph client. ASN batches start at 500, which has been the
+    # sweet spot so far; too low or too high and it gets painfully slow.
+    # From there the batch size follows how the cluster copes.
+    connection = Connection()
+    controller = BatchSizeController(initial=500, minimum=50, maximum=5000, increase=50, window=5, name="asn batch size")
+    committer = Committer(connection, predicates={"country": "country_code", "asnnum": "asnnum"}, controller=controller)
 
     # Get pandas.DataFrame of ASN data
     asn_table = get_asn_table()
 
     # Create layered caches for both countries and ASNs
-    country_uids = LayeredCache('country', 300)
-    asn_uids = LayeredCache('asnnum', 10000)
-
-    txn = client.txn()
+    country_uids = LayeredCache('country', 1 << 16)
+    asn_uids = LayeredCache('asnnum', 1 << 20)
 
     if not get_checkpoint('countries'):
-        root = {
-            "uid": "_:root",
-            "dgraph.type": "Root",
-        }
-        response = txn.mutate(set_obj=root)
-        root_uid = response.uids['root']
+        # The root and every country go in a single mutation
+        batch = MutationBatch()
+        root = batch.node("root", "root", {"dgraph.type": "Root"})
 
         for country_code in tqdm.tqdm(asn_table['country'].dropna().unique(), desc='Ingesting countries'):
             # Create Country Node
-            country = {
-                "uid": "_:" + country_code,
+            country = batch.node("country", country_code, {
                 "dgraph.type": "Country",
                 "country_code": country_code,
-            }
-            response = txn.mutate(set_obj=country)
-            country_uids[country_code] = response.uids[country_code]
+            })
 
             # Draw edge from root to country
-            edge = {
-                "uid": root_uid,
-                "countries": [
-                    {"uid": country_uids[country_code]}
-                ]
-            }
-            response = txn.mutate(set_obj=edge)
-
-        txn.commit()
-        del txn
-        set_checkpoint('countries')
+            batch.edge(root, "countries", country)
 
-    txn = client.txn()
+        commit_batch(committer, batch, {"country": country_uids})
+        set_checkpoint('countries')
 
     if not get_checkpoint('asns'):
-        for index, asnrow in tqdm.tqdm(enumerate(asn_table.itertuples()), desc='Ingesting ASNs', total=len(asn_table)):
+        batch = MutationBatch()
+        for asnrow in tqdm.tqdm(asn_table.itertuples(), desc='Ingesting ASNs', total=len(asn_table)):
             # Create ASN Node
-            asn = {
-                "uid": "_:" + str(asnrow.Index),
+            asn = batch.node("asnnum", str(asnrow.Index), {
                 "dgraph.type": "ASN",
                 "asnnum": asnrow.Index,
                 "org": asnrow.organization,
-            }
-            response = txn.mutate(set_obj=asn)
-            asn_uids[asnrow.Index] = response.uids[str(asnrow.Index)]
+            })
 
             # Draw edge from country to asn
-            edge = {
-                "uid": country_uids[asnrow.country],
-                "asns": [
-                    {"uid": asn_uids[str(asnrow.Index)]}
-                ],
-            }
-            response = txn.mutate(set_obj=edge)
-
-            # Batch ASN node commits. 500 seems to be the sweet
-            # spot. If we go too low or too high, it gets painfully
-            # slow.
-            if index % 200 == 0:
-                txn.commit()
-                del txn
-                txn = client.txn()
-
-        txn.commit()
+            country_uid = country_uids[asnrow.country]
+            if country_uid is not None:
+                batch.edge(country_uid, "asns", asn)
+
+            # Batch ASN node commits
+            if len(batch.created) >= controller.size:
+                commit_batch(committer, batch, {"asnnum": asn_uids})
+                batch = MutationBatch()
+
+        commit_batch(committer, batch, {"asnnum": asn_uids})
         set_checkpoint('asns')
 
+    # Publish read only uid tables for the workers to memory map, now that
+    # the set of countries and ASNs is final
+    if not get_checkpoint('uid-tables'):
+        UidTable.query(connection.client, "Country", "country_code").save(os.path.join(uid_tables, "country"))
+        UidTable.query(connection.client, "ASN", "asnnum").save(os.path.join(uid_tables, "asnnum"))
+        set_checkpoint('uid-tables')
 
-    stub.close()
+    connection.close()
     country_uids.close()
     asn_uids.close()
 
 
-def insert(job_index, filename, batch_size=100, iterations=1000000):
-    if get_checkpoint(filename):
+def commit_batch(committer: Committer, batch: MutationBatch, caches: dict):
+    """
+    Mutate and commit a batch in a single round trip, then store the uids of
+    the nodes it created in their caches.
+
+    :param committer:
+    :param batch:
+    :param caches: node kind -> cache for the nodes created by the batch
+    :return:
+    """
+    uids = committer.commit(batch)
+    for kind, cache in caches.items():
+        cache.set_many(uids.get(kind, {}))
+        cache.flush()
+
+
+def progress_name(filename: str) -> str:
+    """
+    Name of the progress marker for ingesting a file, kept apart from the
+    preprocessing ones.
+
+    :param filename:
+    :return:
+    """
+    return f"ingest/{filename}"
+
+
+def prepare(df) -> dict:
+    """
+    Turn a frame of rows into the column lists the ingest loop works on.
+    Document keys and TLDs are worked out for the whole frame at once
+    instead of row by row.
+
+    :param df: frame with the ingest_columns
+    :return: column name -> list of values, for ingest_columns plus doc_key and tld
+    """
+    paths = df["path"].tolist()
+    return {
+        "domain": df["domain"].tolist(),
+        "ip": df["ip"].tolist(),
+        "asn_num": df["asn_num"].tolist(),
+        "path": paths,
+        "doc_key": [hashlib.md5(path.encode()).hexdigest() for path in paths],
+        "tld": df["domain"].str.rpartition(".")[2].tolist(),
+    }
+
+
+def read_chunks(filenames, batch_size, starts=None, frame_size=1 << 16):
+    """
+    Read and parse rows from several files in batches of columns, one file
+    after another. Batches never span two files, and after the last batch
+    of each file comes (filename, rows, None) to mark the end of it.
+
+    Rows are read frame_size at a time, so a batch that would straddle two
+    frames is cut short at the end of the first.
+
+    :param filenames:
+    :param batch_size: rows per batch, or a function giving the size of each batch
+    :param starts: filename -> number of rows to skip in that file
+    :param frame_size: rows to read and prepare at a time
+    :return: (filename, rows read from the file so far, column name -> values)
+    """
+    size = batch_size if callable(batch_size) else lambda: batch_size
+    starts = starts or dict()
+    for filename in filenames:
+        rows = starts.get(filename, 0)
+        for df in read_frames(filename, columns=ingest_columns, chunk_size=frame_size, start=rows):
+            frame = prepare(df)
+            offset = 0
+            while offset < len(df):
+                end = offset + size()
+                chunk = {column: values[offset:end] for column, values in frame.items()}
+                rows += len(chunk["domain"])
+                offset = end
+                yield filename, rows, chunk
+        yield filename, rows, None
+
+
+def insert(
+        job_index,
+        filenames,
+        batch_size=100,
+        iterations=None,
+        strategies=None,
+        in_flight=4,
+        partitioned=False,
+        min_batch_size=10,
+        max_batch_size=2000,
+        cache_memory=64 << 20,
+        cache_policy="clock",
+        trace=None,
+        uid_index=None,
+        metrics_directory="metrics",
+        trust_bloom=False,
+        bloom_capacity=10000000,
+        bloom_error_rate=1.0e-6,
+):
+    """
+    Stream preprocessed files into DGraph. Each file is checkpointed once
+    all of its rows are committed.
+
+    Along the way, the number of rows of a file that are committed is saved
+    as a progress marker every progress_rows rows. A restarted run skips
+    straight past those rows. Batches commit concurrently, but markers are
+    only saved once every batch before them has committed too, so a marker
+    never gets ahead of DGraph. Rows committed after the last marker are
+    replayed on restart; the caches' DGraph layer finds the nodes they
+    created, so the replay doesn't create them again. The bloom filters are
+    synced before each marker is saved. If they are trusted to rule nodes
+    out at all (trust_bloom), they are not while rows after the marker are
+    replayed.
+
+    The work is pipelined: a reader thread reads and parses the next
+    batches of rows, this thread resolves uids through the caches and
+    builds mutation batches, and up to in_flight batches commit at once on
+    a thread pool. Concurrency comes from threads instead of more processes,
+    so there is still only one copy of each cache per worker.
+
+    In partitioned mode this worker is the only one that sees its domains,
+    so every domain node it needs was created by this worker. Its domain
+    cache skips the bloom filter and DGraph layers, and keeps redis entries
+    without a timeout so nothing it created can fall out of the cache.
+
+    :param job_index:
+    :param filenames: preprocessed csv or parquet input, or a list of them
+    :param batch_size: rows per transaction to start with, adjusted as
+                       commits go by between min_batch_size and max_batch_size
+    :param iterations: stop after about this many rows, None to ingest everything
+    :param strategies: node kind -> cache or upsert, see default_strategies
+    :param in_flight: number of transactions committing at once
+    :param partitioned: whether this worker owns all the domains in filenames
+    :param min_batch_size:
+    :param max_batch_size:
+    :param cache_memory: bytes of in memory uid cache for each node kind
+    :param cache_policy: eviction policy of the in memory caches, see utils.eviction
+    :param trace: directory to record cache access traces to, None to not record
+    :param uid_index: directory of the persistent uid indexes, None to go without
+    :param metrics_directory: directory to publish this worker's metrics to
+    :param trust_bloom: let bloom filter misses rule nodes out, only safe if
+                        every node in DGraph was created by live ingest
+    :param bloom_capacity: keys each bloom filter is sized for
+    :param bloom_error_rate: bloom filter false positive rate at capacity
+    :return: number of rows ingested
+    """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    filenames = [filename for filename in filenames if not get_checkpoint(filename)]
+    if len(filenames) == 0:
         return 0
 
+    strategies = {**default_strategies, **(strategies or {})}
+
     print(f"starting job {job_index}")
-    client, stub = get_client()
-
-    # Create caches
-    domain_uids = FullLayeredCache("domain", 1000000)
-    document_uids = FullLayeredCache("path", 1000000)
-    asn_uids = LayeredCache("asnnum", 10000)
-    country_uids = LayeredCache('country', 300)
-
-    # Create file read streamer
-    file = gzip.open(filename, "rt")
-    reader = csv.DictReader(file)
-    success = False
+    metrics.start_publishing(metrics_directory)
+
+    # Rows of each file committed by an earlier run
+    starts = dict()
+    for filename in filenames:
+        progress = load_progress(progress_name(filename))
+        if progress is not None and progress["rows"] > 0:
+            print(f"Job {job_index} resuming {filename} at row {progress['rows']}")
+            starts[filename] = progress["rows"]
+    saved = dict(starts)
+
+    def record(filename, rows, done=False, stopping=False):
+        # Called once the batch ending at rows (and all before it) committed
+        if done or stopping or rows - saved.get(filename, 0) >= progress_rows:
+            # Share the bloom filters first, if there are any, so every node
+            # created before the marker is in them when a restarted run gets
+            # past it
+            for cache in caches.values():
+                if isinstance(cache, FullLayeredCache):
+                    cache.sync_bloom()
+            save_progress(progress_name(filename), {"rows": rows, "done": done})
+            saved[filename] = rows
+
+    def update_bloom_trust(filename, rows):
+        # Nodes created by rows replayed after a restart may be missing from
+        # the bloom filters, so check DGraph for those even on a bloom miss
+        replayed = filename in starts and rows <= starts[filename] + 2 * progress_rows
+        for cache in caches.values():
+            if isinstance(cache, FullLayeredCache):
+                cache.trust_bloom = trust_bloom and not replayed
+
+    connection = Connection()
+
+    # Create caches. Node kinds that are upserted don't need one.
+    domain_uids = None
+    if strategies["domain"] == "cache":
+        if partitioned:
+            domain_uids = LayeredCache("domain", cache_memory, policy=cache_policy)
+        else:
+            domain_uids = FullLayeredCache(
+                "domain", cache_memory, p=bloom_error_rate, n=bloom_capacity,
+                policy=cache_policy, index=uid_index, trust_bloom=trust_bloom,
+            )
+    document_uids = None
+    if strategies["doc_key"] == "cache":
+        document_uids = FullLayeredCache(
+            "doc_key", cache_memory, p=bloom_error_rate, n=bloom_capacity,
+            policy=cache_policy, index=uid_index, trust_bloom=trust_bloom,
+        )
+
+    # ASN uids come from the table published by ingest_country_asn
+    asn_uids = UidTable.load(os.path.join(uid_tables, "asnnum"))
+
+    # Create file read streamer, reading and parsing batches ahead in a
+    # background thread
+    controller = BatchSizeController(
+        initial=batch_size, minimum=min_batch_size, maximum=max_batch_size, name=f"Job {job_index} batch size",
+    )
+    chunks = read_ahead(read_chunks(filenames, controller, starts), depth=in_flight * 2)
     count = 0
 
-    try:
-        # Create a new transaction.
-        txn = client.txn()
-        for row in reader:
-            row = edict(row)
+    # Where nodes created by a batch get cached once it is committed
+    caches = {"domain": domain_uids, "doc_key": document_uids}
+    caches = {kind: cache for kind, cache in caches.items() if cache is not None}
+    if trace is not None:
+        for cache in caches.values():
+            cache.record_trace(trace)
 
-            try:
+    # Failed batches are replayed, conflicts with other workers are common
+    committer = Committer(connection, predicates={"domain": "domain", "doc_key": "doc_key"}, controller=controller)
+
+    pipeline = CommitPipeline(committer.commit, caches, max_in_flight=in_flight)
+
+    def cached(cache, kind, keys) -> dict:
+        # Look up every distinct key that no batch in flight is creating.
+        # The trace gets every key the rows ask for, duplicates included.
+        if cache is None:
+            return dict()
+        cache.record_access(keys)
+        keys = [key for key in dict.fromkeys(keys) if (kind, key) not in pipeline.pending]
+        return {key: uid for key, uid in zip(keys, cache.get_many(keys)) if uid is not None}
+
+    try:
+        for filename, rows, chunk in metrics.timed(chunks, "stage_seconds", pipeline="ingest", stage="read"):
+            # End of a file, checkpoint it once everything is committed
+            if chunk is None:
+                with metrics.timer("stage_seconds", pipeline="ingest", stage="drain"):
+                    pipeline.drain()
+                record(filename, rows, done=True)
+                set_checkpoint(filename)
+                continue
+
+            batch = MutationBatch()
+            update_bloom_trust(filename, rows)
+
+            # Resolve the whole chunk through the caches up front, in a
+            # fixed number of round trips
+            with metrics.timer("stage_seconds", pipeline="ingest", stage="resolve"):
+                cached_domains = cached(domain_uids, "domain", chunk["domain"])
+                cached_documents = cached(document_uids, "doc_key", chunk["doc_key"])
+                chunk_asn_uids = asn_uids.get_many(chunk["asn_num"])
+
+            build_start = time.perf_counter()
+            for domain_name, ip, asn_uid, path, doc_key, tld in zip(
+                    chunk["domain"], chunk["ip"], chunk_asn_uids,
+                    chunk["path"], chunk["doc_key"], chunk["tld"],
+            ):
                 # Create domain if not exists
-                if row.domain not in domain_uids:
+                domain_uid = batch.get("domain", domain_name)
+                if domain_uid is None and domain_uids is not None:
+                    domain_uid = pipeline.get("domain", domain_name) or cached_domains.get(domain_name, None)
+                if domain_uid is None:
                     domain = {
-                        "uid": "_:" + row.domain,
                         "dgraph.type": "Domain",
-                        "domain": row.domain,
-                        "tld": row.domain.split(".")[-1],
-                        "ip": row.ip,
+                        "domain": domain_name,
+                        "tld": tld,
+                        "ip": ip,
                     }
-                    response = txn.mutate(set_obj=domain)
-                    domain_uids[row.domain] = response.uids[row.domain]
-                    
-                    # Draw edge from asn to domain
-                    edge = {
-                        "uid": asn_uids[row.asn_num],
-                        "domains": [
-                            {"uid": domain_uids[row.domain]},
-                        ],
-                    }
-                    response = txn.mutate(set_obj=edge)
+                    if domain_uids is None:
+                        domain_uid = batch.upsert("domain", domain_name, "domain", domain)
+                    else:
+                        domain_uid = batch.node("domain", domain_name, domain)
 
-                doc_uid = hashlib.md5(row.path.encode()).hexdigest()
-                if doc_uid not in document_uids:
-                    # Create document
+                    # Draw edge from asn to domain
+                    if asn_uid is not None:
+                        batch.edge(asn_uid, "domains", domain_uid)
+
+                # Create document if not exists
+                document_uid = batch.get("doc_key", doc_key)
+                if document_uid is None and document_uids is not None:
+                    document_uid = pipeline.get("doc_key", doc_key) or cached_documents.get(doc_key, None)
+                if document_uid is None:
                     document = {
-                        "uid": "_:" + doc_uid,
                         "dgraph.type": "Document",
-                        "path": row.path,
+                        "path": path,
+                        "doc_key": doc_key,
                     }
-                    response = txn.mutate(set_obj=document)
-                    document_uids[doc_uid] = response.uids[doc_uid]
+                    if document_uids is None:
+                        document_uid = batch.upsert("doc_key", doc_key, "doc_key", document)
+                    else:
+                        document_uid = batch.node("doc_key", doc_key, document)
 
                 # Draw edge from domain to document
-                edge = {
-                    "uid": domain_uids[row.domain],
-                    "documents": [
-                        {"uid": document_uids[doc_uid]}
-                    ],
-                }
-                response = txn.mutate(set_obj=edge)
-
-                if count % batch_size == 0:
-                    txn.commit()
-
-                    # If max iterations exceeded, return
-                    if iterations is not None and count > iterations:
-                        success = True
-                        return
-
-                    # Help garbage collection
-                    del txn
-                    txn = client.txn()
+                batch.edge(domain_uid, "documents", document_uid)
 
                 count += 1
 
-                if count % 100000 == 0 and count != 0:
-                    print(f'Job {job_index} Reached [{count}/{iterations}]')
+                if count % 100000 == 0:
+                    print(f'Job {job_index} Reached [{count}/{iterations or "all"}]')
+
+            metrics.observe("stage_seconds", time.perf_counter() - build_start, pipeline="ingest", stage="build")
+            metrics.count("ingest_rows_total", len(chunk["domain"]))
 
-                    
-            except (pydgraph.errors.AbortedError, grpc._channel._InactiveRpcError) as e:
-                print(f'DGraph client crashed for Job {job_index}, resetting...')
-                time.sleep(1)
-                stub.close()
-                client, stub = get_client()
-                txm = client.txn()
+            # Start committing, while the next batch gets built
+            with metrics.timer("stage_seconds", pipeline="ingest", stage="submit"):
+                pipeline.submit(batch, functools.partial(record, filename, rows))
 
-        success = True
-        txn.commit()
+            # If max iterations exceeded, stop. The file isn't done, so save
+            # how far it got for the next run to carry on from.
+            if iterations is not None and count > iterations:
+                pipeline.drain()
+                record(filename, rows, stopping=True)
+                break
 
     except Exception as e:
         print(e)
         print(traceback.format_exc())
 
     finally:
-        stub.close()
-        domain_uids.close()
+        pipeline.close()
+        print(f'Job {job_index} transactions: {committer.summary()}')
+        chunks.close()
+        connection.close()
+        for cache in caches.values():
+            cache.close()
         asn_uids.close()
-        file.close()
-        if success:
-            set_checkpoint(filename)
+        metrics.publish(metrics_directory)
         return count
 
 
+def status(filenames):
+    """
+    Print how far ingest has got with every file, from the progress markers
+    and checkpoints.
+
+    :param filenames:
+    :return:
+    """
+    done = 0
+    total_rows = 0
+    for filename in filenames:
+        progress = load_progress(progress_name(filename)) or {"rows": 0, "done": False}
+        finished = progress["done"] or get_checkpoint(filename)
+        state = "done" if finished else "partial" if progress["rows"] > 0 else "pending"
+        print("{:<60} {:>12} rows  {}".format(filename, progress["rows"], state))
+
+        done += finished
+        total_rows += progress["rows"]
+
+    print("{}/{} files done, {} rows committed".format(done, len(filenames), total_rows))
+
+
+def export_country_asn(directory: str) -> set:
+    """
+    Write the root, country and ASN nodes as N-Quads for the bulk loader.
+
+    :param directory: rdf output directory
+    :return: the asn numbers that have nodes, as strings
+    """
+    asn_table = get_asn_table()
+    writer = RdfWriter(os.path.join(directory, "asn.rdf.gz"))
+
+    # Create the Root node, then Country nodes with an edge from the root
+    writer.node(root_node(), "Root", {})
+    for country_code in asn_table['country'].dropna().unique():
+        writer.node(country_node(country_code), "Country", {"country_code": country_code})
+        writer.edge(root_node(), "countries", country_node(country_code))
+
+    # Create ASN nodes with an edge from their country
+    for asnrow in asn_table.itertuples():
+        writer.node(asn_node(asnrow.Index), "ASN", {
+            "asnnum": int(asnrow.Index),
+            "org": asnrow.organization,
+        })
+        if isinstance(asnrow.country, str):
+            writer.edge(country_node(asnrow.country), "asns", asn_node(asnrow.Index))
+
+    writer.close()
+    return set(map(str, asn_table.index))
+
+
+def export_file(filename: str, directory: str, asns: set) -> int:
+    """
+    Stream one preprocessed file into an N-Quad shard for the bulk loader.
+    Nothing here talks to DGraph or redis.
+
+    :param filename: preprocessed csv or parquet input
+    :param directory: rdf output directory
+    :param asns: asn numbers that have nodes
+    :return: number of rows exported
+    """
+    output = os.path.join(directory, dataset_name(filename) + ".rdf.gz")
+    if os.path.exists(output):
+        return 0
+
+    writer = RdfWriter(output)
+    count = 0
+    for row in read_rows(filename, columns=ingest_columns):
+        # Create domain, with an edge from its asn the first time this shard sees it
+        domain = domain_node(row["domain"])
+        if writer.node(domain, "Domain", {
+            "domain": row["domain"],
+            "tld": row["domain"].split(".")[-1],
+            "ip": row["ip"],
+        }):
+            if row["asn_num"] in asns:
+                writer.edge(asn_node(row["asn_num"]), "domains", domain)
+
+        # Create document, with an edge from the domain
+        doc_key = hashlib.md5(row["path"].encode()).hexdigest()
+        document = document_node(doc_key)
+        writer.node(document, "Document", {"path": row["path"], "doc_key": doc_key})
+        writer.edge(domain, "documents", document)
+
+        count += 1
+
+    writer.close()
+    print(f"exported {filename} ({count} rows)")
+    return count
+
+
+def export(directory: str, processes: int):
+    """
+    Offline export of everything as sharded, gzip compressed N-Quads plus a
+    schema file, ready for the DGraph bulk loader:
+
+        dgraph bulk -f rdf/ -s rdf/schema.txt
+
+    :param directory: rdf output directory
+    :param processes: number of worker processes
+    :return:
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "schema.txt"), "w") as f:
+        f.write(schema)
+
+    start_time = time.time()
+    asns = export_country_asn(directory)
+
+    # One shard per preprocessed file
+    file_paths = list_datasets("./common-crawl/")
+    with mp.Pool(processes=processes) as pool:
+        counts = pool.starmap(export_file, [(path, directory, asns) for path in file_paths])
+        pool.close()
+    elapsed = time.time() - start_time
+
+    print("Exported in {:.2f}s with {:.2f}rows/s {} processes".format(elapsed, sum(counts) / elapsed, processes))
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Ingest preprocessed common crawl data into DGraph")
+    parser.add_argument(
+        "--mode", choices=["live", "export", "status", "index"], default="live",
+        help="live: mutate a running cluster, export: write N-Quads for the bulk loader, "
+             "status: show how far live mode has got with each file, "
+             "index: rebuild the uid indexes from a DGraph export",
+    )
+    parser.add_argument("--output", default="rdf", help="output directory for export mode")
+    parser.add_argument("--processes", type=int, default=16, help="number of worker processes")
+    parser.add_argument("--batch-size", type=int, default=100, help="rows per transaction to start with")
+    parser.add_argument("--min-batch-size", type=int, default=10, help="smallest rows per transaction")
+    parser.add_argument("--max-batch-size", type=int, default=2000, help="largest rows per transaction")
+    parser.add_argument(
+        "--iterations", type=int, default=None,
+        help="stop each job after about this many rows, eg. for benchmarks; files it didn't finish resume next run",
+    )
+    parser.add_argument("--in-flight", type=int, default=4, help="transactions committing at once per process")
+    parser.add_argument("--cache-memory", type=int, default=64, help="MB of in memory uid cache per node kind per process")
+    parser.add_argument(
+        "--cache-policy", choices=list(policies), default="clock", help="eviction policy of the in memory uid caches",
+    )
+    parser.add_argument("--trace", default=None, help="directory to record cache access traces to")
+    parser.add_argument(
+        "--uid-index", default=None,
+        help="directory of the persistent uid indexes, live mode goes without them unless given",
+    )
+    parser.add_argument("--dgraph-export", default="export", help="DGraph export directory for index mode")
+    parser.add_argument("--metrics", default="metrics", help="directory to export live mode metrics to")
+    parser.add_argument(
+        "--trust-bloom", action="store_true",
+        help="skip DGraph for nodes the bloom filters have never seen, "
+             "only safe if every node in DGraph was created by live ingest",
+    )
+    parser.add_argument(
+        "--bloom-capacity", type=int, default=10000000,
+        help="keys each trusted bloom filter is sized for, about 29 bits a key at the default error rate, "
+             "per node kind and process",
+    )
+    parser.add_argument(
+        "--bloom-error-rate", type=float, default=1.0e-6, help="bloom filter false positive rate at capacity",
+    )
+    parser.add_argument(
+        "--domain-strategy", choices=["cache", "upsert"], default=default_strategies["domain"],
+        help="how live mode finds existing domain nodes",
+    )
+    parser.add_argument(
+        "--document-strategy", choices=["cache", "upsert"], default=default_strategies["doc_key"],
+        help="how live mode finds existing document nodes",
+    )
+    parser.add_argument(
+        "--partitions", type=int, default=0,
+        help="route rows to this many workers by domain hash, 0 to give each worker whole files",
+    )
+    args = parser.parse_args()
+
+    if args.mode == "export":
+        export(args.output, args.processes)
+        return
+
+    if args.mode == "status":
+        init_checkpoints()
+        if args.partitions > 0:
+            file_paths = [
+                path
+                for partition in range(args.partitions)
+                for path in shard_files("./partitions/", args.partitions, partition)
+            ]
+        else:
+            file_paths = list_datasets("./common-crawl/")
+        status(file_paths)
+        return
+
+    if args.mode == "index":
+        if args.uid_index is None:
+            parser.error("index mode needs --uid-index")
+        filenames = sorted(glob.glob(os.path.join(args.dgraph_export, "**", "*.rdf.gz"), recursive=True))
+        counts = UidIndex.rebuild(args.uid_index, filenames, {"domain": "domain", "doc_key": "doc_key"})
+        for kind, count in counts.items():
+            print(f"Indexed {count} {kind} uids from {len(filenames)} files")
+        return
+
     # Initialize checkpoint file
     init_checkpoints()
 
     # Initialize dgraph schema
     initialize_dgraph()
 
+    # Add up and export the metrics of every process every few seconds
+    exporter = metrics.Exporter(args.metrics)
+    exporter.start()
+
     # Ingest country and ASN data
     ingest_country_asn()
 
     # Number of processes to use in the worker pool
-    processes = 16
+    processes = args.processes
 
     # Initialize lock for checkpoint file
     checkpoint_lock = mp.Lock()
 
     # Get data file paths
-    file_paths = map(
-        lambda path: "./common-crawl/" + path,
-        filter(lambda x: x.endswith(".csv.gz"), os.listdir("./common-crawl/")),
-    )
+    file_paths = list_datasets("./common-crawl/")
+
+    if args.partitions > 0:
+        # Split every file into per-worker shards by domain, so that each
+        # domain is only ever ingested by one worker
+        with mp.Pool(processes=processes) as pool:
+            pool.starmap(partition_file, [
+                (path, "./partitions/", args.partitions, ingest_columns) for path in file_paths
+            ])
+            pool.close()
+
+        # One worker per partition, each working through its own shards
+        processes = args.partitions
+        jobs = [shard_files("./partitions/", args.partitions, partition) for partition in range(args.partitions)]
+    else:
+        jobs = file_paths
 
     # Create worker pool
     start_time = time.time()
@@ -253,13 +704,33 @@ def main():
         print(f"Starting {processes} worker processes")
 
         # Run insert function on all files we can see
-        counts = pool.starmap(insert, enumerate(file_paths))
+        strategies = {"domain": args.domain_strategy, "doc_key": args.document_strategy}
+        job = functools.partial(
+            insert,
+            batch_size=args.batch_size,
+            iterations=args.iterations,
+            min_batch_size=args.min_batch_size,
+            max_batch_size=args.max_batch_size,
+            strategies=strategies,
+            in_flight=args.in_flight,
+            partitioned=args.partitions > 0,
+            cache_memory=args.cache_memory << 20,
+            cache_policy=args.cache_policy,
+            trace=args.trace,
+            uid_index=args.uid_index,
+            metrics_directory=args.metrics,
+            trust_bloom=args.trust_bloom,
+            bloom_capacity=args.bloom_capacity,
+            bloom_error_rate=args.bloom_error_rate,
+        )
+        counts = pool.starmap(job, enumerate(jobs))
 
         # Close pool
         pool.close()
     elapsed = time.time() - start_time
 
     print("Finished in {:.2f}s with {:.2f}rows/s {} processes".format(elapsed, sum(counts) / elapsed, processes))
+    print(exporter.stop())
 
 
 if __name__ == '__main__':
@@ -1,121 +1,234 @@
 import os
-import csv
-import gzip
-import json
 import time
-import pyasn
 import parse
-import socket
-import typing
-import numpy as np
-import pandas as pd
-import multiprocessing as mp
-import matplotlib.pyplot as plt
-from ipaddress import ip_address, ip_network, summarize_address_range
-
-asndb = pyasn.pyasn('asn-db.dat')
-
-asntbl = pd.read_csv('ip2asn-v4.tsv.gz', compression='gzip', sep='\t', header=None)
-asntbl.columns = ['start', 'end', 'asn number', 'country', 'organization']
-asntbl.drop(['start', 'end'], inplace=True, axis=1)
-asntbl.drop_duplicates(subset=['asn number'], inplace=True)
-asntbl = asntbl[asntbl['asn number'] != 0]
-asntbl.set_index('asn number', inplace=True)
+import collections
+
+from utils import metrics
+from utils.asn import AsnResolver
+from utils.cdx import parse_lines
+from utils.checkpoints import load_progress, save_progress
+from utils.codec import read_ahead
+from utils.dns import DnsStore, Resolver
+from utils.scheduler import Job, plan_jobs, read_job, run_jobs
+from utils.storage import open_writer
+
+# Prebuilt ip2asn arrays that every worker memory maps
+asn_snapshot = 'ip2asn-v4.snapshot'
 
 columns = ['domain', 'ip', 'asn_num', 'country', 'asn_org', 'tld', 'path', 'status', 'timestamp', 'mime', 'mime_detected', 'length', 'url', 'redirect']
-dnscache = dict()
-
-def resolv(domain: str) -> str:
-    if dnscache.get(domain, None) is None:
-        try:
-            ip_address(domain)
-            ip = domain
-            dnscache[domain] = ip
-        except ValueError:
-            try:
-                ip = socket.gethostbyname(domain)
-                dnscache[domain] = ip
-            except socket.gaierror:
-                ip = None
-    else:
-        ip = dnscache[domain]
-
-    return ip
-
-def getasn(ip: str) -> typing.Tuple[int, str, str]:
-    asnnum = -1
-    try:
-        asnnum, _ = asndb.lookup(ip)
-        asnrow = asntbl.loc[asnnum]
-        country = asnrow['country']
-        org = asnrow['organization']
-    except:
-        country, org = None, None
-    return asnnum, country, org
-
-def parse_n_save(filenames: typing.List[str], split: int):
+
+# Number of dns lookups each worker keeps in flight at once, how long to wait
+# on a single lookup, and how many parsed rows may queue up behind pending
+# lookups before the worker blocks on the oldest one.
+dns_in_flight = 256
+dns_timeout = 5.0
+dns_pending = 50000
+
+# On-disk dns cache shared by all workers and kept between runs
+dns_store = 'dnscache.sqlite'
+
+# Output either gzip csv or typed parquet datasets. Parquet output can be
+# partitioned by a column such as country or tld.
+output_format = 'csv'
+partition_on = None
+
+# Csv compression (gzip, or zstd for intermediate files), level, and the
+# number of compression threads per worker.
+compression = 'gzip'
+compression_level = 6
+compression_threads = 2
+
+# Per process state, set up once in each worker by init_worker
+store: DnsStore = None
+resolver: Resolver = None
+asn_resolver: AsnResolver = None
+
+# Worker pool size (None for one per core), and roughly how many compressed
+# bytes of input each job should get when an input file can be split.
+processes = None
+chunk_size = 1 << 27
+
+# Minimum number of rows written between in-file progress markers
+checkpoint_rows = 500000
+
+# Where every process publishes its metrics, added up by the main process
+metrics_directory = 'metrics'
+
+
+def init_worker():
+    """
+    Open the dns and asn resolvers in a worker process. These are shared by
+    every job the worker runs.
+
+    :return:
+    """
+    global store, resolver, asn_resolver
+
+    store = DnsStore(dns_store)
+    resolver = Resolver(max_in_flight=dns_in_flight, timeout=dns_timeout, store=store)
+
+    # Asn columns are filled in for the whole buffer at once when it is written
+    asn_resolver = AsnResolver.load(asn_snapshot)
+
+    metrics.start_publishing(metrics_directory)
+
+
+def output_name(job: Job) -> str:
+    """
+    Output path (without extension) for a job. Jobs that only cover part of
+    an input file get the part number added.
+
+    :param job:
+    :return:
+    """
+    cdx_num = parse.parse('cdx-{num}.gz', os.path.basename(job.filename)).named['num']
+    if job.part is None:
+        return 'common-crawl/cdx-{}'.format(cdx_num)
+    return 'common-crawl/cdx-{}.{:03d}'.format(cdx_num, job.part)
+
+
+def parse_n_save(job: Job):
     buffer = []
     buffer_size = 20000
 
-    for filename in filenames:
-        if not filename.endswith('.gz'):
-            continue
-
-        cdx_num = parse.parse('cdx-{num}.gz', filename).named['num']
-        csv_name = 'common-crawl/cdx-{}.csv.gz'.format(cdx_num)
-        csv_file = gzip.open(csv_name, 'wt')
-
-        writer = csv.writer(csv_file)
-        writer.writerow(columns)
-
-        _start = time.time()
-        with gzip.open('./common-crawl-raw/' + filename, 'rb') as f:
-            for line in f:
-                parsed = parse.parse("{domain}){path} {timestamp} {meta}", line.decode())
-                meta = json.loads(parsed['meta'])
-                domain = '.'.join(parsed.named.get('domain', None).split(',')[::-1])
-                ip = resolv(domain)
-                asnnum, country, org = getasn(ip)
-
-                buffer.append([
-                    domain,
-                    ip,
-                    asnnum,
-                    country,
-                    org,
-                    parsed.named.get('domain', None).split(',')[-1],
-                    parsed.named.get('path', None),
-                    meta.get('status', None),
-                    parsed.named.get('timestamp', None),
-                    meta.get('mime', None),
-                    meta.get('mime-detected'),
-                    meta.get('length', None),
-                    meta.get('url', None),
-                    meta.get('redirect', None),
-                ])
-
-                if len(buffer) == buffer_size:
-                    for row in buffer:
-                        writer.writerow(row)
-
-                    global dnscache
-                    del buffer
-                    del dnscache
-                    dnscache = dict()
-                    buffer = list()
-
-        print('closing {} {:.2f} hrs'.format(csv_name, (time.time() - _start) / 3600.))
-        csv_file.close()
-
-
-filenames = list(filter(lambda filename: filename.endswith('.gz'), os.listdir('common-crawl-raw')))
-
-splits = []
-splitsize = 2
-for i in range(0, len(filenames), splitsize):
-    splits.append(filenames[i:i+splitsize])
-
-args = list(map(lambda x: (x[1], x[0]), enumerate(splits)))
-with mp.Pool(len(splits)) as pool:
-    pool.starmap(parse_n_save, args)
-    pool.close()
+    # Approximate number of compressed bytes to read and parse at a time
+    read_size = 1 << 20
+
+    # Rows wait here in order until the dns lookup for their domain is done
+    pending = collections.deque()
+
+    # Pick up where a previous run left off. Progress recorded for a job
+    # that was planned with different boundaries can't be trusted.
+    name = output_name(job)
+    progress = load_progress(name)
+    if progress is not None and (progress['start'], progress['end']) != (job.start, job.end):
+        progress = None
+    if progress is not None and progress['done']:
+        print('skipping {} (already done)'.format(name))
+        return
+    if progress is not None:
+        print('resuming {} at row {}'.format(name, progress['rows']))
+
+    rows = progress['rows'] if progress is not None else 0
+    rows_since_checkpoint = 0
+
+    def finish(domain, future, record):
+        ip = resolver.result(domain, future)
+
+        # ip and asn columns go in between the domain and the rest of the record
+        return [domain, ip, None, None, None, *record[1:]]
+
+    def flush():
+        nonlocal rows
+
+        with metrics.timer('stage_seconds', pipeline='stream', stage='asn'):
+            for row, asn in zip(buffer, asn_resolver.resolve([row[1] for row in buffer])):
+                row[2:5] = asn
+        with metrics.timer('stage_seconds', pipeline='stream', stage='write'):
+            writer.write(buffer)
+
+        metrics.count('stream_rows_total', len(buffer))
+        rows += len(buffer)
+        del buffer[:]
+
+    def checkpoint(offset: int, done: bool = False):
+        nonlocal rows_since_checkpoint
+
+        # Everything read up to offset has to be written before recording it
+        with metrics.timer('stage_seconds', pipeline='stream', stage='dns'):
+            while pending:
+                buffer.append(finish(*pending.popleft()))
+        if len(buffer) > 0:
+            flush()
+        with metrics.timer('stage_seconds', pipeline='stream', stage='checkpoint'):
+            resolver.flush()
+
+        save_progress(name, {
+            'start': job.start,
+            'end': job.end,
+            'offset': offset,
+            'rows': rows,
+            'output': writer.checkpoint(),
+            'done': done,
+        })
+        rows_since_checkpoint = 0
+
+    writer = open_writer(
+        name, columns, output_format, partition_on,
+        resume=progress['output'] if progress is not None else None,
+        compression=compression, level=compression_level, threads=compression_threads,
+    )
+
+    # Resolver and store counters when the job started
+    _start = time.time()
+    dns_counts = (resolver.hits, resolver.misses, resolver.failures, resolver.timeouts, store.hits, store.misses)
+    # Decompress the input in a read-ahead thread while this one parses
+    reader = read_ahead(read_job(job, start=progress['offset'] if progress is not None else None, read_size=read_size))
+    for lines, offset in metrics.timed(reader, 'stage_seconds', pipeline='stream', stage='read'):
+        with metrics.timer('stage_seconds', pipeline='stream', stage='parse'):
+            records = parse_lines(lines)
+        rows_since_checkpoint += len(records)
+
+        with metrics.timer('stage_seconds', pipeline='stream', stage='dns'):
+            for record in records:
+                domain = record[0]
+                pending.append((domain, resolver.submit(domain), record))
+
+                # Move rows whose lookups have finished into the buffer. Only
+                # block on a lookup once too many rows are waiting behind it.
+                while pending and (pending[0][1].done() or len(pending) >= dns_pending):
+                    buffer.append(finish(*pending.popleft()))
+
+        if len(buffer) >= buffer_size:
+            flush()
+
+        # Record progress whenever we are at a point reading can resume from
+        if offset is not None and rows_since_checkpoint >= checkpoint_rows:
+            checkpoint(offset)
+
+    checkpoint(job.end, done=True)
+
+    # The resolver and store count over every job of this worker, report
+    # just this job's share
+    job_counts = [
+        after - before for before, after in zip(
+            dns_counts,
+            (resolver.hits, resolver.misses, resolver.failures, resolver.timeouts, store.hits, store.misses),
+        )
+    ]
+    print('closing {} {:.2f} hrs dns hits={} misses={} failures={} timeouts={} store hits={} misses={}'.format(
+        writer.filename, (time.time() - _start) / 3600., *job_counts,
+    ))
+    writer.close()
+
+    for (layer, result), value in zip(
+            [('resolver', 'hit'), ('resolver', 'miss'), ('resolver', 'failure'), ('resolver', 'timeout'),
+             ('store', 'hit'), ('store', 'miss')],
+            job_counts,
+    ):
+        metrics.count('dns_lookups_total', value, layer=layer, result=result)
+    metrics.publish(metrics_directory)
+
+
+def main():
+    if not os.path.exists(asn_snapshot):
+        AsnResolver.build().save(asn_snapshot)
+
+    filenames = [
+        os.path.join('common-crawl-raw', filename)
+        for filename in sorted(os.listdir('common-crawl-raw'))
+        if filename.endswith('.gz')
+    ]
+
+    # Add up and export the metrics of every worker every few seconds
+    exporter = metrics.Exporter(metrics_directory)
+    exporter.start()
+
+    # Split the input into jobs and hand them out largest first
+    jobs = plan_jobs(filenames, chunk_size)
+    run_jobs(parse_n_save, jobs, processes, initializer=init_worker)
+    print(exporter.stop())
+
+
+if __name__ == '__main__':
+    main()
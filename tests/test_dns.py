@@ -0,0 +1,161 @@
+import gzip
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+import stream
+from utils.asn import AsnResolver, ip_to_int
+from utils.dns import DnsStore, HostsFileBackend, Resolver
+from utils.scheduler import Job
+from utils.storage import read_rows
+
+hosts = """
+# stub zone for the tests
+10.0.0.1 slow.example
+10.0.0.2 fast.example www.fast.example
+"""
+
+
+class StubBackend(object):
+    """
+    HostsFileBackend that counts lookups and can hold some domains back
+    until released.
+    """
+
+    def __init__(self, path: str, held: tuple = ()):
+        self.hosts = HostsFileBackend(path)
+        self.held = set(held)
+        self.release = threading.Event()
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, domain: str) -> str:
+        with self.lock:
+            self.calls.append(domain)
+        if domain in self.held:
+            self.release.wait(10.)
+        return self.hosts(domain)
+
+
+def backend(tmp_path, held: tuple = ()) -> StubBackend:
+    path = tmp_path / 'hosts'
+    path.write_text(hosts)
+    return StubBackend(str(path), held)
+
+
+def test_dedup_in_flight(tmp_path):
+    stub = backend(tmp_path, held=('slow.example',))
+    resolver = Resolver(backend=stub, max_in_flight=4)
+
+    futures = [resolver.submit('slow.example') for _ in range(3)]
+    assert all(future is futures[0] for future in futures)
+    assert not futures[0].done()
+
+    stub.release.set()
+    assert [resolver.result('slow.example', future) for future in futures] == ['10.0.0.1'] * 3
+    assert stub.calls == ['slow.example']
+    assert (resolver.misses, resolver.hits) == (1, 2)
+
+    # Finished lookups stay cached
+    assert resolver.resolve('slow.example') == '10.0.0.1'
+    assert stub.calls == ['slow.example']
+    resolver.close()
+
+
+def test_negative_cache(tmp_path):
+    stub = backend(tmp_path)
+    resolver = Resolver(backend=stub, negative_ttl=0.2)
+
+    assert resolver.resolve('missing.example') is None
+    assert resolver.failures == 1
+
+    # Answered from the negative cache without another lookup
+    future = resolver.submit('missing.example')
+    assert future.done() and resolver.result('missing.example', future) is None
+    assert stub.calls == ['missing.example']
+
+    # Failures are retried once the negative ttl has passed
+    time.sleep(0.3)
+    assert resolver.resolve('missing.example') is None
+    assert stub.calls == ['missing.example'] * 2
+    resolver.close()
+
+
+def test_timeout(tmp_path):
+    stub = backend(tmp_path, held=('slow.example',))
+    resolver = Resolver(backend=stub, timeout=0.05)
+
+    assert resolver.resolve('slow.example') is None
+    assert resolver.timeouts == 1 and resolver.failures == 0
+
+    # Timeouts are not negatively cached, the next occurrence looks it up again
+    stub.release.set()
+    assert resolver.resolve('slow.example') == '10.0.0.1'
+    assert stub.calls == ['slow.example'] * 2
+    resolver.close()
+
+
+def test_store(tmp_path):
+    stub = backend(tmp_path)
+    store = DnsStore(str(tmp_path / 'dns.sqlite'))
+    resolver = Resolver(backend=stub, store=store)
+    assert resolver.resolve('www.fast.example') == '10.0.0.2'
+    assert resolver.resolve('missing.example') is None
+    resolver.close()
+
+    # A fresh resolver gets both answers from the store
+    resolver = Resolver(backend=stub, store=store)
+    assert resolver.resolve('www.fast.example') == '10.0.0.2'
+    assert resolver.resolve('missing.example') is None
+    assert stub.calls == ['www.fast.example', 'missing.example']
+    assert store.hits == 2
+    resolver.close()
+    store.close()
+
+
+def cdx_line(domain: str, path: str) -> bytes:
+    surt = ','.join(reversed(domain.split('.')))
+    meta = {'url': f'http://{domain}/{path}', 'status': '200', 'mime': 'text/html', 'length': '10'}
+    return f'{surt})/{path} 20200915123456 {json.dumps(meta)}\n'.encode()
+
+
+def test_stream_order(tmp_path, monkeypatch, capsys):
+    # Rows behind a slow lookup have to wait for it and come out in input order
+    domains = ['slow.example', 'fast.example', 'missing.example', 'slow.example', '10.0.0.9', 'fast.example']
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('common-crawl-raw')
+    os.makedirs('common-crawl')
+    os.makedirs(stream.metrics_directory)
+    filename = os.path.join('common-crawl-raw', 'cdx-00000.gz')
+    with open(filename, 'wb') as f:
+        f.write(gzip.compress(b''.join(cdx_line(domain, str(i)) for i, domain in enumerate(domains))))
+
+    stub = backend(tmp_path, held=('slow.example',))
+    threading.Timer(0.2, stub.release.set).start()
+
+    starts = ip_to_int(['10.0.0.0'])[0]
+    ends = ip_to_int(['10.0.0.255'])[0]
+    monkeypatch.setattr(stream, 'dns_pending', 3)
+    monkeypatch.setattr(stream, 'store', DnsStore('dns.sqlite'))
+    monkeypatch.setattr(stream, 'resolver', Resolver(backend=stub, store=stream.store))
+    monkeypatch.setattr(stream, 'asn_resolver', AsnResolver(
+        starts, ends, np.array([64500]), np.array([0], dtype=np.int16), np.array([0], dtype=np.int32),
+        np.array(['US']), np.array(['Example']),
+    ))
+
+    stream.parse_n_save(Job(filename, None, 0, os.path.getsize(filename)))
+    stream.resolver.close()
+    stream.store.close()
+
+    output, = os.listdir('common-crawl')
+    read = list(read_rows(os.path.join('common-crawl', output)))
+    assert [row['domain'] for row in read] == domains
+    assert [row['path'] for row in read] == [f'/{i}' for i in range(len(domains))]
+    assert [row['ip'] for row in read] == ['10.0.0.1', '10.0.0.2', '', '10.0.0.1', '10.0.0.9', '10.0.0.2']
+    assert [row['asn_num'] for row in read] == ['64500', '64500', '-1', '64500', '64500', '64500']
+    assert sorted(stub.calls) == ['fast.example', 'missing.example', 'slow.example']
+    assert 'dns hits=2 misses=3 failures=1 timeouts=0' in capsys.readouterr().out
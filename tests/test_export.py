@@ -0,0 +1,95 @@
+import gzip
+import hashlib
+import importlib.util
+import os
+import sys
+
+from utils.rdf import unescape
+from utils.storage import open_writer
+
+spec = importlib.util.spec_from_file_location(
+    'graph_ingest', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'graph-ingest.py'),
+)
+graph_ingest = importlib.util.module_from_spec(spec)
+# Registered so the export workers can unpickle its functions
+sys.modules[spec.name] = graph_ingest
+spec.loader.exec_module(graph_ingest)
+
+asn_table = [
+    '0.0.0.0\t0.255.255.255\t0\tNone\tNot routed',
+    '1.0.0.0\t1.0.0.255\t13335\tUS\tCloudflare',
+    '2.0.0.0\t2.0.0.255\t64500\tFR\tOrg "quoted" \\ here',
+]
+
+columns = ['domain', 'ip', 'asn_num', 'path']
+
+shards = [
+    [
+        ['a.com', '1.0.0.1', '13335', '/a "q"'],
+        ['a.com', '1.0.0.1', '13335', '/line\nbreak'],
+        ['a.com', '1.0.0.1', '13335', '/a "q"'],
+    ],
+    [
+        ['a.com', '1.0.0.1', '13335', '/a "q"'],
+        ['b.com', '3.0.0.1', '99999', '/'],
+    ],
+]
+
+
+def read_quads(path: str) -> list:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        lines = f.read().split('\n')
+    assert lines.pop() == ''
+    assert all(line.endswith(' .') for line in lines)
+    return lines
+
+
+def domain_label(domain: str) -> str:
+    return '_:domain.' + hashlib.md5(domain.encode()).hexdigest()
+
+
+def document_label(path: str) -> str:
+    return '_:doc.' + hashlib.md5(path.encode()).hexdigest()
+
+
+def test_export(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with gzip.open('ip2asn-v4.tsv.gz', 'wt') as f:
+        f.write('\n'.join(asn_table) + '\n')
+
+    os.makedirs('common-crawl')
+    for i, rows in enumerate(shards):
+        writer = open_writer(f'common-crawl/cdx-{i:05d}', columns)
+        writer.write(rows)
+        writer.close()
+
+    graph_ingest.export('rdf', processes=1)
+    assert sorted(os.listdir('rdf')) == ['asn.rdf.gz', 'cdx-00000.rdf.gz', 'cdx-00001.rdf.gz', 'schema.txt']
+
+    # Unrouted ranges get no node, literals are escaped and read back intact
+    quads = read_quads(os.path.join('rdf', 'asn.rdf.gz'))
+    assert '_:asn.0 <dgraph.type> "ASN" .' not in quads
+    assert '_:asn.64500 <org> "Org \\"quoted\\" \\\\ here" .' in quads
+    assert unescape('Org \\"quoted\\" \\\\ here') == 'Org "quoted" \\ here'
+    assert '_:country.US <asns> _:asn.13335 .' in quads
+
+    # Each shard writes its nodes once, with an edge from the asn if it has a node
+    a = domain_label('a.com')
+    quoted, newline = shards[0][0][3], shards[0][1][3]
+    first = read_quads(os.path.join('rdf', 'cdx-00000.rdf.gz'))
+    assert first.count(f'{a} <dgraph.type> "Domain" .') == 1
+    assert first.count(f'_:asn.13335 <domains> {a} .') == 1
+    assert first.count(f'{a} <documents> {document_label(quoted)} .') == 2
+    assert sum('<path>' in line for line in first) == 2
+    assert f'{document_label(newline)} <path> "/line\\nbreak" .' in first
+
+    # The same domain gets the same label in every shard, for the bulk loader
+    # to merge
+    second = read_quads(os.path.join('rdf', 'cdx-00001.rdf.gz'))
+    assert second.count(f'{a} <dgraph.type> "Domain" .') == 1
+    b = domain_label('b.com')
+    assert f'{b} <ip> "3.0.0.1" .' in second
+    assert not any(line.endswith(f'<domains> {b} .') for line in second)
+
+    # Shards that already exist are left alone
+    assert graph_ingest.export_file(os.path.join('common-crawl', 'cdx-00000.csv.gz'), 'rdf', {'13335'}) == 0
@@ -0,0 +1,32 @@
+from utils.storage import ParquetWriter, read_rows
+
+columns = ['url', 'country', 'asn_org', 'tld', 'mime', 'asn_num', 'status', 'length']
+
+
+def rows(start: int, count: int, country: str) -> list:
+    return [[f'http://{i}.com/', country, 'org', 'com', 'text/html', '1', '200', '10'] for i in range(start, start + count)]
+
+
+def resume(path: str, partition_on: str = None) -> list:
+    writer = ParquetWriter(path, columns, partition_on=partition_on)
+    writer.write(rows(0, 3, 'US'))
+    state = writer.checkpoint()
+
+    # Written after the checkpoint, so dropped on resume
+    writer.write(rows(3, 2, 'US'))
+
+    writer = ParquetWriter(path, columns, partition_on=partition_on, resume=state)
+    assert [row['url'] for row in read_rows(path)] == [f'http://{i}.com/' for i in range(3)]
+    writer.write(rows(5, 4, 'US'))
+    return list(read_rows(path))
+
+
+def test_resume_single_partition(tmp_path):
+    read = resume(str(tmp_path / 'out.parquet'), partition_on='country')
+    assert [row['url'] for row in read] == [f'http://{i}.com/' for i in [0, 1, 2, 5, 6, 7, 8]]
+    assert {row['country'] for row in read} == {'US'}
+
+
+def test_resume_unpartitioned(tmp_path):
+    read = resume(str(tmp_path / 'out.parquet'))
+    assert [row['url'] for row in read] == [f'http://{i}.com/' for i in [0, 1, 2, 5, 6, 7, 8]]
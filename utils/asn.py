@@ -1,5 +1,11 @@
+import socket
+import typing
+
+import numpy as np
 import pandas as pd
 
+from utils.snapshot import load_arrays, save_arrays
+
 
 def get_asn_table():
     asntbl = pd.read_csv('ip2asn-v4.tsv.gz', compression='gzip', sep='\t', header=None)
@@ -10,4 +16,169 @@ def get_asn_table():
     asntbl.set_index('asn number', inplace=True)
     asntbl.drop_duplicates(inplace=True)
 
-    return asntbl
\ No newline at end of file
+    return asntbl
+
+
+def ip_to_int(ips: typing.Iterable[typing.Union[str, None]]) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert dotted ipv4 strings to integers. Anything that is not an ipv4
+    address (None, ipv6, garbage) is marked invalid.
+
+    :param ips:
+    :return: uint32 array of addresses, bool array of which entries are valid
+    """
+    packed = []
+    valid = []
+    for ip in ips:
+        try:
+            packed.append(socket.inet_aton(ip))
+            valid.append(True)
+        except (OSError, TypeError):
+            packed.append(b'\0\0\0\0')
+            valid.append(False)
+
+    return np.frombuffer(b''.join(packed), dtype='>u4').astype(np.uint32), np.array(valid, dtype=bool)
+
+
+class AsnResolver(object):
+    """
+    Batch ip -> asn, country, organization resolver.
+
+    The ip2asn ranges are kept as sorted numpy arrays so that a whole batch of
+    addresses can be resolved with a single searchsorted. Countries and
+    organizations are dictionary encoded; lookups return integer codes into
+    country_names and org_names, with -1 meaning unknown.
+
+    A resolver can be saved as a directory of .npy files. Loading that snapshot
+    memory maps the arrays, so every worker process shares the same pages
+    instead of parsing the tsv itself.
+    """
+
+    arrays = ['starts', 'ends', 'asns', 'countries', 'orgs', 'country_names', 'org_names']
+
+    def __init__(
+            self,
+            starts: np.ndarray,
+            ends: np.ndarray,
+            asns: np.ndarray,
+            countries: np.ndarray,
+            orgs: np.ndarray,
+            country_names: np.ndarray,
+            org_names: np.ndarray,
+    ):
+        """
+        :param starts: first address of each range, sorted
+        :param ends: last address of each range
+        :param asns: asn number of each range
+        :param countries: country code of each range
+        :param orgs: organization code of each range
+        :param country_names: country for each country code
+        :param org_names: organization for each organization code
+        """
+        super(AsnResolver, self).__init__()
+
+        self.starts = starts
+        self.ends = ends
+        self.asns = asns
+        self.countries = countries
+        self.orgs = orgs
+        self.country_names = country_names
+        self.org_names = org_names
+
+        # Plain lists are much faster to index one element at a time
+        self._country_list = country_names.tolist()
+        self._org_list = org_names.tolist()
+
+    @classmethod
+    def build(cls, filename: str = 'ip2asn-v4.tsv.gz') -> 'AsnResolver':
+        """
+        Build a resolver from the ip2asn tsv.
+
+        :param filename:
+        :return:
+        """
+        table = pd.read_csv(
+            filename, compression='gzip', sep='\t', header=None,
+            names=['start', 'end', 'asn number', 'country', 'organization'],
+            keep_default_na=False,
+        )
+
+        # Unrouted ranges are listed with asn 0
+        table = table[table['asn number'] != 0]
+        starts = ip_to_int(table['start'])[0]
+        order = np.argsort(starts, kind='stable')
+        table = table.iloc[order]
+
+        countries, country_names = pd.factorize(table['country'].mask(table['country'].isin(['None', ''])))
+        orgs, org_names = pd.factorize(table['organization'].mask(table['organization'] == ''))
+
+        return cls(
+            starts[order],
+            ip_to_int(table['end'])[0],
+            table['asn number'].to_numpy(dtype=np.int64),
+            countries.astype(np.int16),
+            orgs.astype(np.int32),
+            np.asarray(country_names, dtype=str),
+            np.asarray(org_names, dtype=str),
+        )
+
+    def save(self, path: str):
+        """
+        Write the resolver arrays to a snapshot directory.
+
+        :param path:
+        :return:
+        """
+        save_arrays(path, {name: getattr(self, name) for name in self.arrays})
+
+    @classmethod
+    def load(cls, path: str) -> 'AsnResolver':
+        """
+        Memory map a snapshot written by save.
+
+        :param path:
+        :return:
+        """
+        return cls(*load_arrays(path, cls.arrays))
+
+    def lookup(self, ips: typing.Iterable[typing.Union[str, None]]) -> typing.Dict[str, np.ndarray]:
+        """
+        Resolve a batch of ips.
+
+        :param ips:
+        :return: dict of asn_num, country code and asn_org code arrays
+        """
+        addresses, valid = ip_to_int(ips)
+
+        # Find the last range starting at or before each address, then make
+        # sure the address is not past the end of that range.
+        index = np.searchsorted(self.starts, addresses, side='right') - 1
+        found = valid & (index >= 0)
+        index[~found] = 0
+        found &= addresses <= self.ends[index]
+
+        return {
+            'asn_num': np.where(found, self.asns[index], -1),
+            'country': np.where(found, self.countries[index], -1),
+            'asn_org': np.where(found, self.orgs[index], -1),
+        }
+
+    def resolve(self, ips: typing.Iterable[typing.Union[str, None]]) -> typing.List[typing.Tuple[int, str, str]]:
+        """
+        Resolve a batch of ips to (asn number, country, organization) tuples,
+        with None for anything unknown.
+
+        :param ips:
+        :return:
+        """
+        result = self.lookup(ips)
+        countries, orgs = self._country_list, self._org_list
+
+        return [
+            (asn, countries[country] if country >= 0 else None, orgs[org] if org >= 0 else None)
+            for asn, country, org in zip(
+                result['asn_num'].tolist(),
+                result['country'].tolist(),
+                result['asn_org'].tolist(),
+            )
+        ]
@@ -0,0 +1,112 @@
+import threading
+import time
+
+
+class BatchSizeController(object):
+    """
+    AIMD controller for the number of rows per DGraph commit.
+
+    Commits are measured as they happen. Every window commits the batch
+    size is adjusted from what that window saw:
+
+    - Too many aborts, or commits slower than target_latency: the cluster
+      is contended or overloaded, so the size is cut multiplicatively.
+    - Throughput clearly lower than the window before, right after an
+      increase: the increase didn't pay off, so the size is cut as well.
+    - Otherwise the size grows additively, probing for more throughput.
+
+    Every decision is printed along with the numbers behind it.
+    """
+
+    def __init__(
+            self,
+            initial: int = 100,
+            minimum: int = 10,
+            maximum: int = 2000,
+            increase: int = 10,
+            decrease: float = 0.5,
+            target_latency: float = 1.0,
+            max_abort_rate: float = 0.1,
+            window: int = 20,
+            name: str = 'batch size',
+    ):
+        """
+        :param initial: starting batch size
+        :param minimum: smallest batch size
+        :param maximum: largest batch size
+        :param increase: added to the size after a good window
+        :param decrease: the size is multiplied by this after a bad window
+        :param target_latency: commits slower than this (seconds) count as overload
+        :param max_abort_rate: aborted attempts / all attempts above this count as contention
+        :param window: number of commits between decisions
+        :param name: what to call the controller in the log
+        """
+        super(BatchSizeController, self).__init__()
+
+        self.size = min(maximum, max(minimum, initial))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.max_abort_rate = max_abort_rate
+        self.window = window
+        self.name = name
+
+        # Commits are recorded from several threads
+        self.lock = threading.Lock()
+        self._reset()
+
+        # Throughput of the last window, and whether the size grew after it
+        self.throughput = None
+        self.increased = False
+
+    def _reset(self):
+        self.commits = 0
+        self.aborts = 0
+        self.latency = 0.
+        self.mutations = 0
+        self.started = time.time()
+
+    def __call__(self) -> int:
+        return self.size
+
+    def record(self, mutations: int, latency: float, aborts: int = 0):
+        """
+        Record a successful commit.
+
+        :param mutations: number of mutations in the batch
+        :param latency: seconds the successful attempt took
+        :param aborts: number of aborted attempts before it
+        :return:
+        """
+        with self.lock:
+            self.commits += 1
+            self.aborts += aborts
+            self.latency += latency
+            self.mutations += mutations
+            if self.commits >= self.window:
+                self._decide()
+                self._reset()
+
+    def _decide(self):
+        latency = self.latency / self.commits
+        abort_rate = self.aborts / (self.aborts + self.commits)
+        throughput = self.mutations / max(time.time() - self.started, 1e-9)
+
+        if abort_rate > self.max_abort_rate:
+            size, reason = int(self.size * self.decrease), 'abort rate'
+        elif latency > self.target_latency:
+            size, reason = int(self.size * self.decrease), 'latency'
+        elif self.increased and throughput < self.throughput * 0.9:
+            size, reason = int(self.size * self.decrease), 'throughput dropped'
+        else:
+            size, reason = self.size + self.increase, 'healthy'
+        size = min(self.maximum, max(self.minimum, size))
+
+        print('{} {} -> {} ({}): {:.3f}s latency {:.0f} mutations/s {:.1%} aborts'.format(
+            self.name, self.size, size, reason, latency, throughput, abort_rate,
+        ))
+        self.increased = size > self.size
+        self.size = size
+        self.throughput = throughput
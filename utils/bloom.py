@@ -0,0 +1,92 @@
+import hashlib
+import math
+import typing
+
+import numpy as np
+
+# Set bits in every byte value
+popcount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class BloomFilter(object):
+    """
+    In memory bloom filter over a numpy bit array.
+
+    Each key is hashed once with blake2b; the two 64 bit halves of the
+    digest drive double hashing for the k bit positions. Filters with the
+    same capacity and error rate use the same layout in every process, so
+    their bit arrays can simply be OR'ed together to merge them.
+    """
+
+    def __init__(self, capacity: int = 1000000, error_rate: float = 1.0e-6):
+        """
+        :param capacity: number of keys the filter is sized for
+        :param error_rate: false positive rate at capacity
+        """
+        super(BloomFilter, self).__init__()
+
+        self.capacity = capacity
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = int(math.ceil(bits / 8)) * 8
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = np.zeros(self.size // 8, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        """
+        Estimate how many distinct keys have been added, from the share of
+        bits that are set (Swamidass and Baldi).
+
+        :return:
+        """
+        ones = int(popcount[self.bits].sum(dtype=np.int64))
+        if ones >= self.size:
+            return 2 ** 63 - 1
+        return int(round(-self.size / self.hashes * math.log(1 - ones / self.size)))
+
+    def _positions(self, keys: typing.List[str]) -> np.ndarray:
+        """
+        Bit positions of each key, one row per key.
+
+        :param keys:
+        :return:
+        """
+        digests = b''.join(hashlib.blake2b(key.encode(), digest_size=16).digest() for key in keys)
+        halves = np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+        steps = np.arange(self.hashes, dtype=np.uint64)
+        return (halves[:, :1] + steps * halves[:, 1:]) % np.uint64(self.size)
+
+    def add_many(self, keys: typing.Iterable[str]):
+        keys = list(keys)
+        if len(keys) == 0:
+            return
+        positions = self._positions(keys).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3), (1 << (positions & np.uint64(7))).astype(np.uint8))
+
+    def add(self, key: str):
+        self.add_many([key])
+
+    def contains_many(self, keys: typing.Iterable[str]) -> typing.List[bool]:
+        keys = list(keys)
+        if len(keys) == 0:
+            return []
+        positions = self._positions(keys)
+        bits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=1).tolist()
+
+    def __contains__(self, key: str) -> bool:
+        return self.contains_many([key])[0]
+
+    def to_bytes(self) -> bytes:
+        return self.bits.tobytes()
+
+    def merge(self, data: bytes):
+        """
+        OR the bits of a filter with the same layout into this one.
+
+        :param data: bit array from to_bytes
+        :return:
+        """
+        other = np.frombuffer(data, dtype=np.uint8)
+        if len(other) != len(self.bits):
+            raise ValueError(f'cannot merge a {len(other)} byte bloom filter into a {len(self.bits)} byte one')
+        self.bits |= other
@@ -1,30 +1,51 @@
-import json
-from typing import Union
+import os
+import time
+from typing import Dict, List, Union
 
-from cachetools.lru import LRUCache
-from redis import Redis, exceptions
 from redisbloom.client import Client as RedisBloom
 
-from utils.dgraph import get_client
+from utils.bloom import BloomFilter
+from utils.eviction import TraceWriter, local_cache, trace_filename
+from utils.metrics import count, observe, timer
+from utils.dgraph import get_client, lookup_uids
+from utils.redis import get_pool, get_redis
+from utils.uidindex import UidIndex
 
 
 class LayeredCache(object):
     """
     Multi-Layered key value store.
 
-    Layer 1: In Memory LRU Key Value Map
+    Layer 1: In Memory Key Uid Map
     Layer 2: Redis Key Value Store
 
     This cache type is great for things that can exist in memory, either
-    locally in the LRU layer or in the redis layer.
+    locally in the in memory layer or in the redis layer. Values must be
+    DGraph uids. Layer 1 evicts with CLOCK by default, storing uids
+    compactly, see CompactCache; other policies are in utils.eviction.
+
+    Writes to redis are buffered and sent in one pipeline once flush_size
+    of them have piled up, or flush_interval seconds after the last flush,
+    or whenever flush is called, eg. once a transaction has committed.
+    Values read from redis are only put in layer 1, never written back.
     """
 
-    def __init__(self, node_name: str, lru_size: int):
+    def __init__(
+            self,
+            node_name: str,
+            local_bytes: int,
+            flush_size: int = 1000,
+            flush_interval: float = 1.,
+            policy: str = "clock",
+    ):
         """
         Initialize the first two layers of a multi-layered cache
         
         :param node_name: 
-        :param lru_size: 
+        :param local_bytes: memory budget of layer 1
+        :param flush_size: buffered redis writes that trigger a flush
+        :param flush_interval: seconds buffered redis writes may wait
+        :param policy: layer 1 eviction policy, see utils.eviction.policies
         """
         super(LayeredCache, self).__init__()
 
@@ -32,19 +53,64 @@ class LayeredCache(object):
         # unique identifier can be used in dgraph queries.
         self.node_name = node_name
 
-        # Initialize a Least Recently Used in-memory cache
-        # with a maximum number of elements.
+        # Initialize an in-memory cache within a memory budget.
         # layer 1
-        self.lru_local_cache = LRUCache(maxsize=lru_size)
+        self.local_cache = local_cache(policy, local_bytes)
 
-        # Initialize a redis client.
+        # Records the keys asked for, if enabled with record_trace
+        self.trace = None
+
+        # Get a redis client on the connection pool shared by every
+        # cache in this process.
         # layer 2 cache
-        self.redis = Redis("localhost")
+        self.redis = get_redis()
 
         # This should be set to True if we should add a timeout to the
         # redis key value store values.
         self.set_timeout = False
 
+        # Redis writes waiting for the next flush, redis key -> value
+        self.writes = dict()
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+
+    def record_trace(self, directory: str):
+        """
+        Start recording the keys passed to record_access to a trace file
+        in directory, to replay against other eviction policies and sizes
+        offline.
+
+        :param directory:
+        :return:
+        """
+        self.trace = TraceWriter(trace_filename(directory, self.node_name))
+
+    def record_access(self, keys: List[str]):
+        """
+        Add keys to the access trace, if one is being recorded. Lookups
+        don't record anything themselves: callers record the keys their
+        rows ask for, in order and before any deduplication, so the trace
+        is the access stream itself rather than what reached the cache.
+
+        :param keys:
+        :return:
+        """
+        if self.trace is not None:
+            self.trace.record(self._get_key(key) for key in keys)
+
+    def _count(self, layer: str, hits: int, misses: int):
+        """
+        Count the keys a layer found, and the ones that fell through it.
+
+        :param layer:
+        :param hits:
+        :param misses:
+        :return:
+        """
+        count("cache_lookups_total", hits, cache=self.node_name, layer=layer, result="hit")
+        count("cache_lookups_total", misses, cache=self.node_name, layer=layer, result="miss")
+
     def _get_key(self, key: str) -> str:
         """
         Get the unique key that is used at each cached layer.
@@ -63,17 +129,71 @@ class LayeredCache(object):
         :return:
         """
 
-        # Store in layer 1 local LRU cache
-        self.lru_local_cache[self._get_key(key)] = value
+        # Store in layer 1 local cache
+        self.local_cache[self._get_key(key)] = value
+
+        # Queue for layer 2 redis cache
+        self.writes[self._get_key(key)] = value
+        self._maybe_flush()
+
+    def set_many(self, items: Dict[str, str]):
+        """
+        Store many key value pairs in each cache layer.
+
+        :param items:
+        :return:
+        """
+        if len(items) == 0:
+            return
+
+        items = {self._get_key(key): value for key, value in items.items()}
+
+        # Store in layer 1 local cache
+        self.local_cache.set_many(items)
+
+        # Queue for layer 2 redis cache
+        self.writes.update(items)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self.writes) >= self.flush_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Send every buffered write to redis in a single round trip.
+
+        :return:
+        """
+        if len(self.writes) > 0:
+            start = time.perf_counter()
+
+            # If we want to have key value pairs timeout in redis, use setex
+            # with 5 minutes before until timeout
+            if self.set_timeout:
+                timeout = 300
+                pipeline = self.redis.pipeline(transaction=False)
+                for key, value in self.writes.items():
+                    pipeline.setex(key, timeout, value)
+                pipeline.execute()
+            else:
+                self.redis.mset(self.writes)
+            self.writes = dict()
+            observe("cache_seconds", time.perf_counter() - start, cache=self.node_name, layer="redis_write")
+        self.last_flush = time.time()
+
+    def _get_local(self, key: str) -> Union[str, None]:
+        """
+        Look a key up without going to redis: in layer 1, then in the
+        writes that haven't been flushed yet.
 
-        # Store in layer 2 redis cache
-        # If we want to have key value pairs timeout in redis, use setex with 5
-        # minutes before until timeout
-        if self.set_timeout:
-            timeout = 300
-            self.redis.setex(self._get_key(key), timeout, value)
-        else:
-            self.redis.set(self._get_key(key), value)
+        :param key: redis key
+        :return:
+        """
+        value = self.local_cache.get(key, None)
+        if value is None:
+            value = self.writes.get(key, None)
+        return value
 
     def __contains__(self, key: str) -> bool:
         """
@@ -87,17 +207,19 @@ class LayeredCache(object):
         :param key:
         :return:
         """
-
-        # Check the layer 1 local LRU cache
-        local_result = self.lru_local_cache.get(self._get_key(key), None)
+        # Check the layer 1 local cache
+        local_result = self._get_local(self._get_key(key))
+        self._count("local", local_result is not None, local_result is None)
         if local_result is not None:
             return True
 
         # Check the layer 2 redis cache
-        redis_result = self.redis.get(self._get_key(key))
+        with timer("cache_seconds", cache=self.node_name, layer="redis"):
+            redis_result = self.redis.get(self._get_key(key))
+        self._count("redis", redis_result is not None, redis_result is None)
         if redis_result is not None:
-            # Update the each layer with the value
-            self[key] = redis_result.decode()
+            # Update layer 1 with the value, redis already has it
+            self.local_cache[self._get_key(key)] = redis_result.decode()
             return True
 
         # Cache miss, return False
@@ -113,104 +235,313 @@ class LayeredCache(object):
         :param key:
         :return:
         """
-
-        # Check the layer 1 local LRU cache
-        local_result = self.lru_local_cache.get(self._get_key(key), None)
+        # Check the layer 1 local cache
+        local_result = self._get_local(self._get_key(key))
+        self._count("local", local_result is not None, local_result is None)
         if local_result is not None:
             return local_result
 
         # Check the layer 2 redis cache
-        redis_result = self.redis.get(self._get_key(key))
+        with timer("cache_seconds", cache=self.node_name, layer="redis"):
+            redis_result = self.redis.get(self._get_key(key))
+        self._count("redis", redis_result is not None, redis_result is None)
         if redis_result is not None:
-            # Update the each layer with the value
-            self[key] = redis_result.decode()
+            # Update layer 1 with the value, redis already has it
+            self.local_cache[self._get_key(key)] = redis_result.decode()
             return redis_result.decode()
 
         # Cache miss, return None
         return None
 
+    def get_many(self, keys: List[str]) -> List[Union[str, None]]:
+        """
+        Look up many keys at once. Keys missing from layer 1 are fetched
+        from redis with a single MGET, and the ones found there are put in
+        layer 1.
+
+        :param keys:
+        :return: the value for each key, None for keys that were not found
+        """
+        keys = list(keys)
+        values = [None] * len(keys)
+
+        # Check the layer 1 local cache, then the unflushed writes
+        missing = []
+        for i, value in enumerate(self.local_cache.get_many(self._get_key(key) for key in keys)):
+            values[i] = value if value is not None else self.writes.get(self._get_key(keys[i]), None)
+            if values[i] is None:
+                missing.append(i)
+
+        self._count("local", len(keys) - len(missing), len(missing))
+        if len(missing) == 0:
+            return values
+
+        # Check the layer 2 redis cache in one round trip
+        with timer("cache_seconds", cache=self.node_name, layer="redis"):
+            redis_results = self.redis.mget([self._get_key(keys[i]) for i in missing])
+        found = dict()
+        for i, redis_result in zip(missing, redis_results):
+            if redis_result is not None:
+                values[i] = redis_result.decode()
+                found[self._get_key(keys[i])] = values[i]
+        self.local_cache.set_many(found)
+        self._count("redis", len(found), len(missing) - len(found))
+
+        return values
+
+    def contains_many(self, keys: List[str]) -> List[bool]:
+        """
+        Check many keys at once, see get_many.
+
+        :param keys:
+        :return: whether each key was found
+        """
+        return [value is not None for value in self.get_many(keys)]
+
     def close(self):
         """
-        Close any outstanding connections.
+        Flush buffered writes and close any outstanding connections.
 
         :return:
         """
+        self.flush()
         self.redis.close()
+        if self.trace is not None:
+            self.trace.close()
 
 
 class FullLayeredCache(LayeredCache):
     """
-    Multi-Layered key value store with bloom filter and dgraph.
+    Multi-Layered key value store with uid index, bloom filter and dgraph.
 
-    Layer 1: In Memory LRU Key Value Map
+    Layer 1: In Memory Key Uid Map
     Layer 2: Redis Key Value Store
-    Layer 3: Bloom filter
-    Layer 4: DGraph
+    Layer 3: Local Uid Index, if enabled
+    Layer 4: Bloom filter, if trusted
+    Layer 5: DGraph
 
     The primary difference between this class and the LayeredCache class is that this
-    one includes the bloom filter and DGraph.
+    one includes the uid index, the bloom filter and DGraph.
+
+    The bloom filter is only kept when trust_bloom is set. It lives in
+    memory, sized for bloom_capacity keys, and every key stored in the
+    cache is added to it. Every sync_interval seconds its bits are OR'ed
+    into a shared copy in the RedisBloom instance and the merged bits
+    pulled back, so keys added by other workers show up. A key the filter
+    has never seen is taken not to be in DGraph, and the lookup stops
+    there; a key it has seen still has to be looked up, since the filter
+    holds no uids. Only set trust_bloom when every node in DGraph was
+    stored through a cache with the filter, eg. a graph that was empty
+    when live ingest started. Nodes from the bulk loader, from before the
+    filter existed, from a worker that died before syncing, or any node
+    after the shared copy in redis is lost would otherwise be created
+    again. Past its capacity the filter rules out fewer and fewer keys,
+    which costs DGraph queries but never creates duplicates.
+
+    trust_bloom can be switched off for a while (eg. while replaying rows
+    after a restart). The filter keeps being filled and synced meanwhile.
+
+    The uid index is a persistent key -> uid index on local disk shared by
+    every worker, see UidIndex. Unlike redis entries, which time out, and
+    layer 1, which goes away with the process, it remembers every key ever
+    stored, and an index rebuilt from a DGraph export knows every node in
+    the graph. It is checked before the bloom filter, so keys it knows
+    are never ruled out, and DGraph is only asked about keys it hasn't
+    seen.
+
+    In the lookup counts (see utils.metrics), a bloom filter hit means the
+    filter has seen the key and a miss that it ruled the key out.
     """
 
-    def __init__(self, node_name: str, lru_size: int, p=1.0e-6, n=1000000):
+    def __init__(
+            self,
+            node_name: str,
+            local_bytes: int,
+            p=1.0e-6,
+            n=1000000,
+            sync_interval=30.,
+            policy="clock",
+            index: str = None,
+            trust_bloom: bool = False,
+    ):
         """
         Initialize last two layers of cache
 
         :param node_name:
-        :param lru_size:
+        :param local_bytes: memory budget of layer 1
+        :param p: bloom filter false positive rate
+        :param n: bloom filter capacity, the same in every worker
+        :param sync_interval: seconds between bloom filter syncs with redis
+        :param policy: layer 1 eviction policy, see utils.eviction.policies
+        :param index: directory of the uid indexes, None to go without
+        :param trust_bloom: keep a bloom filter, and let its misses rule keys out
         """
-        super(FullLayeredCache, self).__init__(node_name, lru_size)
+        super(FullLayeredCache, self).__init__(node_name, local_bytes, policy=policy)
 
         # Set to true so we add a timeout to layer 2 redis key value stores
         self.set_timeout = True
 
-        # Create the bloom filter client object
-        self.bloom = RedisBloom(port=6378)
-
-        # Create a dgraph client, stub, and transaction
+        # Create the in memory bloom filter, and the client for the
+        # RedisBloom instance holding the shared copy of its bits
+        self.local_bloom = None
+        self.bloom = None
+        self.bloom_key = f"{node_name}-bloom"
+        self.sync_interval = sync_interval
+        self.last_sync = 0.
+        self.unsynced = False
+        self.saturated = False
+        self.trust_bloom = trust_bloom
+        if trust_bloom:
+            self.local_bloom = BloomFilter(capacity=n, error_rate=p)
+            self.bloom = RedisBloom(connection_pool=get_pool(6378))
+
+        # Open the uid index for this node kind
+        self.index = None
+        if index is not None:
+            self.index = UidIndex(os.path.join(index, node_name))
+
+        # Create a dgraph client and stub
         self.dgraph, self.stub = get_client()
-        self.txn = self.dgraph.txn()
 
-        # Initialize the bloom filter (if it doesnt already exist)
-        try:
-            self.bloom.bfInfo(node_name)
-        except exceptions.ResponseError:
-            self.bloom.bfCreate(node_name, p, n)
+        # Pick up whatever other workers have added so far
+        self.sync_bloom()
 
-    def __contains__(self, key: str) -> bool:
+    def sync_bloom(self):
         """
-        Check to see if key is in a layer of the cache. We will start at
-        layer 1 and go walk through each layer until we find a result.
-        We will update previous layers if we cache miss.
+        Push the local bloom filter bits to redis and pull back the union of
+        every worker's bits. The OR happens inside redis, in one transaction.
+        Does nothing without a bloom filter.
 
-        We'll return True if the key was found at a layer, False if we
-        cache miss.
+        :return:
+        """
+        if self.local_bloom is None:
+            return
+
+        start = time.perf_counter()
+        pipeline = self.bloom.pipeline(transaction=True)
+        if self.unsynced:
+            tmp = f"{self.bloom_key}-{os.getpid()}"
+            pipeline.set(tmp, self.local_bloom.to_bytes())
+            pipeline.bitop("OR", self.bloom_key, self.bloom_key, tmp)
+            pipeline.delete(tmp)
+        pipeline.get(self.bloom_key)
+        merged = pipeline.execute()[-1]
+
+        if merged is not None:
+            self.local_bloom.merge(merged)
+        self.unsynced = False
+        self.last_sync = time.time()
+        observe("cache_seconds", time.perf_counter() - start, cache=self.node_name, layer="bloom_sync")
+
+        if not self.saturated and len(self.local_bloom) > self.local_bloom.capacity:
+            self.saturated = True
+            print(
+                f"{self.node_name} bloom filter holds about {len(self.local_bloom)} keys, past its capacity "
+                f"of {self.local_bloom.capacity}, so it rules out fewer keys from now on"
+            )
+
+    def _maybe_sync(self):
+        if self.local_bloom is not None and time.time() - self.last_sync > self.sync_interval:
+            self.sync_bloom()
+
+    def _add_bloom(self, keys: List[str]):
+        """
+        Add stored keys to the bloom filter, if there is one.
+
+        :param keys:
+        :return:
+        """
+        if self.local_bloom is None:
+            return
+        self.local_bloom.add_many(self._get_key(key) for key in keys)
+        self.unsynced = True
+        self._maybe_sync()
+
+    def _ruled_out(self, keys: List[str]) -> List[bool]:
+        """
+        Check keys against the bloom filter, if it is trusted.
+
+        :param keys:
+        :return: for each key, whether it is certainly not in DGraph
+        """
+        if self.local_bloom is None or not self.trust_bloom:
+            return [False] * len(keys)
+        self._maybe_sync()
+        seen = self.local_bloom.contains_many(self._get_key(key) for key in keys)
+        self._count("bloom", sum(seen), len(seen) - sum(seen))
+        return [not hit for hit in seen]
+
+    def __setitem__(self, key: str, value: str):
+        """
+        Store a key value pair in each cache layer, including the bloom
+        filter.
 
         :param key:
+        :param value:
         :return:
         """
+        super(FullLayeredCache, self).__setitem__(key, value)
+        self._add_bloom([key])
+        if self.index is not None:
+            self.index[key] = value
 
-        # Check layer 1 and 2
-        if super(FullLayeredCache, self).__contains__(key):
-            return True
+    def set_many(self, items: Dict[str, str]):
+        """
+        Store many key value pairs in each cache layer, including the bloom
+        filter.
 
-        # Check the layer 3 bloom filter
-        exists_in_bloom = self.bloom.bfExists(self.node_name, self._get_key(key))
-        if exists_in_bloom == 1:
-            # Unfortunately, we can't store the actual value in the bloom filter.
-            # For this, we can't update previous layers with the value for this key.
-            return True
+        :param items:
+        :return:
+        """
+        if len(items) == 0:
+            return
+        super(FullLayeredCache, self).set_many(items)
+        self._add_bloom(list(items))
+        if self.index is not None:
+            self.index.set_many(items)
+
+    def _get_indexed(self, keys: List[str]) -> List[Union[str, None]]:
+        """
+        Look keys up in the uid index, storing the ones found in layer 1.
+        Redis doesn't need them, every worker has the index.
 
-        # All else has failed, we must now check dgraph. This is super super slow.
-        query = """query all($a: string) { all(func: eq(%s, $a)) { uid } }""" % self.node_name
-        dgraph_result = self.txn.query(query, variables={"$a": str(key)})
-        thing = json.loads(dgraph_result.json)
-        if len(thing["all"]) > 0:
+        :param keys:
+        :return: the uid for each key, None for keys that are not indexed
+        """
+        if self.index is None:
+            return [None] * len(keys)
+        with timer("cache_seconds", cache=self.node_name, layer="index"):
+            uids = self.index.get_many(keys)
+        hits = sum(uid is not None for uid in uids)
+        self._count("index", hits, len(keys) - hits)
+        self.local_cache.set_many({self._get_key(key): uid for key, uid in zip(keys, uids) if uid is not None})
+        return uids
+
+    def _query(self, key: str) -> Union[str, None]:
+        """
+        Look a key up in DGraph, storing it in the previous layers if found.
+        This is super super slow.
+
+        :param key:
+        :return:
+        """
+        with timer("cache_seconds", cache=self.node_name, layer="dgraph"):
+            uid = lookup_uids(self.dgraph.txn(read_only=True), [(self.node_name, key)])[0]
+        self._count("dgraph", uid is not None, uid is None)
+        if uid is not None:
             # Update previous layers
-            self[key] = thing["all"][0]["uid"]
-            return True
+            self[key] = uid
+        return uid
 
-        # Cache miss, return False
-        return False
+    def __contains__(self, key: str) -> bool:
+        """
+        Check to see if key is in a layer of the cache. A key is only
+        found if a layer has its uid, so this agrees with __getitem__.
+
+        :param key:
+        :return:
+        """
+        return self[key] is not None
 
     def __getitem__(self, key: str) -> Union[str, None]:
         """
@@ -227,22 +558,73 @@ class FullLayeredCache(LayeredCache):
         if item is not None:
             return item
 
-        # Check layer 3 bloom filter
-        exists_in_bloom = self.bloom.bfExists(self.node_name, self._get_key(key))
-        if exists_in_bloom == 1:
-            return True
+        # Check the layer 3 uid index
+        item = self._get_indexed([key])[0]
+        if item is not None:
+            return item
 
-        # All else has failed, we must now check dgraph. This is super super slow.
-        query = """query all($a: string) { all(func: eq(%s, $a)) { uid } }""" % self.node_name
-        dgraph_result = self.txn.query(query, variables={"$a": str(key)})
-        thing = json.loads(dgraph_result.json)
-        if len(thing["all"]) > 0:
-            # Update previous layers
-            self[key] = thing["all"][0]["uid"]
-            return thing["all"][0]["uid"]
+        # Check layer 4 bloom filter. A hit only tells us the key may
+        # exist, so the uid still has to come from dgraph.
+        if self._ruled_out([key])[0]:
+            return None
 
-        # Cache miss, return None
-        return None
+        # All else has failed, we must now check dgraph.
+        return self._query(key)
+
+    def _query_many(self, keys: List[str]) -> List[Union[str, None]]:
+        """
+        Look up many keys in DGraph with a single query, storing the ones
+        found in the previous layers in bulk.
+
+        :param keys:
+        :return: the uid for each key, None for keys that are not in DGraph
+        """
+        with timer("cache_seconds", cache=self.node_name, layer="dgraph"):
+            uids = lookup_uids(self.dgraph.txn(read_only=True), [(self.node_name, key) for key in keys])
+        hits = sum(uid is not None for uid in uids)
+        self._count("dgraph", hits, len(keys) - hits)
+        self.set_many({key: uid for key, uid in zip(keys, uids) if uid is not None})
+        return uids
+
+    def get_many(self, keys: List[str]) -> List[Union[str, None]]:
+        """
+        Look up many keys at once, walking the layers with one round trip
+        each: layer 1, a redis MGET, the uid index, the bloom filter if it
+        is trusted, then a single DGraph query for whatever is left.
+        contains_many goes through here too.
+
+        :param keys:
+        :return: the uid for each key, None for keys that were not found
+        """
+        keys = list(keys)
+
+        # Check layer 1 and 2
+        values = super(FullLayeredCache, self).get_many(keys)
+        missing = [i for i, value in enumerate(values) if value is None]
+        if len(missing) == 0:
+            return values
+
+        # Check the layer 3 uid index
+        for i, uid in zip(missing, self._get_indexed([keys[i] for i in missing])):
+            values[i] = uid
+        missing = [i for i in missing if values[i] is None]
+        if len(missing) == 0:
+            return values
+
+        # Check layer 4 bloom filter, which rules keys out but can't
+        # provide their uids
+        ruled_out = self._ruled_out([keys[i] for i in missing])
+        missing = [i for i, out in zip(missing, ruled_out) if not out]
+        if len(missing) == 0:
+            return values
+
+        # All else has failed, we must now check dgraph. One query for
+        # every remaining key.
+        uids = self._query_many([keys[i] for i in missing])
+        for i, uid in zip(missing, uids):
+            values[i] = uid
+
+        return values
 
     def close(self):
         """
@@ -251,11 +633,20 @@ class FullLayeredCache(LayeredCache):
         :return:
         """
 
+        # Share whatever this worker added to the bloom filter
+        if self.unsynced:
+            self.sync_bloom()
+
         # Close the layer 2 redis connection
         super(FullLayeredCache, self).close()
 
-        # Close layer 3 bloom filter connection
-        self.bloom.close()
+        # Write out whatever was added to the layer 3 uid index
+        if self.index is not None:
+            self.index.close()
+
+        # Close layer 4 bloom filter connection
+        if self.bloom is not None:
+            self.bloom.close()
 
-        # Close layer 4 dgraph connections
+        # Close layer 5 dgraph connections
         self.stub.close()
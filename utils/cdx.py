@@ -0,0 +1,65 @@
+import json
+import typing
+
+# Layout of the tuples produced by parse_line. This is the order of the
+# preprocessed csv columns, minus the ip and asn columns which are filled in
+# later.
+fields = ('domain', 'tld', 'path', 'status', 'timestamp', 'mime', 'mime_detected', 'length', 'url', 'redirect')
+
+Record = typing.Tuple[str, str, str, str, str, str, str, str, str, str]
+
+
+def parse_line(line: bytes) -> Record:
+    """
+    Parse one raw cdx line of the form
+
+        com,example)/path 20200915123456 {"url": ..., "status": ..., ...}
+
+    into a record tuple (see fields). The surt domain is split and reversed
+    exactly once, and the json metadata is decoded straight from bytes.
+
+    Raises ValueError if the line is not a cdx record.
+
+    :param line:
+    :return:
+    """
+    surt, sep, rest = line.partition(b')')
+    path, _, rest = rest.partition(b' ')
+    timestamp, _, meta = rest.partition(b' ')
+    if not sep or not meta:
+        raise ValueError('malformed cdx line')
+
+    meta = json.loads(meta)
+    labels = surt.decode().split(',')
+    tld = labels[0]
+    labels.reverse()
+
+    return (
+        '.'.join(labels),
+        tld,
+        path.decode(),
+        meta.get('status', None),
+        timestamp.decode(),
+        meta.get('mime', None),
+        meta.get('mime-detected', None),
+        meta.get('length', None),
+        meta.get('url', None),
+        meta.get('redirect', None),
+    )
+
+
+def parse_lines(lines: typing.Iterable[bytes]) -> typing.List[Record]:
+    """
+    Parse a batch of raw cdx lines, skipping any that are malformed.
+
+    :param lines:
+    :return:
+    """
+    records = []
+    for line in lines:
+        try:
+            records.append(parse_line(line))
+        except ValueError:
+            # json.JSONDecodeError and UnicodeDecodeError are both ValueErrors
+            continue
+    return records
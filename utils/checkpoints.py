@@ -1,9 +1,14 @@
+import json
 import multiprocessing as mp
 import os
 import pickle
+import typing
 
 lock: mp.Lock = None
 
+# Directory holding per-job progress markers
+progress_dir = 'progress'
+
 
 def set_checkpoint_lock(l: mp.Lock):
     """
@@ -19,9 +24,27 @@ def set_checkpoint_lock(l: mp.Lock):
     lock = l
 
 
+def _atomic_write(filename: str, data: bytes):
+    """
+    Write a file so that readers only ever see the old or the new contents,
+    never a partial write. The data goes to a temp file first, which is
+    then renamed over the original.
+
+    :param filename:
+    :param data:
+    :return:
+    """
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
 def init_checkpoints():
     if not os.path.exists('checkpoint.pickle'):
-        pickle.dump(set(), open('checkpoint.pickle', 'wb'))
+        _atomic_write('checkpoint.pickle', pickle.dumps(set()))
 
 
 def set_checkpoint(name):
@@ -29,7 +52,7 @@ def set_checkpoint(name):
         lock.acquire()
     checkpoint: set = pickle.load(open('checkpoint.pickle', 'rb'))
     checkpoint.add(name)
-    pickle.dump(checkpoint, open('checkpoint.pickle', 'wb'))
+    _atomic_write('checkpoint.pickle', pickle.dumps(checkpoint))
     print(f'reached checkpoint {name}')
     if lock is not None:
         lock.release()
@@ -42,3 +65,34 @@ def get_checkpoint(name):
     if lock is not None:
         lock.release()
     return contains
+
+
+def _progress_path(name: str) -> str:
+    return os.path.join(progress_dir, os.path.normpath(name).replace(os.sep, '_') + '.json')
+
+
+def save_progress(name: str, state: dict):
+    """
+    Atomically record how far a job has got. Each job has its own progress
+    file, so no lock is needed as long as a job only runs in one process.
+
+    :param name: job name, eg. its output path
+    :param state: json serializable progress state
+    :return:
+    """
+    os.makedirs(progress_dir, exist_ok=True)
+    _atomic_write(_progress_path(name), json.dumps(state).encode())
+
+
+def load_progress(name: str) -> typing.Union[dict, None]:
+    """
+    Get the last progress recorded for a job, or None if it never started.
+
+    :param name:
+    :return:
+    """
+    try:
+        with open(_progress_path(name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
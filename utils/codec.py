@@ -0,0 +1,330 @@
+import collections
+import gzip
+import io
+import queue
+import threading
+import typing
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Extensions for each supported compression
+extensions = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def compression_for(filename: str) -> typing.Union[str, None]:
+    """
+    Figure out the compression of a file from its extension.
+
+    :param filename:
+    :return: gzip, zstd or None for uncompressed files
+    """
+    for compression, extension in extensions.items():
+        if filename.endswith(extension):
+            return compression
+    return None
+
+
+def _require_zstd():
+    if zstandard is None:
+        raise RuntimeError('zstd compression requires the zstandard package (pip install zstandard)')
+
+
+def read_ahead(iterable: typing.Iterable, depth: int = 4) -> typing.Iterator:
+    """
+    Consume an iterable in a background thread, keeping up to depth items
+    ready ahead of the caller. Useful for overlapping decompression (which
+    releases the GIL) with whatever the caller does with the data.
+
+    Exceptions raised by the iterable are re-raised in the caller.
+
+    :param iterable:
+    :param depth:
+    :return:
+    """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put((item, None))
+            items.put((done, None))
+        except BaseException as e:
+            items.put((done, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        # Unblock the producer if the caller stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+class GzipBlockWriter(io.RawIOBase):
+    """
+    pigz style parallel gzip writer.
+
+    Written data is cut into fixed size blocks that are compressed on a
+    thread pool, each as its own gzip member, and written out in order. The
+    result is an ordinary multi-member gzip file that any gzip reader can
+    decompress. zlib releases the GIL, so compression runs truly in parallel
+    with the writing thread.
+
+    flush() compresses and writes everything buffered so far, so after a
+    flush the underlying file always ends on a member boundary.
+    """
+
+    def __init__(self, raw: typing.BinaryIO, level: int = 6, block_size: int = 1 << 20, threads: int = 4):
+        """
+        :param raw: binary file to write compressed data to (left open on close)
+        :param level: zlib compression level
+        :param block_size: uncompressed bytes per gzip member
+        :param threads: number of compression threads
+        """
+        super(GzipBlockWriter, self).__init__()
+
+        self.raw = raw
+        self.level = level
+        self.block_size = block_size
+        self.block = bytearray()
+
+        # Compressed blocks in write order. At most two per thread are kept
+        # in flight to bound memory.
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = collections.deque()
+        self.max_pending = threads * 2
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.block += b
+        while len(self.block) >= self.block_size:
+            self._submit(bytes(self.block[:self.block_size]))
+            del self.block[:self.block_size]
+        return len(b)
+
+    def _submit(self, data: bytes):
+        self.pending.append(self.executor.submit(gzip.compress, data, self.level))
+
+        # Write out blocks that are done, waiting on the oldest if too many
+        # are in flight.
+        while len(self.pending) > self.max_pending or (self.pending and self.pending[0].done()):
+            self.raw.write(self.pending.popleft().result())
+
+    def flush(self):
+        if self.closed:
+            return
+        if len(self.block) > 0:
+            self._submit(bytes(self.block))
+            self.block = bytearray()
+        while self.pending:
+            self.raw.write(self.pending.popleft().result())
+        self.raw.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        # Closing flushes whatever is still buffered
+        super(GzipBlockWriter, self).close()
+        self.executor.shutdown()
+
+
+class ZstdWriter(io.RawIOBase):
+    """
+    zstd writer using the library's own worker threads. flush() ends the
+    current frame, so the underlying file always ends on a frame boundary
+    after a flush.
+    """
+
+    def __init__(self, raw: typing.BinaryIO, level: int = 3, threads: int = 4):
+        """
+        :param raw: binary file to write compressed data to (left open on close)
+        :param level: zstd compression level
+        :param threads: number of compression threads
+        """
+        super(ZstdWriter, self).__init__()
+        _require_zstd()
+
+        self.raw = raw
+        self.compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        self.writer = self.compressor.stream_writer(raw, closefd=False)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.writer.write(b)
+        return len(b)
+
+    def flush(self):
+        if self.closed:
+            return
+        self.writer.flush(zstandard.FLUSH_FRAME)
+        self.raw.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        # Closing flushes whatever is still buffered
+        super(ZstdWriter, self).close()
+        self.writer.close()
+
+
+def _gzip_chunks(raw: typing.BinaryIO, chunk_size: int) -> typing.Iterator[bytes]:
+    """
+    Decompress a (possibly multi-member) gzip stream.
+
+    :param raw:
+    :param chunk_size:
+    :return:
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    while True:
+        data = raw.read(chunk_size)
+        if len(data) == 0:
+            return
+        while len(data) > 0:
+            chunk = decompressor.decompress(data)
+            if len(chunk) > 0:
+                yield chunk
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            else:
+                data = b''
+
+
+def _zstd_chunks(raw: typing.BinaryIO, chunk_size: int) -> typing.Iterator[bytes]:
+    """
+    Decompress a (possibly multi-frame) zstd stream.
+
+    :param raw:
+    :param chunk_size:
+    :return:
+    """
+    _require_zstd()
+    reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)
+    while True:
+        chunk = reader.read(chunk_size)
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def _plain_chunks(raw: typing.BinaryIO, chunk_size: int) -> typing.Iterator[bytes]:
+    while True:
+        chunk = raw.read(chunk_size)
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class ReadAheadReader(io.RawIOBase):
+    """
+    Readable file object over decompressed data, where reading and
+    decompression happen in a background thread ahead of the consumer.
+    """
+
+    def __init__(self, raw: typing.BinaryIO, compression: str = None, chunk_size: int = 1 << 20, depth: int = 4):
+        """
+        :param raw: compressed binary file (closed along with the reader)
+        :param compression: gzip, zstd or None
+        :param chunk_size: compressed bytes to read at a time
+        :param depth: decompressed chunks to keep ready
+        """
+        super(ReadAheadReader, self).__init__()
+
+        chunks = {'gzip': _gzip_chunks, 'zstd': _zstd_chunks, None: _plain_chunks}[compression]
+        self.raw = raw
+        self.chunks = read_ahead(chunks(raw, chunk_size), depth)
+        self.chunk = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while len(self.chunk) == 0:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.chunk = memoryview(chunk)
+
+        n = min(len(b), len(self.chunk))
+        b[:n] = self.chunk[:n]
+        self.chunk = self.chunk[n:]
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self.chunks.close()
+        self.raw.close()
+        super(ReadAheadReader, self).close()
+
+
+def open_write(
+        raw: typing.BinaryIO,
+        compression: str = 'gzip',
+        level: int = None,
+        threads: int = 4,
+        block_size: int = 1 << 20,
+) -> io.RawIOBase:
+    """
+    Wrap a binary file in a threaded compressing writer.
+
+    :param raw: binary file to write compressed data to (left open on close)
+    :param compression: gzip or zstd
+    :param level: compression level, defaults to 6 for gzip and 3 for zstd
+    :param threads: compression threads
+    :param block_size: uncompressed bytes per gzip member
+    :return:
+    """
+    if compression == 'gzip':
+        return GzipBlockWriter(raw, level=6 if level is None else level, block_size=block_size, threads=threads)
+    if compression == 'zstd':
+        return ZstdWriter(raw, level=3 if level is None else level, threads=threads)
+    raise ValueError(f'unknown compression {compression}')
+
+
+def open_read(filename: str, mode: str = 'rb', chunk_size: int = 1 << 20, depth: int = 4) -> typing.IO:
+    """
+    Open a (compressed) file for reading, decompressing in a read-ahead
+    thread. The compression is picked from the file extension.
+
+    :param filename:
+    :param mode: rb or rt
+    :param chunk_size: compressed bytes to read at a time
+    :param depth: decompressed chunks to keep ready
+    :return:
+    """
+    reader = io.BufferedReader(
+        ReadAheadReader(open(filename, 'rb'), compression_for(filename), chunk_size, depth),
+        buffer_size=chunk_size,
+    )
+    if mode == 'rt':
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return reader
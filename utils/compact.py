@@ -0,0 +1,142 @@
+import typing
+
+import numpy as np
+
+# Bytes each slot takes: key hash, uid and reference bit
+slot_bytes = 8 + 8 + 1
+
+
+class CompactCache(object):
+    """
+    In memory uid cache over preallocated numpy arrays, sized by a byte
+    budget instead of an entry count.
+
+    Only the 64 bit hash of each key is stored, and values must be DGraph
+    uids ("0x1a2b"), which are kept as integers. The table is set
+    associative: a key's hash picks a bucket of ways slots, which is
+    searched in one go. When a bucket is full, CLOCK picks the slot to
+    evict: every slot has a reference bit that is set when the slot is
+    read or written, and a per bucket hand sweeps past referenced slots,
+    clearing their bit, until it finds one that wasn't used since the
+    last sweep.
+
+    Keys are hashed with Python's own string hash, so the table is only
+    meaningful within one process. Two keys with the same 64 bit hash
+    share a slot; with a few million keys that is vanishingly unlikely.
+    """
+
+    def __init__(self, max_bytes: int, ways: int = 8):
+        """
+        :param max_bytes: memory budget for the arrays
+        :param ways: slots per bucket
+        """
+        super(CompactCache, self).__init__()
+
+        self.ways = ways
+        self.buckets = max(1, max_bytes // (slot_bytes * ways))
+
+        # 0 marks an empty slot, so no key hashes to it, see _hash
+        self.keys = np.zeros((self.buckets, ways), dtype=np.uint64)
+        self.uids = np.zeros((self.buckets, ways), dtype=np.uint64)
+        self.referenced = np.zeros((self.buckets, ways), dtype=np.bool_)
+        self.hands = np.zeros(self.buckets, dtype=np.uint8)
+        self.count = 0
+
+    @property
+    def maxsize(self) -> int:
+        return self.buckets * self.ways
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _hash(self, keys: typing.List[str]) -> np.ndarray:
+        hashes = np.array([hash(key) for key in keys], dtype=np.int64).view(np.uint64)
+        hashes[hashes == 0] = 1
+        return hashes
+
+    def get_many(self, keys: typing.Iterable[str]) -> typing.List[typing.Union[str, None]]:
+        """
+        Look up many keys at once.
+
+        :param keys:
+        :return: the uid for each key, None for keys that are not cached
+        """
+        keys = list(keys)
+        if len(keys) == 0:
+            return []
+
+        hashes = self._hash(keys)
+        buckets = hashes % np.uint64(self.buckets)
+        matches = self.keys[buckets] == hashes[:, None]
+        found = matches.any(axis=1)
+        ways = matches.argmax(axis=1)
+
+        buckets, ways = buckets[found], ways[found]
+        self.referenced[buckets, ways] = True
+        uids = iter(self.uids[buckets, ways].tolist())
+        return [hex(next(uids)) if hit else None for hit in found.tolist()]
+
+    def get(self, key: str, default=None) -> typing.Union[str, None]:
+        uid = self.get_many([key])[0]
+        return default if uid is None else uid
+
+    def __getitem__(self, key: str) -> str:
+        uid = self.get(key)
+        if uid is None:
+            raise KeyError(key)
+        return uid
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def set_many(self, items: typing.Dict[str, str]):
+        """
+        Store many key uid pairs, evicting with CLOCK where buckets are full.
+
+        :param items: key -> uid
+        :return:
+        """
+        if len(items) == 0:
+            return
+
+        hashes = self._hash(list(items))
+        for h, uid in zip(hashes, items.values()):
+            bucket = int(h % np.uint64(self.buckets))
+            keys = self.keys[bucket]
+            referenced = self.referenced[bucket]
+
+            # The key itself, else an empty slot, else a CLOCK victim
+            way = np.flatnonzero(keys == h)
+            if len(way) == 0:
+                way = np.flatnonzero(keys == 0)
+                if len(way) > 0:
+                    self.count += 1
+            if len(way) == 0:
+                hand = int(self.hands[bucket])
+                order = (hand + np.arange(self.ways)) % self.ways
+                unreferenced = np.flatnonzero(~referenced[order])
+                if len(unreferenced) == 0:
+                    # Everything was used since the last sweep, go round
+                    # once clearing every bit and take the slot at the hand
+                    referenced[:] = False
+                    way = hand
+                else:
+                    referenced[order[:unreferenced[0]]] = False
+                    way = int(order[unreferenced[0]])
+                self.hands[bucket] = (way + 1) % self.ways
+            else:
+                way = int(way[0])
+
+            keys[way] = h
+            self.uids[bucket, way] = int(uid, 16)
+            referenced[way] = True
+
+    def __setitem__(self, key: str, uid: str):
+        self.set_many({key: uid})
+
+    def clear(self):
+        self.keys[:] = 0
+        self.uids[:] = 0
+        self.referenced[:] = False
+        self.hands[:] = 0
+        self.count = 0
@@ -1,8 +1,12 @@
+import json
 import random
+import threading
+import typing
 
 import pydgraph
 
 from utils.checkpoints import get_checkpoint, set_checkpoint
+from utils.metrics import timer
 
 schema = """
 asnnum: int @index(int) .
@@ -15,7 +19,7 @@ type ASN {
     domains
 }
 
-domain: string @index(trigram,exact) .
+domain: string @index(trigram,exact) @upsert .
 tld: string .
 ip: string .
 documents: [uid] @reverse .
@@ -28,8 +32,10 @@ type Domain {
 }
 
 path: string @index(term) .
+doc_key: string @index(exact) @upsert .
 type Document {
     path
+    doc_key
 }
 
 country_code: string @index(exact) .
@@ -47,6 +53,35 @@ type Root {
 """
 
 
+def lookup_uids(txn, keys: typing.List[typing.Tuple[str, str]]) -> typing.List[typing.Union[str, None]]:
+    """
+    Look up many nodes by an indexed predicate in a single query, one block
+    per key. Keys are passed as query variables, so they need no escaping.
+
+    :param txn: DGraph transaction, ideally read only
+    :param keys: (predicate, key) pairs
+    :return: the uid of the first node matching each pair, or None
+    """
+    if len(keys) == 0:
+        return []
+
+    params = []
+    blocks = []
+    variables = dict()
+    for i, (predicate, key) in enumerate(keys):
+        params.append(f"$k{i}: string")
+        blocks.append(f"  n{i}(func: eq({predicate}, $k{i}), first: 1) {{ uid }}")
+        variables[f"$k{i}"] = str(key)
+    query = "query q({}) {{\n{}\n}}".format(", ".join(params), "\n".join(blocks))
+
+    with timer("dgraph_seconds", call="query"):
+        found = json.loads(txn.query(query, variables=variables).json)
+    return [
+        found[f"n{i}"][0]["uid"] if len(found.get(f"n{i}", [])) > 0 else None
+        for i in range(len(keys))
+    ]
+
+
 class StubWrapper:
     """
     Very simple class for initializing and tracking DGraph connection stubs
@@ -94,6 +129,45 @@ def get_client():
     return pydgraph.DgraphClient(*client_stub.stubs), client_stub
 
 
+class Connection(object):
+    """
+    A DGraph client shared by several threads. When a thread finds the
+    connection dead it resets it; the other threads pick up the new client
+    the next time they start a transaction.
+    """
+
+    def __init__(self):
+        super(Connection, self).__init__()
+
+        self.lock = threading.Lock()
+        self.client, self.stub = get_client()
+
+    def txn(self) -> pydgraph.Txn:
+        """
+        Start a new transaction on the current client.
+
+        :return:
+        """
+        return self.client.txn()
+
+    def reset(self, client: pydgraph.DgraphClient):
+        """
+        Replace client with a fresh one on new stubs. If another thread
+        already replaced it, this does nothing.
+
+        :param client: the client that failed
+        :return:
+        """
+        with self.lock:
+            if client is not self.client:
+                return
+            self.stub.close()
+            self.client, self.stub = get_client()
+
+    def close(self):
+        self.stub.close()
+
+
 def drop_all(client):
     """
     This function drops all dgraph nodes, edges and schemas.
@@ -0,0 +1,351 @@
+import functools
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from ipaddress import ip_address
+
+from cachetools import LRUCache, TTLCache
+
+
+class HostsFileBackend(object):
+    """
+    Resolver backend that answers lookups from an /etc/hosts style file.
+
+    This is mostly useful for testing the resolver stage against a fixed
+    set of domains without touching the network.
+    """
+
+    def __init__(self, path: str):
+        """
+        Load the hosts file into memory.
+
+        :param path: path to a hosts file
+        """
+        super(HostsFileBackend, self).__init__()
+
+        self.hosts = dict()
+        with open(path) as f:
+            for line in f:
+                line = line.split('#', 1)[0].split()
+                if len(line) < 2:
+                    continue
+                for name in line[1:]:
+                    self.hosts.setdefault(name.lower(), line[0])
+
+    def __call__(self, domain: str) -> str:
+        """
+        Resolve a domain the same way socket.gethostbyname would.
+
+        :param domain:
+        :return:
+        """
+        try:
+            return self.hosts[domain.lower()]
+        except KeyError:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+
+# Marker for a domain the store knows nothing about (as opposed to a domain
+# the store knows does not resolve, which is None).
+MISSING = object()
+
+
+class DnsStore(object):
+    """
+    Persistent domain -> ip cache shared by every worker process.
+
+    Entries live in a sqlite database in WAL mode so that any number of
+    processes can read it concurrently while one of them writes. Each entry
+    carries an expiry time; domains that failed to resolve are stored with a
+    null ip and a shorter ttl. Writes are buffered and committed in batches.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS dns (
+        domain TEXT PRIMARY KEY,
+        ip TEXT,
+        expires REAL NOT NULL
+    )
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 86400., negative_ttl: float = 3600., batch_size: int = 1000):
+        """
+        Open (or create) the on-disk cache.
+
+        :param path: sqlite database file
+        :param ttl: seconds a resolved ip stays valid
+        :param negative_ttl: seconds a failed lookup stays valid
+        :param batch_size: number of buffered writes before committing
+        """
+        super(DnsStore, self).__init__()
+
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.batch_size = batch_size
+
+        self.db = sqlite3.connect(path, timeout=60.)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(self.schema)
+        self.db.commit()
+
+        self.writes = []
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, domain: str) -> typing.Union[str, None, object]:
+        """
+        Look up a domain. Returns the ip, None if the domain is known not to
+        resolve, or MISSING if there is no live entry for it.
+
+        :param domain:
+        :return:
+        """
+        row = self.db.execute('SELECT ip, expires FROM dns WHERE domain = ?', (domain,)).fetchone()
+        if row is None or row[1] < time.time():
+            self.misses += 1
+            return MISSING
+
+        self.hits += 1
+        return row[0]
+
+    def put(self, domain: str, ip: typing.Union[str, None]):
+        """
+        Buffer an answer for a domain. None records a failed lookup.
+
+        :param domain:
+        :param ip:
+        :return:
+        """
+        ttl = self.negative_ttl if ip is None else self.ttl
+        self.writes.append((domain, ip, time.time() + ttl))
+        if len(self.writes) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit buffered writes.
+
+        :return:
+        """
+        if len(self.writes) == 0:
+            return
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO dns (domain, ip, expires) VALUES (?, ?, ?)', self.writes)
+        self.writes = []
+
+    def close(self):
+        """
+        Flush outstanding writes and close the database.
+
+        :return:
+        """
+        self.flush()
+        self.db.close()
+
+
+class Resolver(object):
+    """
+    Concurrent DNS resolver stage.
+
+    Lookups are submitted to a bounded thread pool and handed back as futures
+    so the caller can keep parsing rows while lookups are pending. Distinct
+    domains are only ever resolved once at a time, successful answers are kept
+    in an LRU, and failed lookups (gaierror) are negatively cached for a while.
+
+    If a DnsStore is given, it is checked before going to the backend and every
+    answer from the backend is written back to it.
+    """
+
+    def __init__(
+            self,
+            backend: typing.Callable[[str], str] = socket.gethostbyname,
+            max_in_flight: int = 256,
+            timeout: float = 5.0,
+            cache_size: int = 100000,
+            negative_ttl: float = 3600.,
+            store: DnsStore = None,
+    ):
+        """
+        Initialize the resolver thread pool and caches.
+
+        :param backend: callable that takes a domain and returns an ip, raising
+                        socket.gaierror if the domain does not resolve
+        :param max_in_flight: maximum number of lookups running at once
+        :param timeout: seconds to wait on a single lookup before giving up
+        :param cache_size: number of resolved domains to keep in memory
+        :param negative_ttl: seconds to remember that a domain failed to resolve
+        :param store: optional persistent cache shared with other processes
+        """
+        super(Resolver, self).__init__()
+
+        self.backend = backend
+        self.timeout = timeout
+        self.store = store
+
+        # Answers from the backend, waiting to be written to the store. The
+        # lookup threads put them here, the submitting thread drains it.
+        self._answers = queue.SimpleQueue()
+
+        # Futures for every domain we have seen recently. Pending lookups
+        # live here too, so duplicate domains share a single lookup.
+        self._futures = LRUCache(maxsize=cache_size)
+
+        # Domains that raised gaierror. These expire after negative_ttl
+        # seconds so transient failures eventually get retried.
+        self._negative = TTLCache(maxsize=cache_size, ttl=negative_ttl)
+
+        # Bound the number of lookups that can be in flight at once. The
+        # submitting thread blocks once the limit is reached.
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    @staticmethod
+    def _done(value: typing.Union[str, None]) -> Future:
+        """
+        Wrap an already known answer in a completed future.
+
+        :param value:
+        :return:
+        """
+        future = Future()
+        future.set_result(value)
+        return future
+
+    def _release(self, domain: str, future: Future):
+        """
+        Free up an in-flight slot and queue the answer for the store.
+
+        :param domain:
+        :param future:
+        :return:
+        """
+        self._slots.release()
+
+        if self.store is None:
+            return
+        error = future.exception()
+        if error is None:
+            self._answers.put((domain, future.result()))
+        elif isinstance(error, socket.gaierror):
+            self._answers.put((domain, None))
+
+    def _save(self):
+        """
+        Write answers from finished lookups to the store.
+
+        :return:
+        """
+        while True:
+            try:
+                domain, ip = self._answers.get_nowait()
+            except queue.Empty:
+                return
+            self.store.put(domain, ip)
+
+    def submit(self, domain: str) -> Future:
+        """
+        Start resolving a domain, returning a future for its ip. Answers that
+        are already known come back as completed futures.
+
+        :param domain:
+        :return:
+        """
+
+        # Check the negative cache
+        if domain in self._negative:
+            self.hits += 1
+            return self._done(None)
+
+        # Check for a pending or completed lookup
+        future = self._futures.get(domain, None)
+        if future is not None:
+            self.hits += 1
+            return future
+
+        # Literal ip addresses resolve to themselves
+        try:
+            ip_address(domain)
+            future = self._done(domain)
+            self._futures[domain] = future
+            return future
+        except ValueError:
+            pass
+
+        # Check the persistent store
+        if self.store is not None:
+            if not self._answers.empty():
+                self._save()
+            ip = self.store.get(domain)
+            if ip is not MISSING:
+                future = self._done(ip)
+                self._futures[domain] = future
+                return future
+
+        # Cache miss, hand the lookup to the thread pool
+        self.misses += 1
+        self._slots.acquire()
+        future = self._executor.submit(self.backend, domain)
+        future.add_done_callback(functools.partial(self._release, domain))
+        self._futures[domain] = future
+        return future
+
+    def result(self, domain: str, future: Future, timeout: float = None) -> typing.Union[str, None]:
+        """
+        Wait for the future returned by submit. Returns None if the domain does
+        not resolve or the lookup timed out.
+
+        :param domain:
+        :param future:
+        :param timeout: override the per-lookup timeout
+        :return:
+        """
+        try:
+            return future.result(timeout=self.timeout if timeout is None else timeout)
+        except TimeoutError:
+            # Drop the lookup so the next occurrence of the domain tries again
+            self.timeouts += 1
+            self._futures.pop(domain, None)
+        except (socket.gaierror, socket.herror, UnicodeError):
+            self.failures += 1
+            self._negative[domain] = True
+            self._futures.pop(domain, None)
+        return None
+
+    def resolve(self, domain: str) -> typing.Union[str, None]:
+        """
+        Blocking lookup of a single domain.
+
+        :param domain:
+        :return:
+        """
+        return self.result(domain, self.submit(domain))
+
+    def flush(self):
+        """
+        Write answers from finished lookups through to the store.
+
+        :return:
+        """
+        if self.store is not None:
+            self._save()
+            self.store.flush()
+
+    def close(self):
+        """
+        Shut down the lookup thread pool and flush answers to the store.
+
+        :return:
+        """
+        self._executor.shutdown(wait=self.store is not None)
+        self.flush()
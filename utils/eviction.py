@@ -0,0 +1,377 @@
+import collections
+import hashlib
+import os
+import typing
+
+import numpy as np
+
+from utils.compact import CompactCache, slot_bytes
+
+# Rough bytes an entry takes in the caches below, which keep Python str
+# keys and values in OrderedDicts, used to turn a memory budget into a size
+object_entry_bytes = 256
+
+
+class Cache(object):
+    """
+    Base for the in memory caches of each eviction policy. Subclasses
+    implement get and __setitem__, the batch methods are built on those.
+    """
+
+    def __init__(self, maxsize: int):
+        super(Cache, self).__init__()
+        self.maxsize = max(1, maxsize)
+
+    def get(self, key, default=None):
+        raise NotImplementedError()
+
+    def __setitem__(self, key, value):
+        raise NotImplementedError()
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def get_many(self, keys: typing.Iterable) -> list:
+        return [self.get(key) for key in keys]
+
+    def set_many(self, items: dict):
+        for key, value in items.items():
+            self[key] = value
+
+
+class LRUCache(Cache):
+    """
+    Least recently used eviction.
+    """
+
+    def __init__(self, maxsize: int):
+        super(LRUCache, self).__init__(maxsize)
+        self.entries = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        value = self.entries.get(key, None)
+        if value is None:
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class ARCCache(Cache):
+    """
+    Adaptive replacement cache (Megiddo and Modha). Entries seen once (t1)
+    and entries seen again (t2) are kept in separate LRU lists, and the
+    split between them adapts to hits in the ghost lists b1 and b2, which
+    remember the keys recently evicted from each.
+    """
+
+    def __init__(self, maxsize: int):
+        super(ARCCache, self).__init__(maxsize)
+        self.t1 = collections.OrderedDict()
+        self.t2 = collections.OrderedDict()
+        self.b1 = collections.OrderedDict()
+        self.b2 = collections.OrderedDict()
+
+        # Target size of t1
+        self.p = 0.
+
+    def __len__(self) -> int:
+        return len(self.t1) + len(self.t2)
+
+    def get(self, key, default=None):
+        if key in self.t1:
+            value = self.t2[key] = self.t1.pop(key)
+            return value
+        if key in self.t2:
+            self.t2.move_to_end(key)
+            return self.t2[key]
+        return default
+
+    def _replace(self, in_b2: bool):
+        if len(self.t1) > 0 and (len(self.t1) > self.p or (in_b2 and len(self.t1) == self.p)):
+            key, _ = self.t1.popitem(last=False)
+            self.b1[key] = None
+        elif len(self.t2) > 0:
+            key, _ = self.t2.popitem(last=False)
+            self.b2[key] = None
+
+    def __setitem__(self, key, value):
+        if key in self.t1 or key in self.t2:
+            (self.t1 if key in self.t1 else self.t2)[key] = value
+            return
+
+        if key in self.b1:
+            self.p = min(self.maxsize, self.p + max(len(self.b2) / len(self.b1), 1))
+            self._replace(False)
+            del self.b1[key]
+            self.t2[key] = value
+            return
+
+        if key in self.b2:
+            self.p = max(0., self.p - max(len(self.b1) / len(self.b2), 1))
+            self._replace(True)
+            del self.b2[key]
+            self.t2[key] = value
+            return
+
+        if len(self.t1) + len(self.b1) >= self.maxsize:
+            if len(self.t1) < self.maxsize:
+                self.b1.popitem(last=False)
+                self._replace(False)
+            else:
+                self.t1.popitem(last=False)
+        else:
+            total = len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2)
+            if total >= self.maxsize:
+                if total >= 2 * self.maxsize:
+                    self.b2.popitem(last=False)
+                self._replace(False)
+        self.t1[key] = value
+
+    def clear(self):
+        for entries in [self.t1, self.t2, self.b1, self.b2]:
+            entries.clear()
+        self.p = 0.
+
+
+class FrequencySketch(object):
+    """
+    Count-min sketch of 4 bit counters estimating how often keys were seen.
+    Every counter is halved once 10 times the cache size increments have
+    happened, so old popularity fades.
+    """
+
+    def __init__(self, maxsize: int, depth: int = 4):
+        super(FrequencySketch, self).__init__()
+        self.width = 1 << max(4, int(maxsize - 1).bit_length())
+        self.depth = depth
+        self.counters = np.zeros((depth, self.width), dtype=np.uint8)
+        self.rows = np.arange(depth)
+        self.additions = 0
+        self.sample_size = 10 * maxsize
+
+        # Every row hashes the key with its own seed
+        self.seeds = np.arange(1, depth + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+
+    def _indexes(self, key) -> np.ndarray:
+        # splitmix64 finalizer of the key's hash plus each row's seed
+        h = (np.uint64(hash(key) & 0xFFFFFFFFFFFFFFFF) + self.seeds)
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        h ^= h >> np.uint64(31)
+        return (h & np.uint64(self.width - 1)).astype(np.int64)
+
+    def increment(self, key):
+        indexes = self._indexes(key)
+        counters = self.counters[self.rows, indexes]
+        self.counters[self.rows, indexes] = np.minimum(counters + 1, 15)
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.counters >>= 1
+            self.additions //= 2
+
+    def frequency(self, key) -> int:
+        return int(self.counters[self.rows, self._indexes(key)].min())
+
+
+class TinyLFUCache(Cache):
+    """
+    W-TinyLFU (Einziger et al., as in Caffeine). New entries go to a small
+    LRU window. Entries leaving the window only get into the main segmented
+    LRU by being seen more often than the entry they would evict, going by
+    a frequency sketch of every access. Scans and one off keys pass
+    through the window without flushing the main cache.
+    """
+
+    def __init__(self, maxsize: int, window: float = 0.01, protected: float = 0.8):
+        """
+        :param maxsize:
+        :param window: share of maxsize for the window
+        :param protected: share of the main cache for entries hit twice
+        """
+        super(TinyLFUCache, self).__init__(maxsize)
+        self.window_size = max(1, int(self.maxsize * window))
+        self.main_size = max(1, self.maxsize - self.window_size)
+        self.protected_size = max(1, int(self.main_size * protected))
+
+        self.window = collections.OrderedDict()
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+        self.sketch = FrequencySketch(self.maxsize)
+
+    def __len__(self) -> int:
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+    def get(self, key, default=None):
+        self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+            return self.window[key]
+        if key in self.protected:
+            self.protected.move_to_end(key)
+            return self.protected[key]
+        if key in self.probation:
+            # Promote, demoting the least recent protected entry if full
+            value = self.protected[key] = self.probation.pop(key)
+            if len(self.protected) > self.protected_size:
+                demoted, demoted_value = self.protected.popitem(last=False)
+                self.probation[demoted] = demoted_value
+            return value
+        return default
+
+    def __setitem__(self, key, value):
+        for entries in [self.window, self.probation, self.protected]:
+            if key in entries:
+                entries[key] = value
+                return
+
+        self.window[key] = value
+        if len(self.window) <= self.window_size:
+            return
+
+        # Admit the entry leaving the window to the main cache only if it
+        # is more popular than the one it would push out
+        candidate, candidate_value = self.window.popitem(last=False)
+        if len(self.probation) + len(self.protected) < self.main_size:
+            self.probation[candidate] = candidate_value
+            return
+        victims = self.probation if len(self.probation) > 0 else self.protected
+        victim = next(iter(victims))
+        if self.sketch.frequency(candidate) > self.sketch.frequency(victim):
+            del victims[victim]
+            self.probation[candidate] = candidate_value
+
+    def clear(self):
+        for entries in [self.window, self.probation, self.protected]:
+            entries.clear()
+        self.sketch = FrequencySketch(self.maxsize)
+
+
+# Eviction policies the caches can use for layer 1, by name. CLOCK is the
+# compact numpy cache, the others keep Python objects.
+policies = {
+    'clock': CompactCache,
+    'lru': LRUCache,
+    'arc': ARCCache,
+    'tinylfu': TinyLFUCache,
+}
+
+
+def _check_policy(policy: str):
+    if policy not in policies:
+        raise ValueError(f'unknown eviction policy {policy}, expected one of {", ".join(policies)}')
+
+
+def local_cache(policy: str, max_bytes: int):
+    """
+    Create an in memory cache with an eviction policy, within a memory budget.
+
+    :param policy: name of the policy, see policies
+    :param max_bytes:
+    :return:
+    """
+    _check_policy(policy)
+    if policy == 'clock':
+        return CompactCache(max_bytes)
+    return policies[policy](max_bytes // object_entry_bytes)
+
+
+def sized_cache(policy: str, entries: int):
+    """
+    Create an in memory cache with an eviction policy holding about entries
+    keys, for comparing policies at the same size.
+
+    :param policy: name of the policy, see policies
+    :param entries:
+    :return:
+    """
+    _check_policy(policy)
+    if policy == 'clock':
+        return CompactCache(entries * slot_bytes)
+    return policies[policy](entries)
+
+
+class TraceWriter(object):
+    """
+    Records the keys a cache is asked for, as a stream of 64 bit key hashes
+    appended to a file. Hashes are blake2b based, so traces from different
+    processes and runs can be replayed together.
+    """
+
+    def __init__(self, filename: str, buffer_size: int = 1 << 16):
+        """
+        :param filename:
+        :param buffer_size: hashes to collect before appending them to the file
+        """
+        super(TraceWriter, self).__init__()
+
+        self.filename = filename
+        self.buffer = []
+        self.buffer_size = buffer_size
+
+    def record(self, keys: typing.Iterable[str]):
+        self.buffer.extend(hashlib.blake2b(key.encode(), digest_size=8).digest() for key in keys)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        with open(self.filename, 'ab') as f:
+            f.write(b''.join(self.buffer))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+
+def trace_filename(directory: str, name: str) -> str:
+    """
+    File a process records the trace of a cache to.
+
+    :param directory:
+    :param name: cache node name
+    :return:
+    """
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'{name}.{os.getpid()}.trace')
+
+
+def read_trace(filename: str) -> np.ndarray:
+    """
+    Read the key hashes recorded by a TraceWriter.
+
+    :param filename:
+    :return:
+    """
+    return np.fromfile(filename, dtype=np.uint64)
+
+
+def simulate(trace: typing.Iterable[int], cache) -> float:
+    """
+    Replay a trace against a cache, inserting every key that misses.
+
+    :param trace: key hashes
+    :param cache: cache to fill, see sized_cache
+    :return: hit rate
+    """
+    hits = 0
+    total = 0
+    for key in trace:
+        total += 1
+        if cache.get(key) is not None:
+            hits += 1
+        else:
+            cache[key] = '0x1'
+    return hits / max(total, 1)
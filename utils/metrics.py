@@ -0,0 +1,301 @@
+import bisect
+import contextlib
+import glob
+import json
+import os
+import threading
+import time
+import typing
+
+# Upper bounds of the latency histogram buckets, in seconds
+buckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.]
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms of one process, keyed by metric name
+    and labels.
+
+    Recording is a dict update under an uncontended lock, cheap enough to
+    leave on. Each process writes its metrics to a file in a shared
+    directory every few seconds (see start_publishing), and an Exporter in
+    the main process adds up every worker's file.
+    """
+
+    def __init__(self):
+        super(Metrics, self).__init__()
+
+        self.lock = threading.Lock()
+
+        # (name, labels) -> value
+        self.counters = dict()
+
+        # (name, labels) -> [count per bucket..., count above the last, sum]
+        self.histograms = dict()
+
+        self.publisher = None
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.publisher = None
+
+    def count(self, name: str, value: float = 1, **labels):
+        """
+        Add to a counter.
+
+        :param name:
+        :param value:
+        :param labels:
+        :return:
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Record a latency in a histogram.
+
+        :param name:
+        :param seconds:
+        :param labels:
+        :return:
+        """
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(buckets) + 2)
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Record how long the body of a with statement takes.
+
+        :param name:
+        :param labels:
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), list(value)] for (name, labels), value in self.histograms.items()],
+            }
+
+    def publish(self, directory: str):
+        """
+        Write this process's metrics to its file in directory.
+
+        :param directory:
+        :return:
+        """
+        filename = os.path.join(directory, f'worker-{os.getpid()}.json')
+        tmp = f'{filename}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, filename)
+
+    def start_publishing(self, directory: str, interval: float = 5.):
+        """
+        Publish this process's metrics to directory every interval seconds
+        from a background thread. Calling this again in the same process
+        does nothing.
+
+        :param directory:
+        :param interval:
+        :return:
+        """
+        if self.publisher is not None:
+            return
+        os.makedirs(directory, exist_ok=True)
+
+        def publish():
+            while True:
+                time.sleep(interval)
+                self.publish(directory)
+
+        self.publisher = threading.Thread(target=publish, daemon=True)
+        self.publisher.start()
+
+
+# Metrics of this process. Forked workers start from scratch, instead of
+# counting everything the parent did before the fork again.
+metrics = Metrics()
+os.register_at_fork(after_in_child=metrics.reset)
+
+count = metrics.count
+observe = metrics.observe
+timer = metrics.timer
+publish = metrics.publish
+start_publishing = metrics.start_publishing
+
+
+def timed(iterable: typing.Iterable, name: str, **labels) -> typing.Iterator:
+    """
+    Iterate, recording how long each item took to come out of iterable,
+    eg. time spent waiting on a reader.
+
+    :param iterable:
+    :param name:
+    :param labels:
+    :return:
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        observe(name, time.perf_counter() - start, **labels)
+        yield item
+
+
+def _labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in sorted(labels.items())) + '}'
+
+
+def _quantile(histogram: typing.List[float], q: float) -> float:
+    # Upper bound of the bucket the quantile falls in
+    total = sum(histogram[:-1])
+    seen = 0
+    for bound, n in zip(buckets + [float('inf')], histogram[:-1]):
+        seen += n
+        if seen >= q * total:
+            return bound
+    return float('inf')
+
+
+class Exporter(object):
+    """
+    Adds up the metrics every process published to a directory, and writes
+    the totals every interval seconds as metrics.prom, in the Prometheus
+    text format (eg. for the node exporter's textfile collector), and as a
+    readable table in summary.txt.
+    """
+
+    def __init__(self, directory: str = 'metrics', interval: float = 5.):
+        """
+        :param directory: where the processes publish their metrics
+        :param interval: seconds between exports
+        """
+        super(Exporter, self).__init__()
+
+        self.directory = directory
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+        # Start from a clean slate, workers of earlier runs are gone
+        os.makedirs(directory, exist_ok=True)
+        for filename in glob.glob(os.path.join(directory, 'worker-*.json')):
+            os.remove(filename)
+
+    def collect(self) -> typing.Tuple[dict, dict]:
+        """
+        Add up every published file.
+
+        :return: counters, histograms, both keyed by (name, labels)
+        """
+        counters = dict()
+        histograms = dict()
+        for filename in glob.glob(os.path.join(self.directory, 'worker-*.json')):
+            try:
+                with open(filename) as f:
+                    snapshot = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(sorted(labels.items())))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in snapshot['histograms']:
+                key = (name, tuple(sorted(labels.items())))
+                total = histograms.setdefault(key, [0] * len(value))
+                for i, v in enumerate(value):
+                    total[i] += v
+        return counters, histograms
+
+    def prometheus(self, counters: dict, histograms: dict) -> str:
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f'# TYPE {name} counter')
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f'{name}{_labels(dict(labels))} {value}')
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f'# TYPE {name} histogram')
+            for (n, labels), value in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(buckets + ['+Inf'], value[:-1]):
+                    cumulative += bucket
+                    lines.append(f'{name}_bucket{_labels(dict(labels), le=bound)} {cumulative}')
+                lines.append(f'{name}_sum{_labels(dict(labels))} {value[-1]}')
+                lines.append(f'{name}_count{_labels(dict(labels))} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, counters: dict, histograms: dict) -> str:
+        lines = ['{:<60} {:>14}'.format('counter', 'value')]
+        for (name, labels), value in sorted(counters.items()):
+            lines.append('{:<60} {:>14.0f}'.format(name + _labels(dict(labels)), value))
+        lines.append('')
+        lines.append('{:<60} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('latency', 'count', 'total s', 'mean ms', 'p50 ms', 'p99 ms'))
+        for (name, labels), value in sorted(histograms.items()):
+            n = sum(value[:-1])
+            lines.append('{:<60} {:>10} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                name + _labels(dict(labels)), n, value[-1], value[-1] / max(n, 1) * 1000,
+                _quantile(value, 0.5) * 1000, _quantile(value, 0.99) * 1000,
+            ))
+        return '\n'.join(lines) + '\n'
+
+    def export(self) -> str:
+        """
+        Write metrics.prom and summary.txt from what has been published so far.
+
+        :return: the summary table
+        """
+        counters, histograms = self.collect()
+        summary = self.summary(counters, histograms)
+        for name, text in [('metrics.prom', self.prometheus(counters, histograms)), ('summary.txt', summary)]:
+            filename = os.path.join(self.directory, name)
+            with open(f'{filename}.tmp', 'w') as f:
+                f.write(text)
+            os.replace(f'{filename}.tmp', filename)
+        return summary
+
+    def start(self):
+        def run():
+            while not self.stopped.wait(self.interval):
+                publish(self.directory)
+                self.export()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> str:
+        """
+        Stop exporting, after a last export including this process.
+
+        :return: the final summary table
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        publish(self.directory)
+        return self.export()
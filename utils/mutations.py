@@ -0,0 +1,239 @@
+import typing
+
+from utils.dgraph import lookup_uids
+from utils.metrics import timer
+
+
+class MutationBatch(object):
+    """
+    Builder for a batch of nodes and edges that go to DGraph as a single
+    json mutation.
+
+    New nodes get blank node names (_:n0, _:n1, ...) that edges in the same
+    batch can reference before DGraph has assigned real uids. Each new node is
+    tracked by (kind, key), so a node that shows up many times in a batch is
+    only created once. Once the batch is mutated, the uid map DGraph hands
+    back is translated to {kind: {key: uid}} so callers can fill their caches
+    in bulk.
+
+    Nodes can also be upserted: instead of the caller knowing whether the
+    node exists, DGraph looks it up by an indexed predicate when the batch
+    is sent and only creates it if nothing matched. Upserted nodes get query
+    variables (uid(v0), uid(v1), ...) instead of blank node names, and the
+    whole batch goes out as a single upsert block.
+
+    Edges can also point at nodes that another batch, still in flight, is
+    creating. Such pending references are objects with a uid() method that
+    blocks until the node has a uid. Edges using them are held back and only
+    bound to real uids when the batch is mutated.
+    """
+
+    def __init__(self):
+        super(MutationBatch, self).__init__()
+
+        # Every object in the mutation, nodes and edges alike
+        self.objects = []
+
+        # (kind, key) -> blank node name for nodes created in this batch
+        self.created = dict()
+
+        # (kind, key) -> (query variable, predicate) for upserted nodes
+        self.upserted = dict()
+
+        # Edges with at least one pending end, (subject, predicate, target)
+        self.deferred = []
+
+    def __len__(self) -> int:
+        return len(self.objects)
+
+    def get(self, kind: str, key: str) -> typing.Union[str, None]:
+        """
+        Get the blank node reference of a node created earlier in this batch.
+
+        :param kind: node kind, eg. the cache node name
+        :param key:
+        :return: "_:nX", "uid(vX)" or None if the node is not part of the batch
+        """
+        name = self.created.get((kind, key), None)
+        if name is not None:
+            return "_:" + name
+        upserted = self.upserted.get((kind, key), None)
+        if upserted is not None:
+            return f"uid({upserted[0]})"
+        return None
+
+    def node(self, kind: str, key: str, obj: dict) -> str:
+        """
+        Add a new node to the batch, returning a reference to it that can be
+        used as a uid in edges. Adding the same (kind, key) twice returns the
+        existing reference.
+
+        :param kind: node kind, eg. the cache node name
+        :param key: key the node is cached under
+        :param obj: node predicates, without the uid
+        :return:
+        """
+        ref = self.get(kind, key)
+        if ref is not None:
+            return ref
+
+        name = f"n{len(self.created)}"
+        self.created[(kind, key)] = name
+        self.objects.append({"uid": "_:" + name, **obj})
+        return "_:" + name
+
+    def upsert(self, kind: str, key: str, predicate: str, obj: dict) -> str:
+        """
+        Add a node that DGraph looks up by predicate == key when the batch is
+        sent, creating it only if there is no match. If the node already
+        exists its predicates are set to those in obj. Adding the same
+        (kind, key) twice returns the existing reference.
+
+        The predicate should have an exact index and the @upsert directive,
+        so concurrent batches upserting the same node conflict instead of
+        both creating it.
+
+        :param kind: node kind, eg. the cache node name
+        :param key: value of predicate that identifies the node
+        :param predicate: indexed predicate to look the node up by
+        :param obj: node predicates, without the uid
+        :return:
+        """
+        ref = self.get(kind, key)
+        if ref is not None:
+            return ref
+
+        name = f"v{len(self.upserted)}"
+        self.upserted[(kind, key)] = (name, predicate)
+        self.objects.append({"uid": f"uid({name})", **obj})
+        return f"uid({name})"
+
+    def query(self) -> typing.Tuple[str, typing.Dict[str, str]]:
+        """
+        Build the query half of the upsert block, with one var block per
+        upserted node. Keys are passed as query variables rather than pasted
+        into the query, so they need no escaping.
+
+        :return: query, variables
+        """
+        params = []
+        blocks = []
+        variables = dict()
+        for i, ((_, key), (name, predicate)) in enumerate(self.upserted.items()):
+            params.append(f"$k{i}: string")
+            blocks.append(f"  {name} as var(func: eq({predicate}, $k{i}))")
+            variables[f"$k{i}"] = str(key)
+
+        query = "query q({}) {{\n{}\n}}".format(", ".join(params), "\n".join(blocks))
+        return query, variables
+
+    def edge(self, subject: str, predicate: str, target: str):
+        """
+        Add an edge between two nodes. Either end can be a real uid, a
+        reference returned by node or upsert, or a pending reference.
+
+        :param subject:
+        :param predicate:
+        :param target:
+        :return:
+        """
+        if not isinstance(subject, str) or not isinstance(target, str):
+            self.deferred.append((subject, predicate, target))
+            return
+
+        self.objects.append({
+            "uid": subject,
+            predicate: [
+                {"uid": target}
+            ],
+        })
+
+    def bind(self):
+        """
+        Turn deferred edges into ordinary ones, waiting for any pending ends
+        to get their uids. Edges to a node that never got a uid (because
+        the batch creating it failed) are dropped. The failed batch raises
+        its own error when the pipeline completes it, so no progress marker
+        gets past it and the rows behind the dropped edges are replayed.
+
+        :return:
+        """
+        deferred, self.deferred = self.deferred, []
+        for subject, predicate, target in deferred:
+            if not isinstance(subject, str):
+                subject = subject.uid()
+            if not isinstance(target, str):
+                target = target.uid()
+            if subject is not None and target is not None:
+                self.edge(subject, predicate, target)
+
+    def mutate(self, txn, commit_now: bool = False) -> typing.Dict[str, typing.Dict[str, str]]:
+        """
+        Send the whole batch as one mutation, or as one upsert block if any
+        nodes were upserted.
+
+        :param txn: DGraph transaction
+        :param commit_now: commit in the same round trip
+        :return: {kind: {key: uid}} for every node created by the batch,
+                 not including upserted nodes
+        """
+        self.bind()
+        if len(self.objects) == 0:
+            if commit_now:
+                txn.commit()
+            return dict()
+
+        if len(self.upserted) == 0:
+            with timer("dgraph_seconds", call="mutate"):
+                response = txn.mutate(set_obj=self.objects, commit_now=commit_now)
+        else:
+            query, variables = self.query()
+            request = txn.create_request(
+                query=query,
+                variables=variables,
+                mutations=[txn.create_mutation(set_obj=self.objects)],
+                commit_now=commit_now,
+            )
+            with timer("dgraph_seconds", call="upsert"):
+                response = txn.do_request(request)
+        return self.resolve(response.uids)
+
+    def find_created(self, txn, predicates: typing.Dict[str, str]) -> typing.Union[typing.Dict[str, typing.Dict[str, str]], None]:
+        """
+        Find out whether the batch was committed after a commit whose outcome
+        is unknown, eg. because the connection dropped before the reply came
+        back. Commits are atomic, so the batch only counts as committed if
+        every node it created exists. Some of them existing is not enough,
+        since another worker may have created the same keys (documents are
+        keyed by path, and domains are shared between files).
+
+        Only nodes of kinds in predicates can be looked up. A batch without
+        any such nodes is reported as not committed.
+
+        :param txn: DGraph transaction, ideally read only
+        :param predicates: node kind -> indexed predicate holding the node key
+        :return: {kind: {key: uid}} like mutate if the batch was committed,
+                 None if it was not
+        """
+        nodes = [(kind, key) for kind, key in self.created if kind in predicates]
+        uids = lookup_uids(txn, [(predicates[kind], key) for kind, key in nodes])
+
+        if len(nodes) == 0 or any(uid is None for uid in uids):
+            return None
+
+        resolved = dict()
+        for (kind, key), uid in zip(nodes, uids):
+            resolved.setdefault(kind, dict())[key] = uid
+        return resolved
+
+    def resolve(self, uids: typing.Mapping[str, str]) -> typing.Dict[str, typing.Dict[str, str]]:
+        """
+        Translate a DGraph blank node -> uid map to {kind: {key: uid}}.
+
+        :param uids:
+        :return:
+        """
+        resolved = dict()
+        for (kind, key), name in self.created.items():
+            resolved.setdefault(kind, dict())[key] = uids[name]
+        return resolved
@@ -0,0 +1,90 @@
+import glob
+import os
+import shutil
+import typing
+import zlib
+
+from utils.storage import dataset_name, open_writer, read_rows
+
+
+def partition_of(domain: str, partitions: int) -> int:
+    """
+    Pick the partition that owns a domain. crc32 is stable across processes
+    and runs, unlike the builtin hash.
+
+    :param domain:
+    :param partitions:
+    :return:
+    """
+    return zlib.crc32(domain.encode()) % partitions
+
+
+def partition_directory(directory: str, partitions: int) -> str:
+    """
+    Shards for different partition counts are kept apart, so changing the
+    count never mixes up shards that route domains differently.
+
+    :param directory:
+    :param partitions:
+    :return:
+    """
+    return os.path.join(directory, f'{partitions}-way')
+
+
+def partition_file(filename: str, directory: str, partitions: int, columns: typing.List[str], batch_size: int = 10000) -> int:
+    """
+    Split one preprocessed dataset into one shard per partition, routing each
+    row by its domain. Shards go to a temp directory that is renamed into
+    place once every shard is complete, and datasets that are already split
+    are skipped.
+
+    :param filename: preprocessed csv or parquet input
+    :param directory: base directory for the shards
+    :param partitions:
+    :param columns: columns to keep, must include domain
+    :param batch_size: rows to buffer per shard before writing
+    :return: number of rows split
+    """
+    output = os.path.join(partition_directory(directory, partitions), dataset_name(filename))
+    if os.path.exists(output):
+        return 0
+
+    tmp = f'{output}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    writers = [
+        open_writer(os.path.join(tmp, f'shard-{partition:03d}'), columns, threads=1)
+        for partition in range(partitions)
+    ]
+    buffers = [[] for _ in range(partitions)]
+
+    count = 0
+    for row in read_rows(filename, columns=columns):
+        partition = partition_of(row['domain'], partitions)
+        buffers[partition].append([row[column] for column in columns])
+        if len(buffers[partition]) >= batch_size:
+            writers[partition].write(buffers[partition])
+            buffers[partition] = []
+        count += 1
+
+    for writer, buffer in zip(writers, buffers):
+        writer.write(buffer)
+        writer.close()
+
+    os.replace(tmp, output)
+    print(f'partitioned {filename} ({count} rows)')
+    return count
+
+
+def shard_files(directory: str, partitions: int, partition: int) -> typing.List[str]:
+    """
+    Every shard that belongs to a partition, across all split datasets.
+
+    :param directory: base directory for the shards
+    :param partitions:
+    :param partition:
+    :return:
+    """
+    pattern = os.path.join(partition_directory(directory, partitions), '*', f'shard-{partition:03d}.csv.*')
+    return sorted(path for path in glob.glob(pattern) if not os.path.dirname(path).endswith('.tmp'))
@@ -0,0 +1,153 @@
+import collections
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from utils.metrics import timer
+from utils.mutations import MutationBatch
+
+
+class PendingNode(typing.NamedTuple):
+    """
+    Reference to a node that a batch in flight is creating. Usable as an
+    edge end in a MutationBatch.
+    """
+    kind: str
+    key: str
+    future: Future
+
+    def uid(self) -> typing.Union[str, None]:
+        """
+        Wait for the batch creating the node to commit. If it failed, its
+        error is raised by the pipeline when that batch completes, not
+        here, so the batches referring to the node can still commit.
+
+        :return: the node's uid, or None if the batch failed
+        """
+        if self.future.exception() is not None:
+            return None
+        return self.future.result().get(self.kind, {}).get(self.key, None)
+
+
+class CommitPipeline(object):
+    """
+    Commits mutation batches on a small thread pool, so the caller can build
+    the next batches (reading rows, looking up caches) while earlier ones
+    are still on their way to DGraph. At most max_in_flight batches are
+    committing at once; submit blocks once that many are outstanding.
+
+    Nodes created by a batch don't have uids until it commits. Until then
+    they are tracked here, and get hands out pending references to them
+    instead of letting the caller create them a second time. Pending
+    references are only waited on by the commit thread of the batch that
+    uses them, so building batches never blocks on DGraph.
+
+    Committed uids are written to the caches from the calling thread, in
+    submit order, so the caches are only ever touched by one thread.
+    """
+
+    def __init__(
+            self,
+            commit: typing.Callable[[MutationBatch], typing.Dict[str, typing.Dict[str, str]]],
+            caches: dict,
+            max_in_flight: int = 4,
+    ):
+        """
+        :param commit: mutates and commits a batch, returning {kind: {key: uid}}
+        :param caches: node kind -> cache for the nodes created by each batch
+        :param max_in_flight: number of batches committing at once
+        """
+        super(CommitPipeline, self).__init__()
+
+        self.commit = commit
+        self.caches = caches
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+        # (batch, future, on_commit) in submit order
+        self.in_flight = collections.deque()
+
+        # (kind, key) -> future of the batch creating that node
+        self.pending: typing.Dict[typing.Tuple[str, str], Future] = dict()
+
+    def __len__(self) -> int:
+        return len(self.in_flight)
+
+    def submit(self, batch: MutationBatch, on_commit: typing.Callable[[], typing.Any] = None):
+        """
+        Start committing a batch, waiting for the oldest batch first if
+        too many are in flight.
+
+        :param batch:
+        :param on_commit: called from the submitting thread once this batch
+                          and every batch submitted before it have committed
+        :return:
+        """
+        while len(self.in_flight) >= self.max_in_flight:
+            self._complete()
+
+        future = self.executor.submit(self._commit, batch)
+        for node in batch.created:
+            self.pending[node] = future
+        self.in_flight.append((batch, future, on_commit))
+
+        # Pick up anything that finished in the meantime
+        while len(self.in_flight) > 0 and self.in_flight[0][1].done():
+            self._complete()
+
+    def _commit(self, batch: MutationBatch) -> typing.Dict[str, typing.Dict[str, str]]:
+        with timer("stage_seconds", pipeline="ingest", stage="commit"):
+            return self.commit(batch)
+
+    def _complete(self):
+        """
+        Wait for the oldest batch, then cache the uids of the nodes it
+        created, flushing them to redis so other workers see them.
+
+        :return:
+        """
+        batch, future, on_commit = self.in_flight.popleft()
+        uids = future.result()
+        for kind, cache in self.caches.items():
+            cache.set_many(uids.get(kind, {}))
+            cache.flush()
+        for node in batch.created:
+            if self.pending.get(node, None) is future:
+                del self.pending[node]
+        if on_commit is not None:
+            on_commit()
+
+    def get(self, kind: str, key: str) -> typing.Union[str, PendingNode, None]:
+        """
+        Get a reference to a node that an in flight batch is creating.
+
+        :param kind:
+        :param key:
+        :return: the uid if the batch has already committed, a PendingNode
+                 if it hasn't, or None if no batch in flight creates the node
+                 (or the batch creating it failed)
+        """
+        future = self.pending.get((kind, key), None)
+        if future is None:
+            return None
+        node = PendingNode(kind, key, future)
+        if future.done():
+            return node.uid()
+        return node
+
+    def drain(self):
+        """
+        Wait for every batch in flight.
+
+        :return:
+        """
+        while len(self.in_flight) > 0:
+            self._complete()
+
+    def close(self):
+        """
+        Stop the commit threads. Batches still in flight are finished
+        first, but their uids are not cached.
+
+        :return:
+        """
+        self.executor.shutdown(wait=True)
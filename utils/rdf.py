@@ -0,0 +1,157 @@
+import hashlib
+import os
+import re
+import typing
+
+from cachetools import LRUCache
+
+from utils.codec import open_write
+
+
+def escape(value: str) -> str:
+    """
+    Escape a string for use as an N-Quad literal.
+
+    :param value:
+    :return:
+    """
+    return (
+        value
+        .replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
+def unescape(value: str) -> str:
+    """
+    Undo escape, for literals read back from N-Quads.
+
+    :param value:
+    :return:
+    """
+    return re.sub(r'\\(.)', lambda match: {'n': '\n', 'r': '\r', 't': '\t'}.get(match.group(1), match.group(1)), value)
+
+
+def literal(value: typing.Union[str, int]) -> str:
+    """
+    Format a value as an N-Quad literal. Integers are typed so that they
+    load into int predicates.
+
+    :param value:
+    :return:
+    """
+    if isinstance(value, int):
+        return f'"{value}"^^<xs:int>'
+    return f'"{escape(str(value))}"'
+
+
+# Deterministic blank node names for every node type in the schema. The same
+# node gets the same name in every file, so the bulk loader links them up.
+# Domains are hashed since they may contain characters that are not valid in
+# blank node names; documents are already keyed by the md5 of their path.
+
+def root_node() -> str:
+    return '_:root'
+
+
+def country_node(country_code: str) -> str:
+    return f'_:country.{country_code}'
+
+
+def asn_node(asnnum: typing.Union[str, int]) -> str:
+    return f'_:asn.{asnnum}'
+
+
+def domain_node(domain: str) -> str:
+    return '_:domain.' + hashlib.md5(domain.encode()).hexdigest()
+
+
+def document_node(doc_key: str) -> str:
+    return f'_:doc.{doc_key}'
+
+
+class RdfWriter(object):
+    """
+    Writes nodes and edges as gzip compressed N-Quads for the DGraph bulk
+    loader. The output goes to a temp file that is renamed into place on
+    close, so a file that exists is always complete.
+
+    Deduplication only covers the file being written, to keep shards small.
+    Root, country, asn and domain nodes are tracked exactly, documents go
+    through a bounded LRU since they are far too numerous for that. Nothing
+    is shared between writers: shards are written by separate processes, so
+    the same domain is written again in every shard it occurs in. That is
+    fine, since the bulk loader maps each blank node label to one uid across
+    all its input files and merges identical triples.
+    """
+
+    def __init__(self, filename: str, document_memory: int = 1000000, threads: int = 2):
+        """
+        :param filename: output .rdf.gz file
+        :param document_memory: number of recent documents to deduplicate against
+        :param threads: compression threads
+        """
+        super(RdfWriter, self).__init__()
+
+        self.filename = filename
+        self.tmp = f'{filename}.{os.getpid()}.tmp'
+        self.raw = open(self.tmp, 'wb')
+        self.file = open_write(self.raw, 'gzip', threads=threads)
+
+        self.seen = set()
+        self.seen_documents = LRUCache(maxsize=document_memory)
+        self.buffer = []
+
+    def _write(self, line: str):
+        self.buffer.append(line)
+        if len(self.buffer) >= 10000:
+            self.flush()
+
+    def node(self, name: str, dgraph_type: str, predicates: dict) -> bool:
+        """
+        Write a node with its type and predicates, unless it has already been
+        written.
+
+        :param name: blank node name
+        :param dgraph_type:
+        :param predicates: predicate -> value
+        :return: True if the node was written, False if it was a duplicate
+        """
+        if dgraph_type == 'Document':
+            if name in self.seen_documents:
+                return False
+            self.seen_documents[name] = True
+        else:
+            if name in self.seen:
+                return False
+            self.seen.add(name)
+
+        self._write(f'{name} <dgraph.type> "{dgraph_type}" .\n')
+        for predicate, value in predicates.items():
+            if value is None or value == '':
+                continue
+            self._write(f'{name} <{predicate}> {literal(value)} .\n')
+        return True
+
+    def edge(self, subject: str, predicate: str, target: str):
+        """
+        Write an edge between two nodes.
+
+        :param subject:
+        :param predicate:
+        :param target:
+        :return:
+        """
+        self._write(f'{subject} <{predicate}> {target} .\n')
+
+    def flush(self):
+        self.file.write(''.join(self.buffer).encode())
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.raw.close()
+        os.replace(self.tmp, self.filename)
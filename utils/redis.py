@@ -1,7 +1,37 @@
-from redis import Redis
+from redis import ConnectionPool, Redis
 
 from utils.checkpoints import get_checkpoint, set_checkpoint
 
+# Connection pools shared by every redis client in this process, by port.
+# redis-py notices when a pool was inherited through a fork and starts a
+# fresh one, so each worker process ends up with its own.
+pools = dict()
+
+
+def get_pool(port: int = 6379) -> ConnectionPool:
+    """
+    Get the connection pool for the redis instance on a port, creating it
+    on first use.
+
+    :param port:
+    :return:
+    """
+    pool = pools.get(port, None)
+    if pool is None:
+        pool = pools[port] = ConnectionPool(host="localhost", port=port)
+    return pool
+
+
+def get_redis(port: int = 6379) -> Redis:
+    """
+    Get a redis client using the shared connection pool. Clients are cheap,
+    connections are only opened by the pool as needed.
+
+    :param port:
+    :return:
+    """
+    return Redis(connection_pool=get_pool(port))
+
 
 def init_redis():
     if not get_checkpoint('redis-init'):
@@ -0,0 +1,153 @@
+import collections
+import random
+import threading
+import time
+import typing
+
+import grpc
+import pydgraph
+
+from utils.batching import BatchSizeController
+from utils.dgraph import Connection
+from utils.metrics import count
+from utils.mutations import MutationBatch
+
+# gRPC errors that can go away on a retry. Anything else, eg. a mutation
+# DGraph rejects as invalid, fails the same way every time.
+transient_codes = {
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.ABORTED,
+}
+
+
+class Committer(object):
+    """
+    Commits mutation batches, replaying them on a fresh transaction when
+    they fail. Safe to share between threads.
+
+    Aborts (transaction conflicts) are certain not to have committed
+    anything, so the batch is simply replayed after a jittered exponential
+    backoff. Connection errors are different: the commit may or may not
+    have gone through before the connection dropped. After one, the
+    connection is reset and the batch's nodes are looked up before
+    anything is replayed, so a batch is never applied twice. Other gRPC
+    errors, such as an invalid mutation, are raised straight away.
+
+    Nothing is written to the uid caches until a commit has succeeded, so
+    no cached uid can point at a node from a failed attempt.
+    """
+
+    def __init__(
+            self,
+            connection: Connection,
+            predicates: typing.Dict[str, str] = None,
+            max_attempts: int = 10,
+            base_delay: float = 0.05,
+            max_delay: float = 5.0,
+            controller: BatchSizeController = None,
+    ):
+        """
+        :param connection: DGraph connection, reset on connection errors
+        :param predicates: node kind -> indexed predicate holding the node key,
+                           used to check whether a batch was committed
+        :param max_attempts: give up on a batch after this many attempts
+        :param base_delay: backoff before the first retry, in seconds
+        :param max_delay: cap on the backoff, in seconds
+        :param controller: told the latency and aborts of every commit
+        """
+        super(Committer, self).__init__()
+
+        self.connection = connection
+        self.predicates = predicates or dict()
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.controller = controller
+
+        # commits, aborts, connection_errors, retries, recovered, failures
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+        count("dgraph_transactions_total", result=name)
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Full jitter exponential backoff. Spreading the retries out randomly
+        stops workers that conflicted with each other from conflicting again
+        on the replay.
+
+        :param attempt: number of attempts made so far
+        :return: seconds to wait
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def commit(self, batch: MutationBatch) -> typing.Dict[str, typing.Dict[str, str]]:
+        """
+        Mutate and commit a batch in a single round trip, retrying until it
+        goes through or max_attempts is reached.
+
+        :param batch:
+        :return: {kind: {key: uid}} for every node created by the batch
+        """
+        # Set when an attempt may have committed without us hearing back
+        uncertain = False
+        error = None
+        aborts = 0
+
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                self._count('retries')
+                time.sleep(self.backoff(attempt))
+
+            client = self.connection.client
+            try:
+                if uncertain:
+                    uids = batch.find_created(client.txn(read_only=True), self.predicates)
+                    if uids is not None:
+                        self._count('recovered')
+                        return uids
+                    uncertain = False
+
+                start = time.time()
+                uids = batch.mutate(client.txn(), commit_now=True)
+                self._count('commits')
+                if self.controller is not None:
+                    self.controller.record(len(batch), time.time() - start, aborts)
+                return uids
+
+            except (pydgraph.errors.AbortedError, pydgraph.errors.RetriableError) as e:
+                self._count('aborts')
+                aborts += 1
+                error = e
+
+            except grpc.RpcError as e:
+                code = e.code() if callable(getattr(e, 'code', None)) else None
+                if code not in transient_codes:
+                    self._count('failures')
+                    raise
+                if code == grpc.StatusCode.ABORTED:
+                    self._count('aborts')
+                    aborts += 1
+                else:
+                    self._count('connection_errors')
+                    self.connection.reset(client)
+                    uncertain = True
+                error = e
+
+            except pydgraph.errors.ConnectionError as e:
+                self._count('connection_errors')
+                self.connection.reset(client)
+                uncertain = True
+                error = e
+
+        self._count('failures')
+        raise error
+
+    def summary(self) -> str:
+        with self.lock:
+            return ' '.join(f'{name}={count}' for name, count in sorted(self.counts.items()))
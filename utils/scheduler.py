@@ -0,0 +1,217 @@
+import collections
+import multiprocessing as mp
+import os
+import time
+import typing
+import zlib
+
+# Every gzip member starts with these bytes (magic number + deflate)
+gzip_magic = b'\x1f\x8b\x08'
+
+
+class Job(typing.NamedTuple):
+    """
+    A unit of preprocessing work: a byte range of one input file. start and
+    end always fall on gzip member boundaries, so the range can be
+    decompressed on its own.
+    """
+    filename: str
+    part: typing.Union[int, None]
+    start: int
+    end: int
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start
+
+
+def is_member_start(f: typing.BinaryIO, offset: int, max_bytes: int = 1 << 26) -> bool:
+    """
+    Check that a complete, valid gzip member starts at offset. The member is
+    decompressed (and its crc checked) without keeping the output around.
+
+    :param f:
+    :param offset:
+    :param max_bytes: give up on members with more compressed bytes than this
+    :return:
+    """
+    f.seek(offset)
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    read = 0
+    try:
+        while not decompressor.eof:
+            data = f.read(1 << 16)
+            read += len(data)
+            if len(data) == 0 or read > max_bytes:
+                return False
+            decompressor.decompress(data)
+    except zlib.error:
+        return False
+    return True
+
+
+def find_member_start(f: typing.BinaryIO, offset: int, limit: int, window: int = 1 << 20) -> typing.Union[int, None]:
+    """
+    Find the first gzip member boundary at or after offset and before limit.
+    Files made of a single gzip member have no boundaries, so this returns
+    None for them.
+
+    :param f:
+    :param offset:
+    :param limit:
+    :param window:
+    :return:
+    """
+    position = offset
+    while position < limit:
+        f.seek(position)
+        data = f.read(window + len(gzip_magic) - 1)
+        index = data.find(gzip_magic)
+        while index != -1 and position + index < limit:
+            if is_member_start(f, position + index):
+                return position + index
+            index = data.find(gzip_magic, index + 1)
+        if len(data) < window:
+            break
+        position += window
+    return None
+
+
+def split_file(filename: str, chunk_size: int) -> typing.List[Job]:
+    """
+    Split a (multi-member) gzip file into jobs of roughly chunk_size
+    compressed bytes. Files that can't be split become a single job.
+
+    :param filename:
+    :param chunk_size:
+    :return:
+    """
+    size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, 'rb') as f:
+        while boundaries[-1] + chunk_size < size:
+            boundary = find_member_start(f, boundaries[-1] + chunk_size, size)
+            if boundary is None:
+                break
+            boundaries.append(boundary)
+    boundaries.append(size)
+
+    if len(boundaries) == 2:
+        return [Job(filename, None, 0, size)]
+    return [
+        Job(filename, part, start, end)
+        for part, (start, end) in enumerate(zip(boundaries[:-1], boundaries[1:]))
+    ]
+
+
+def plan_jobs(filenames: typing.List[str], chunk_size: int = 1 << 27) -> typing.List[Job]:
+    """
+    Split input files into jobs, largest first so that the big ones are
+    not left running at the end while the rest of the pool sits idle.
+
+    :param filenames:
+    :param chunk_size:
+    :return:
+    """
+    jobs = []
+    for filename in filenames:
+        jobs.extend(split_file(filename, chunk_size))
+    return sorted(jobs, key=lambda job: job.size, reverse=True)
+
+
+def read_job(job: Job, start: int = None, read_size: int = 1 << 20) -> typing.Iterator[typing.Tuple[typing.List[bytes], typing.Union[int, None]]]:
+    """
+    Stream the decompressed lines of a job's byte range, member by member.
+
+    Along with each batch of lines this yields a resume offset: the position
+    in the file from which read_job(job, start=offset) picks up with exactly
+    the lines that come after this batch. Resume offsets only exist at gzip
+    member boundaries that fall between lines; elsewhere the offset is None.
+
+    :param job:
+    :param start: resume offset to start reading from instead of job.start
+    :param read_size: compressed bytes to read at a time
+    :return:
+    """
+    position = job.start if start is None else start
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    compressed = b''
+    partial = b''
+
+    with open(job.filename, 'rb') as f:
+        f.seek(position)
+        while True:
+            if len(compressed) == 0:
+                compressed = f.read(min(read_size, job.end - position))
+                position += len(compressed)
+                if len(compressed) == 0:
+                    break
+
+            data = partial + decompressor.decompress(compressed)
+            if decompressor.eof:
+                # End of a member. Whatever is left over belongs to the next one.
+                compressed = decompressor.unused_data
+                boundary = position - len(compressed)
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            else:
+                compressed = b''
+                boundary = None
+
+            cut = data.rfind(b'\n') + 1
+            partial = data[cut:]
+            yield data[:cut].splitlines(keepends=True), boundary if len(partial) == 0 else None
+
+    if len(partial) > 0:
+        yield [partial], None
+
+
+def _timed(task: typing.Tuple[typing.Callable, Job]) -> typing.Tuple[int, float]:
+    """
+    Run one job, returning which process ran it and for how long.
+
+    :param task:
+    :return:
+    """
+    func, job = task
+    start = time.time()
+    func(job)
+    return os.getpid(), time.time() - start
+
+
+def run_jobs(
+        func: typing.Callable[[Job], typing.Any],
+        jobs: typing.List[Job],
+        processes: int = None,
+        initializer: typing.Callable = None,
+        initargs: tuple = (),
+):
+    """
+    Run func over jobs in a process pool. Jobs are handed out one at a time,
+    in order, as workers become free. Prints how busy each worker was once
+    everything is done.
+
+    :param func: function to run on each job, must be picklable
+    :param jobs:
+    :param processes: pool size, defaults to the number of cores
+    :param initializer: called once in each worker process before any jobs
+    :param initargs: arguments for initializer
+    :return:
+    """
+    processes = max(1, min(processes or os.cpu_count(), len(jobs)))
+    busy = collections.Counter()
+    done = collections.Counter()
+
+    start = time.time()
+    with mp.Pool(processes=processes, initializer=initializer, initargs=initargs) as pool:
+        tasks = [(func, job) for job in jobs]
+        for pid, elapsed in pool.imap_unordered(_timed, tasks, chunksize=1):
+            busy[pid] += elapsed
+            done[pid] += 1
+        pool.close()
+    wall = time.time() - start
+
+    print('Finished {} jobs in {:.2f} hrs with {} processes'.format(len(jobs), wall / 3600., processes))
+    for pid in sorted(busy):
+        print('  worker {:>7} {:>4} jobs {:>8.2f} hrs busy {:>6.1%} utilization'.format(
+            pid, done[pid], busy[pid] / 3600., busy[pid] / wall,
+        ))
@@ -0,0 +1,38 @@
+import os
+import shutil
+import typing
+
+import numpy as np
+
+
+def save_arrays(path: str, arrays: typing.Dict[str, np.ndarray]):
+    """
+    Write numpy arrays to a snapshot directory, one .npy file per array.
+    Files are written under a temporary directory first and moved into
+    place, so a snapshot is never left half written.
+
+    :param path: snapshot directory
+    :param arrays: name -> array
+    :return:
+    """
+    tmp = path + '.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), array, allow_pickle=False)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+
+
+def load_arrays(path: str, names: typing.Iterable[str]) -> typing.List[np.ndarray]:
+    """
+    Memory map the arrays of a snapshot written by save_arrays, so every
+    process loading it shares the same pages.
+
+    :param path: snapshot directory
+    :param names: arrays to load
+    :return: the arrays, in the order of names
+    """
+    return [
+        np.load(os.path.join(path, name + '.npy'), mmap_mode='r', allow_pickle=False)
+        for name in names
+    ]
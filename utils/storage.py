@@ -0,0 +1,369 @@
+import collections
+import csv
+import io
+import itertools
+import os
+import shutil
+import typing
+
+import fastparquet
+import numpy as np
+import pandas as pd
+
+from utils.codec import extensions, open_read, open_write
+
+# Preprocessed column types for the parquet output. Low cardinality text
+# columns are dictionary encoded, numeric ones are stored as integers with -1
+# standing in for missing values. Everything else is plain text.
+categorical_columns = ['country', 'asn_org', 'tld', 'mime']
+integer_columns = ['asn_num', 'status', 'length']
+
+# Value used for rows that have nothing in the partition column, since
+# partitioned writes silently drop rows with a null partition value.
+unknown_partition = 'unknown'
+
+
+class CsvWriter(object):
+    """
+    Row writer for compressed csv output. Compression runs on background
+    threads (see utils.codec).
+
+    A checkpoint flushes the compressor, so the file up to a checkpoint is
+    always a complete gzip (or zstd) stream. Resuming truncates whatever was
+    written after the last checkpoint.
+    """
+
+    def __init__(
+            self,
+            filename: str,
+            columns: typing.List[str],
+            resume: dict = None,
+            compression: str = 'gzip',
+            level: int = None,
+            threads: int = 4,
+    ):
+        """
+        Open the output file and write the header.
+
+        :param filename:
+        :param columns:
+        :param resume: state from checkpoint to continue from
+        :param compression: gzip or zstd
+        :param level: compression level
+        :param threads: compression threads
+        """
+        super(CsvWriter, self).__init__()
+
+        self.filename = filename
+        if resume is None:
+            self.raw = open(filename, 'wb')
+        else:
+            self.raw = open(filename, 'r+b')
+            self.raw.truncate(resume['size'])
+            self.raw.seek(resume['size'])
+
+        self.compressor = open_write(self.raw, compression, level=level, threads=threads)
+        self.file = io.TextIOWrapper(self.compressor, encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        if resume is None:
+            self.writer.writerow(columns)
+
+    def write(self, rows: typing.List[list]):
+        """
+        Write a batch of rows.
+
+        :param rows:
+        :return:
+        """
+        self.writer.writerows(rows)
+
+    def checkpoint(self) -> dict:
+        """
+        Make everything written so far durable.
+
+        :return: state to resume from
+        """
+        self.file.flush()
+        self.compressor.flush()
+        os.fsync(self.raw.fileno())
+        return {'size': self.raw.tell()}
+
+    def close(self):
+        self.file.close()
+        self.raw.close()
+
+
+class ParquetWriter(object):
+    """
+    Row writer for typed parquet output. Each call to write appends one row
+    group to a hive style dataset directory, optionally partitioned by a
+    column (eg. country or tld).
+
+    A checkpoint records the data files in the dataset. Resuming deletes any
+    files written after that and rebuilds the dataset metadata.
+    """
+
+    def __init__(self, path: str, columns: typing.List[str], partition_on: str = None, resume: dict = None):
+        """
+        :param path: dataset directory
+        :param columns:
+        :param partition_on: optional column to partition the dataset by
+        :param resume: state from checkpoint to continue from
+        """
+        super(ParquetWriter, self).__init__()
+
+        self.filename = path
+        self.columns = columns
+        self.partition_on = partition_on
+        self.started = False
+
+        if resume is not None and len(resume['parts']) > 0:
+            keep = set(resume['parts'])
+            for part in self._parts():
+                if part not in keep:
+                    os.remove(os.path.join(path, part))
+            # Rooted at the dataset, or merge writes the metadata next to
+            # the parts when they all sit in one partition. The root is made
+            # absolute by fastparquet, so the parts have to be too.
+            root = os.path.abspath(path)
+            fastparquet.writer.merge([os.path.join(root, part) for part in resume['parts']], root=root)
+            self.started = True
+        elif os.path.exists(path):
+            shutil.rmtree(path)
+
+    def _parts(self) -> typing.List[str]:
+        """
+        Data files in the dataset, relative to its directory.
+
+        :return:
+        """
+        parts = []
+        for root, _, files in os.walk(self.filename):
+            for name in files:
+                if name.endswith('.parquet'):
+                    parts.append(os.path.relpath(os.path.join(root, name), self.filename))
+        return sorted(parts)
+
+    def frame(self, rows: typing.List[list]) -> pd.DataFrame:
+        """
+        Build a typed DataFrame from a batch of rows.
+
+        :param rows:
+        :return:
+        """
+        df = pd.DataFrame(rows, columns=self.columns)
+
+        for column in integer_columns:
+            df[column] = pd.to_numeric(df[column], errors='coerce').fillna(-1).astype(np.int64)
+
+        if self.partition_on is not None:
+            df[self.partition_on] = df[self.partition_on].fillna(unknown_partition)
+
+        for column in categorical_columns:
+            df[column] = df[column].astype('category')
+
+        return df
+
+    def write(self, rows: typing.List[list]):
+        """
+        Write a batch of rows as a new row group.
+
+        :param rows:
+        :return:
+        """
+        fastparquet.write(
+            self.filename,
+            self.frame(rows),
+            file_scheme='hive',
+            partition_on=[self.partition_on] if self.partition_on is not None else [],
+            append=self.started,
+            object_encoding='utf8',
+            compression='SNAPPY',
+            stats=False,
+        )
+        self.started = True
+
+    def checkpoint(self) -> dict:
+        """
+        Row groups are complete once write returns, so just record them.
+
+        :return: state to resume from
+        """
+        return {'parts': self._parts()}
+
+    def close(self):
+        pass
+
+
+def open_writer(
+        name: str,
+        columns: typing.List[str],
+        output_format: str = 'csv',
+        partition_on: str = None,
+        resume: dict = None,
+        compression: str = 'gzip',
+        level: int = None,
+        threads: int = 4,
+):
+    """
+    Open a writer for the output format. The name should not include an
+    extension; .csv.gz, .csv.zst or .parquet is added for you.
+
+    :param name:
+    :param columns:
+    :param output_format: csv or parquet
+    :param partition_on: column to partition parquet output by
+    :param resume: state from the writer's checkpoint to continue from
+    :param compression: csv compression, gzip or zstd
+    :param level: csv compression level
+    :param threads: csv compression threads
+    :return:
+    """
+    if output_format == 'csv':
+        return CsvWriter(
+            name + '.csv' + extensions[compression], columns,
+            resume=resume, compression=compression, level=level, threads=threads,
+        )
+    if output_format == 'parquet':
+        return ParquetWriter(name + '.parquet', columns, partition_on=partition_on, resume=resume)
+    raise ValueError(f'unknown output format {output_format}')
+
+
+def is_dataset(filename: str) -> bool:
+    """
+    Check whether a path is preprocessed output we know how to read.
+
+    :param filename:
+    :return:
+    """
+    return filename.endswith(('.csv.gz', '.csv.zst', '.parquet'))
+
+
+def dataset_name(filename: str) -> str:
+    """
+    Name of a preprocessed output without its directory or extension.
+
+    :param filename:
+    :return:
+    """
+    name = os.path.basename(os.path.normpath(filename))
+    for extension in ('.csv.gz', '.csv.zst', '.parquet'):
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def parquet_row_groups(filename: str, columns: typing.List[str] = None, start: int = 0) -> typing.Iterator[typing.Tuple[pd.DataFrame, int]]:
+    """
+    Read a parquet dataset one row group at a time, from the row group
+    holding row start on. Whole row groups before start are skipped
+    without reading them.
+
+    :param filename: .parquet dataset
+    :param columns: columns to read, None for all of them
+    :param start: number of rows to skip
+    :return: (row group, number of its leading rows to skip)
+    """
+    dataset = fastparquet.ParquetFile(filename)
+
+    groups = 0
+    skipped = 0
+    for row_group in dataset.row_groups:
+        if skipped + row_group.num_rows > start:
+            break
+        skipped += row_group.num_rows
+        groups += 1
+    if groups == len(dataset.row_groups):
+        return
+    if groups > 0:
+        dataset = dataset[groups:]
+
+    for df in dataset.iter_row_groups(columns=columns):
+        yield df, start - skipped
+        skipped = start
+
+
+def read_rows(filename: str, columns: typing.List[str] = None, start: int = 0) -> typing.Iterator[dict]:
+    """
+    Stream rows from preprocessed output as dicts of strings, the way
+    csv.DictReader would. Parquet datasets only read the columns asked for.
+
+    :param filename: .csv.gz or .csv.zst file, or .parquet dataset
+    :param columns: columns to read, None for all of them
+    :param start: number of rows to skip
+    :return:
+    """
+    if filename.endswith('.parquet'):
+        for df, skip in parquet_row_groups(filename, columns, start):
+            df = df.iloc[skip:]
+            # Match csv, where everything is text and missing values are empty
+            df = df.astype(str).where(df.notna(), '')
+            yield from df.to_dict('records')
+        return
+
+    with open_read(filename, 'rt') as f:
+        reader = csv.DictReader(f)
+
+        # Skipped rows still have to be parsed, since a row can span lines,
+        # but they aren't turned into dicts
+        if start > 0 and reader.fieldnames is not None:
+            collections.deque(itertools.islice(reader.reader, start), maxlen=0)
+
+        for row in reader:
+            if columns is not None:
+                row = {column: row[column] for column in columns}
+            yield row
+
+
+def read_frames(
+        filename: str,
+        columns: typing.List[str] = None,
+        chunk_size: int = 1 << 16,
+        start: int = 0,
+) -> typing.Iterator[pd.DataFrame]:
+    """
+    Stream preprocessed output as DataFrames of up to chunk_size rows, for
+    callers that work on whole columns rather than row by row. Every column
+    is text with missing values as empty strings, same as read_rows.
+
+    :param filename: .csv.gz or .csv.zst file, or .parquet dataset
+    :param columns: columns to read, None for all of them
+    :param chunk_size: rows per frame
+    :param start: number of rows to skip
+    :return:
+    """
+    if filename.endswith('.parquet'):
+        for df, skip in parquet_row_groups(filename, columns, start):
+            df = df.iloc[skip:]
+            df = df.astype(str).where(df.notna(), '').reset_index(drop=True)
+            for offset in range(0, len(df), chunk_size):
+                yield df.iloc[offset:offset + chunk_size]
+        return
+
+    with open_read(filename, 'rb') as f:
+        frames = pd.read_csv(f, usecols=columns, dtype=str, keep_default_na=False, chunksize=chunk_size)
+
+        # Skipped rows are still parsed, since a row can span lines, but
+        # only in pandas' C parser
+        skipped = 0
+        for df in frames:
+            if skipped < start:
+                df = df.iloc[start - skipped:]
+                skipped += min(start - skipped, chunk_size)
+                if len(df) == 0:
+                    continue
+            yield df if columns is None else df[columns]
+
+
+def list_datasets(directory: str) -> typing.List[str]:
+    """
+    List the preprocessed outputs in a directory.
+
+    :param directory:
+    :return:
+    """
+    return [
+        os.path.join(directory, path)
+        for path in sorted(os.listdir(directory))
+        if is_dataset(path)
+    ]
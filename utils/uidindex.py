@@ -0,0 +1,346 @@
+import fcntl
+import glob
+import hashlib
+import math
+import os
+import re
+import shutil
+import time
+import typing
+
+import numpy as np
+
+from utils.codec import open_read
+from utils.rdf import unescape
+
+# A triple with a literal object in a DGraph export, <0x1> <predicate> "value"
+export_triple = re.compile(r'^<(0x[0-9a-f]+)> <([^>]+)> "((?:[^"\\]|\\.)*)"')
+
+# Bytes reserved for the .npy header of a merged run, so the row count can
+# be filled in once the merge is done
+header_size = 128
+
+
+def npy_header(rows: int) -> bytes:
+    """
+    Version 1.0 .npy header for a run of rows, padded to header_size bytes.
+
+    :param rows:
+    :return:
+    """
+    header = repr({'descr': '<u8', 'fortran_order': False, 'shape': (rows, 3)})
+    header = header.ljust(header_size - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+
+class UidIndex(object):
+    """
+    Persistent key -> uid index on local disk, shared by every worker.
+
+    The index is a directory of sorted runs. A run is a .npy array of
+    (hash high, hash low, uid) rows sorted by the 128 bit blake2b hash of
+    the key, so a lookup is a binary search per run. Runs are memory
+    mapped, so all workers share the same pages, and they survive
+    restarts.
+
+    Each worker buffers the keys it adds and writes them out as a new run
+    once run_size of them have piled up. Other workers pick new runs up
+    when they refresh, at most every refresh_interval seconds. Whenever
+    fanout runs of about the same size exist they are merged into one
+    (size tiered compaction), so the number of runs to search stays
+    logarithmic. A run file is never changed once written: merges write a
+    new run, then delete their inputs, and readers still mapping a deleted
+    run keep reading it until they refresh.
+
+    The index outlives the graph it was built against. After dropping the
+    DGraph data, remove the index directory or rebuild it from an export.
+    """
+
+    def __init__(self, directory: str, run_size: int = 1 << 16, refresh_interval: float = 10., fanout: int = 4):
+        """
+        :param directory: where the runs are kept, one directory per node kind
+        :param run_size: added keys to buffer before writing them as a run
+        :param refresh_interval: seconds between looking for new runs
+        :param fanout: runs of a size tier that get merged
+        """
+        super(UidIndex, self).__init__()
+
+        self.directory = directory
+        self.run_size = run_size
+        self.refresh_interval = refresh_interval
+        self.fanout = fanout
+        os.makedirs(directory, exist_ok=True)
+
+        # Keys added but not written to a run yet, key -> uid
+        self.added = dict()
+
+        # Run filename -> memory mapped rows, newest first
+        self.runs = dict()
+        self.last_refresh = 0.
+        self.refresh()
+
+    def __len__(self) -> int:
+        return sum(len(run) for run in self.runs.values()) + len(self.added)
+
+    @staticmethod
+    def _hash(keys: typing.List[str]) -> np.ndarray:
+        digests = b''.join(hashlib.blake2b(str(key).encode(), digest_size=16).digest() for key in keys)
+        return np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+
+    def refresh(self):
+        """
+        Map runs written since the last refresh and forget merged ones.
+
+        :return:
+        """
+        runs = dict()
+        for filename in sorted(glob.glob(os.path.join(self.directory, 'run-*.npy')), reverse=True):
+            run = self.runs.get(filename, None)
+            if run is None:
+                try:
+                    run = np.load(filename, mmap_mode='r', allow_pickle=False)
+                except FileNotFoundError:
+                    # Merged away since the listing, the merged run has its keys
+                    continue
+            runs[filename] = run
+        self.runs = runs
+        self.last_refresh = time.time()
+
+    def get_many(self, keys: typing.Iterable[str]) -> typing.List[typing.Union[str, None]]:
+        """
+        Look up many keys, with one binary search per run for all of them.
+
+        :param keys:
+        :return: the uid for each key, None for keys that are not in the index
+        """
+        keys = list(keys)
+        if time.time() - self.last_refresh >= self.refresh_interval:
+            self.refresh()
+
+        values = [self.added.get(key, None) for key in keys]
+        missing = np.asarray([i for i, value in enumerate(values) if value is None], dtype=np.int64)
+        if len(missing) == 0 or len(self.runs) == 0:
+            return values
+
+        hashes = self._hash([keys[i] for i in missing])
+        for run in self.runs.values():
+            if len(missing) == 0:
+                break
+            if len(run) == 0:
+                continue
+
+            # Rows with the same high half are next to each other, walk
+            # forward through them until the low half matches
+            index = np.searchsorted(run[:, 0], hashes[:, 0])
+            found = np.zeros(len(missing), dtype=np.bool_)
+            candidates = np.flatnonzero(index < len(run))
+            while len(candidates) > 0:
+                rows = run[index[candidates]]
+                same_high = rows[:, 0] == hashes[candidates, 0]
+                hit = same_high & (rows[:, 1] == hashes[candidates, 1])
+                found[candidates[hit]] = True
+                candidates = candidates[same_high & ~hit]
+                index[candidates] += 1
+                candidates = candidates[index[candidates] < len(run)]
+
+            hits = np.flatnonzero(found)
+            for i, uid in zip(missing[hits].tolist(), run[index[hits], 2].tolist()):
+                values[i] = hex(uid)
+            missing = missing[~found]
+            hashes = hashes[~found]
+
+        return values
+
+    def __getitem__(self, key: str) -> typing.Union[str, None]:
+        return self.get_many([key])[0]
+
+    def __contains__(self, key: str) -> bool:
+        return self[key] is not None
+
+    def set_many(self, items: typing.Dict[str, str]):
+        """
+        Add many key uid pairs, writing a run once enough have piled up.
+
+        :param items: key -> uid
+        :return:
+        """
+        self.added.update(items)
+        if len(self.added) >= self.run_size:
+            self.flush()
+
+    def __setitem__(self, key: str, uid: str):
+        self.set_many({key: uid})
+
+    def _run_filename(self) -> str:
+        return os.path.join(self.directory, f'run-{time.time_ns():020d}-{os.getpid()}.npy')
+
+    def _write_run(self, rows: np.ndarray) -> str:
+        """
+        Sort rows by hash and write them as a new run, under a temporary
+        name first so readers never see a partial run.
+
+        :param rows:
+        :return: the run's filename
+        """
+        rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+        filename = self._run_filename()
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, rows, allow_pickle=False)
+        os.replace(tmp, filename)
+        return filename
+
+    def _merge_runs(self, runs: typing.List[np.ndarray], block: int = 1 << 16) -> str:
+        """
+        Merge sorted runs into a new run, block by block, so only about
+        block rows of each run are in memory at once. A key in several
+        runs keeps the uid of the first run it is in.
+
+        :param runs: runs to merge, newest first
+        :param block: rows of each run to read at a time
+        :return: the merged run's filename
+        """
+        filename = self._run_filename()
+        tmp = filename + '.tmp'
+        positions = [0] * len(runs)
+        written = 0
+        with open(tmp, 'wb') as f:
+            f.write(npy_header(0))
+            while True:
+                chunks = {
+                    i: np.asarray(run[positions[i]:positions[i] + block])
+                    for i, run in enumerate(runs) if positions[i] < len(run)
+                }
+                if len(chunks) == 0:
+                    break
+
+                # Every key up to the smallest last key of a chunk that
+                # doesn't reach the end of its run is in these chunks, since
+                # keys are unique within a run
+                bounds = [
+                    (int(chunk[-1, 0]), int(chunk[-1, 1]))
+                    for i, chunk in chunks.items() if positions[i] + len(chunk) < len(runs[i])
+                ]
+                parts = []
+                for i, chunk in chunks.items():
+                    if len(bounds) > 0:
+                        high, low = min(bounds)
+                        chunk = chunk[:int(np.count_nonzero(
+                            (chunk[:, 0] < high) | ((chunk[:, 0] == high) & (chunk[:, 1] <= low))
+                        ))]
+                    positions[i] += len(chunk)
+                    parts.append((chunk, np.full(len(chunk), i, dtype=np.uint64)))
+
+                rows = np.concatenate([chunk for chunk, _ in parts])
+                order = np.concatenate([source for _, source in parts])
+                sort = np.lexsort((order, rows[:, 1], rows[:, 0]))
+                rows = rows[sort]
+
+                # Keep the row from the newest run of every key
+                first = np.ones(len(rows), dtype=np.bool_)
+                first[1:] = (rows[1:, 0] != rows[:-1, 0]) | (rows[1:, 1] != rows[:-1, 1])
+                rows = np.ascontiguousarray(rows[first], dtype='<u8')
+                f.write(rows.tobytes())
+                written += len(rows)
+
+            f.seek(0)
+            f.write(npy_header(written))
+        os.replace(tmp, filename)
+        return filename
+
+    def flush(self):
+        """
+        Write the added keys as a new run, then merge runs if a size tier
+        has filled up.
+
+        :return:
+        """
+        if len(self.added) == 0:
+            return
+
+        keys = list(self.added)
+        rows = np.empty((len(keys), 3), dtype=np.uint64)
+        rows[:, :2] = self._hash(keys)
+        rows[:, 2] = [int(uid, 16) for uid in self.added.values()]
+        filename = self._write_run(rows)
+        self.added = dict()
+
+        self.runs = {filename: np.load(filename, mmap_mode='r', allow_pickle=False), **self.runs}
+        self.compact()
+
+    def _tier(self, rows: int) -> int:
+        return int(math.log(max(rows, 1), self.fanout))
+
+    def compact(self, full: bool = False):
+        """
+        Merge runs of the same size tier, fanout at a time, or every run
+        into one if full, streaming through them in key order. Only one
+        process merges at a time, others skip.
+
+        :param full:
+        :return:
+        """
+        with open(os.path.join(self.directory, 'compact.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            while True:
+                self.refresh()
+                tiers = dict()
+                for filename, run in self.runs.items():
+                    tiers.setdefault(0 if full else self._tier(len(run)), []).append(filename)
+                merge = next((filenames for filenames in tiers.values() if len(filenames) >= self.fanout), None)
+                if full and len(self.runs) > 1:
+                    merge = list(self.runs)
+                if merge is None:
+                    return
+
+                self._merge_runs([self.runs[filename] for filename in merge])
+                for filename in merge:
+                    os.remove(filename)
+
+    def close(self):
+        """
+        Write out whatever was added since the last run.
+
+        :return:
+        """
+        self.flush()
+        self.runs = dict()
+
+    @classmethod
+    def rebuild(cls, directory: str, filenames: typing.List[str], predicates: typing.Dict[str, str]) -> typing.Dict[str, int]:
+        """
+        Build the indexes of some node kinds from scratch, from the .rdf.gz
+        files of a DGraph export. Existing indexes are removed first, so no
+        worker should be using them.
+
+        :param directory: index root, with one directory per node kind
+        :param filenames: exported N-Quad files
+        :param predicates: node kind -> predicate holding the node key
+        :return: node kind -> number of keys indexed
+        """
+        indexes = dict()
+        for kind in predicates:
+            shutil.rmtree(os.path.join(directory, kind), ignore_errors=True)
+            indexes[kind] = cls(os.path.join(directory, kind), run_size=1 << 22)
+        kinds = {predicate: kind for kind, predicate in predicates.items()}
+
+        counts = {kind: 0 for kind in predicates}
+        for filename in filenames:
+            with open_read(filename, 'rt') as f:
+                for line in f:
+                    match = export_triple.match(line)
+                    if match is None or match.group(2) not in kinds:
+                        continue
+                    kind = kinds[match.group(2)]
+                    indexes[kind][unescape(match.group(3))] = match.group(1)
+                    counts[kind] += 1
+
+        for index in indexes.values():
+            index.flush()
+            index.compact(full=True)
+            index.close()
+        return counts
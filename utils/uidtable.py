@@ -0,0 +1,114 @@
+import json
+import typing
+
+import numpy as np
+
+from utils.snapshot import load_arrays, save_arrays
+
+
+class UidTable(object):
+    """
+    Read only key -> uid table for node types that are fixed once ingested,
+    like countries and ASNs.
+
+    Keys are kept as a sorted numpy array, with the uids as integers in a
+    second array, so lookups are a binary search. A table can be saved as a
+    directory of .npy files. Loading it memory maps the arrays, so every
+    worker process shares the same pages and lookups never touch the
+    network.
+    """
+
+    arrays = ['keys', 'uids']
+
+    def __init__(self, keys: np.ndarray, uids: np.ndarray):
+        """
+        :param keys: sorted keys
+        :param uids: uid of each key
+        """
+        super(UidTable, self).__init__()
+
+        self.keys = keys
+        self.uids = uids
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def build(cls, items: typing.Mapping[str, str]) -> 'UidTable':
+        """
+        Build a table from a key -> uid mapping, with uids as DGraph gives
+        them ("0x1f").
+
+        :param items:
+        :return:
+        """
+        keys = np.asarray([str(key) for key in items.keys()], dtype=str)
+        uids = np.asarray([int(uid, 16) for uid in items.values()], dtype=np.uint64)
+        order = np.argsort(keys, kind='stable')
+        return cls(keys[order], uids[order])
+
+    @classmethod
+    def query(cls, client, dgraph_type: str, predicate: str) -> 'UidTable':
+        """
+        Build a table of every node of a type, keyed by one of its predicates.
+
+        :param client: DGraph client
+        :param dgraph_type:
+        :param predicate:
+        :return:
+        """
+        query = """{ all(func: type(%s)) { uid %s } }""" % (dgraph_type, predicate)
+        result = json.loads(client.txn(read_only=True).query(query).json)
+        return cls.build({node[predicate]: node['uid'] for node in result['all'] if predicate in node})
+
+    def save(self, path: str):
+        """
+        Write the table to a snapshot directory.
+
+        :param path:
+        :return:
+        """
+        save_arrays(path, {name: getattr(self, name) for name in self.arrays})
+
+    @classmethod
+    def load(cls, path: str) -> 'UidTable':
+        """
+        Memory map a table written by save.
+
+        :param path:
+        :return:
+        """
+        return cls(*load_arrays(path, cls.arrays))
+
+    def get_many(self, keys: typing.Iterable[str]) -> typing.List[typing.Union[str, None]]:
+        """
+        Look up a batch of keys with a single searchsorted.
+
+        :param keys:
+        :return: uid of each key, None where a key is not in the table
+        """
+        keys = np.asarray(list(keys), dtype=str)
+        if len(self.keys) == 0 or len(keys) == 0:
+            return [None] * len(keys)
+
+        index = np.searchsorted(self.keys, keys)
+        index[index >= len(self.keys)] = 0
+        found = self.keys[index] == keys
+        return [
+            hex(uid) if hit else None
+            for uid, hit in zip(self.uids[index].tolist(), found.tolist())
+        ]
+
+    def __getitem__(self, key: str) -> typing.Union[str, None]:
+        return self.get_many([key])[0]
+
+    def __contains__(self, key: str) -> bool:
+        return self[key] is not None
+
+    def close(self):
+        """
+        Nothing to close, the memory maps go away with the table. Here so a
+        table can stand in for a LayeredCache.
+
+        :return:
+        """